@@ -8,15 +8,40 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
-from comments.routing import websocket_urlpatterns
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "comment_systems.settings")
 
+# Sets Django up, so it has to run before anything that imports models.
+django_asgi_app = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from comments.routing import websocket_urlpatterns  # noqa: E402
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.auth import AuthMiddlewareStack  # noqa: E402
+from comments.instrumentation import serve_web_metrics  # noqa: E402
+from .serving import FileServingApp, ThreadPoolWSGIApp  # noqa: E402
+
+# Runs in every uvicorn worker, each of which imports this module.
+serve_web_metrics()
+
+http_app = django_asgi_app
+# Production profile: see production_settings.py
+if getattr(settings, "COMMENTS_HTTP_THREADS", 0):
+    http_app = ThreadPoolWSGIApp(get_wsgi_application(), settings.COMMENTS_HTTP_THREADS)
+if getattr(settings, "COMMENTS_SERVE_FILES", False):
+    http_app = FileServingApp(
+        http_app,
+        [
+            (settings.STATIC_URL, settings.STATIC_ROOT),
+            (settings.MEDIA_URL, settings.MEDIA_ROOT),
+        ],
+        max_age=getattr(settings, "COMMENTS_FILES_MAX_AGE", 86400),
+    )
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": http_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
@@ -0,0 +1,66 @@
+# Settings for running the benchmarks (manage.py bench_suite and the other
+# bench_* commands) on a workstation without the docker stack:
+#
+#   DJANGO_SETTINGS_MODULE=comment_systems.bench_settings python manage.py migrate
+#   DJANGO_SETTINGS_MODULE=comment_systems.bench_settings python manage.py bench_suite
+#
+# BENCH_DB=mysql uses the DB_* variables of settings.py (e.g. the MySQL
+# container from docker-compose), anything else a local SQLite file.
+# BENCH_REDIS_URL points the cache at a real Redis; without it the cache is
+# an in-process fakeredis server (pip install fakeredis). Captcha checks are
+# stubbed out. BENCH_PROFILE=production starts from production_settings
+# instead of settings (for manage.py bench_serving), BENCH_DEBUG=1 turns
+# DEBUG back on.
+import os
+
+if os.getenv("BENCH_PROFILE") == "production":
+    os.environ.setdefault("DJANGO_SECRET_KEY", "bench")
+    os.environ.setdefault("DJANGO_ALLOWED_HOSTS", "127.0.0.1,localhost,testserver")
+    from .production_settings import *  # noqa: F401,F403
+    from .production_settings import BASE_DIR, DATABASES
+else:
+    from .settings import *  # noqa: F401,F403
+    from .settings import BASE_DIR, DATABASES
+
+DEBUG = os.getenv("BENCH_DEBUG") == "1"
+
+if os.getenv("BENCH_DB", "sqlite") != "mysql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv("BENCH_SQLITE_PATH", str(BASE_DIR / "bench.sqlite3")),
+            "CONN_MAX_AGE": DATABASES["default"].get("CONN_MAX_AGE", 0),
+            "CONN_HEALTH_CHECKS": DATABASES["default"].get("CONN_HEALTH_CHECKS", False),
+        }
+    }
+    # The FULLTEXT index behind the default search backend is MySQL only.
+    COMMENTS_SEARCH_BACKEND = "comments.search.LocalInvertedIndexBackend"
+
+if os.getenv("BENCH_REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": os.getenv("BENCH_REDIS_URL"),
+            "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+        }
+    }
+else:
+    import fakeredis
+
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": "redis://bench/1",
+            "OPTIONS": {
+                "CLIENT_CLASS": "django_redis.client.DefaultClient",
+                "CONNECTION_POOL_KWARGS": {
+                    "connection_class": fakeredis.FakeConnection,
+                    "server": fakeredis.FakeServer(),
+                },
+            },
+        }
+    }
+
+CAPTCHA_VERIFIER = "comments.captcha.StubCaptchaVerifier"
+# Tasks (broadcasts, renditions) run in the benchmark process.
+CELERY_TASK_ALWAYS_EAGER = True
@@ -0,0 +1,38 @@
+# Production serving profile (docker-compose.prod.yml):
+#
+#   DJANGO_SETTINGS_MODULE=comment_systems.production_settings python manage.py serve
+#
+# manage.py serve runs the ASGI application under uvicorn with one process
+# per CPU, each with COMMENTS_HTTP_THREADS request threads; its help text
+# has the sizing formula. Requires DJANGO_SECRET_KEY and DJANGO_ALLOWED_HOSTS.
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES, os
+
+DEBUG = False
+
+SECRET_KEY = os.getenv("DJANGO_SECRET_KEY")
+if not SECRET_KEY:
+    raise ImproperlyConfigured("Set DJANGO_SECRET_KEY for the production profile.")
+ALLOWED_HOSTS = [h for h in os.getenv("DJANGO_ALLOWED_HOSTS", "").split(",") if h]
+if not ALLOWED_HOSTS:
+    raise ImproperlyConfigured(
+        "Set DJANGO_ALLOWED_HOSTS (comma-separated) for the production profile."
+    )
+
+# Each request thread keeps its connection open between requests and pings
+# it before reuse; connections idle longer than this are closed.
+DATABASES["default"]["CONN_MAX_AGE"] = int(os.getenv("DB_CONN_MAX_AGE", "60"))
+DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
+# HTTP runs on this many long-lived threads per worker process, so it is
+# also the number of database connections a worker holds (see serving.py).
+COMMENTS_HTTP_THREADS = int(os.getenv("COMMENTS_HTTP_THREADS", "4"))
+
+# /static/ (collectstatic output) and /media/ are served by the ASGI
+# process itself, off the request threads; set COMMENTS_SERVE_FILES=0 when
+# a proxy in front serves them.
+STATIC_ROOT = BASE_DIR / "staticfiles"
+COMMENTS_SERVE_FILES = os.getenv("COMMENTS_SERVE_FILES", "1") == "1"
+COMMENTS_FILES_MAX_AGE = 86400
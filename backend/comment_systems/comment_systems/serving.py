@@ -0,0 +1,229 @@
+"""
+ASGI building blocks of the production profile (production_settings.py).
+
+Django's ASGI handler runs every request's sync code in a thread of its
+own, so thread-local database connections are opened and dropped per
+request whatever CONN_MAX_AGE says. ThreadPoolWSGIApp runs the WSGI
+handler on a fixed pool of long-lived threads instead: each thread keeps
+its connection for CONN_MAX_AGE seconds, and the pool size bounds the
+connections a worker process holds.
+"""
+
+import asyncio
+import mimetypes
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ThreadPoolWSGIApp:
+    """ASGI HTTP application running ``wsgi_application`` on ``threads``
+    long-lived threads"""
+
+    def __init__(self, wsgi_application, threads):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="http")
+
+    async def __call__(self, scope, receive, send):
+        await _PooledInstance(self.wsgi_application, self.executor)(
+            scope, receive, send
+        )
+
+
+# Requests repeating a header more often than this are answered with 400.
+DUPLICATE_HEADER_LIMIT = 100
+
+
+def build_environ(scope, body):
+    """WSGI environ of an ASGI HTTP ``scope`` whose request body is ``body``;
+    raises ValueError if a header repeats too often"""
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name) :]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client") is not None:
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    headers = defaultdict(list)
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        if name == "content-length":
+            name = "CONTENT_LENGTH"
+        elif name == "content-type":
+            name = "CONTENT_TYPE"
+        else:
+            name = "HTTP_" + name.upper().replace("-", "_")
+        if len(headers[name]) >= DUPLICATE_HEADER_LIMIT:
+            raise ValueError(f"Too many {name} headers")
+        headers[name].append(value.decode("latin1"))
+    for name, values in headers.items():
+        environ[name] = ",".join(values)
+    return environ
+
+
+class _PooledInstance:
+    """Handles one request: reads the body on the event loop, then runs the
+    WSGI application and relays its response from a pool thread"""
+
+    def __init__(self, wsgi_application, executor):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+        self.response_start = None
+        self.response_started = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            raise ValueError("ThreadPoolWSGIApp received a non-HTTP scope")
+        self.scope = scope
+        loop = asyncio.get_running_loop()
+
+        def sync_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        self.sync_send = sync_send
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            await loop.run_in_executor(self.executor, self.run, body)
+
+    def start_response(self, status, response_headers, exc_info=None):
+        if exc_info is not None:
+            if self.response_started:
+                raise exc_info[1].with_traceback(exc_info[2])
+        elif self.response_start is not None:
+            raise ValueError("start_response called a second time without exc_info")
+        self.response_start = {
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [
+                (name.lower().encode("ascii"), value.encode("latin1"))
+                for name, value in response_headers
+            ],
+        }
+
+    def run(self, body):
+        try:
+            environ = build_environ(self.scope, body)
+        except ValueError:
+            self.start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            self.sync_send(self.response_start)
+            self.sync_send({"type": "http.response.body", "body": b"Bad Request"})
+            return
+        response = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in response:
+                if not chunk:
+                    continue
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        finally:
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body"})
+
+
+class FileServingApp:
+    """Serves GET and HEAD requests under each ``(url_prefix, root)`` of
+    ``mounts`` from disk on the event loop, with ETag revalidation;
+    everything else goes to ``app``. Reads run in the loop's default
+    executor, so no request thread is tied up by a download."""
+
+    def __init__(self, app, mounts, max_age=86400):
+        self.app = app
+        self.mounts = [(prefix, root) for prefix, root in mounts if prefix and root]
+        self.max_age = max_age
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            for prefix, root in self.mounts:
+                if scope["path"].startswith(prefix):
+                    return await self.serve(
+                        scope, send, root, scope["path"][len(prefix) :]
+                    )
+        return await self.app(scope, receive, send)
+
+    async def serve(self, scope, send, root, name):
+        try:
+            path = safe_join(root, name)
+            stat = os.stat(path)
+        except (SuspiciousFileOperation, OSError, ValueError):
+            return await self.respond(send, 404, [], b"Not Found")
+        if not os.path.isfile(path):
+            return await self.respond(send, 404, [], b"Not Found")
+
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers = [
+            (b"etag", etag.encode()),
+            (b"last-modified", http_date(stat.st_mtime).encode()),
+            (b"cache-control", f"public, max-age={self.max_age}".encode()),
+        ]
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match")
+        if if_none_match and etag in parse_etags(if_none_match.decode("latin1")):
+            return await self.respond(send, 304, headers, b"")
+
+        content_type, encoding = mimetypes.guess_type(path)
+        # Compressed files (.tar.gz) are sent as they are, not decoded.
+        if content_type is None or encoding is not None:
+            content_type = "application/octet-stream"
+        headers += [
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(stat.st_size).encode()),
+            (b"x-content-type-options", b"nosniff"),
+        ]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        if scope["method"] == "HEAD":
+            return await send({"type": "http.response.body"})
+
+        loop = asyncio.get_running_loop()
+        with open(path, "rb") as file:
+            while chunk := await loop.run_in_executor(None, file.read, CHUNK_SIZE):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        await send({"type": "http.response.body"})
+
+    async def respond(self, send, status, headers, body):
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
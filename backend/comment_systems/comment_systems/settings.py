@@ -47,8 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "comments.middleware.InstrumentationMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "comments.middleware.CompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -100,11 +102,46 @@ DATABASES = {
 }
 RECAPTCHA_SECRET_KEY = os.getenv('RECAPTCHA_SECRET_KEY')
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
+# "comments.captcha.StubCaptchaVerifier" accepts every token without a
+# network call; use it for local benchmarks and tests only.
+CAPTCHA_VERIFIER = os.getenv("CAPTCHA_VERIFIER", "comments.captcha.RecaptchaVerifier")
+CAPTCHA_CONNECT_TIMEOUT = 2
+CAPTCHA_READ_TIMEOUT = 3
+CAPTCHA_HTTP_POOL_SIZE = 10
+CAPTCHA_VERIFIED_TTL = 120
+
+# Set CHANNEL_REDIS_URL to share websocket groups between Daphne workers;
+# CHANNEL_LAYER=pubsub selects the Redis pub/sub layer instead of lists.
+CHANNEL_REDIS_URL = os.getenv("CHANNEL_REDIS_URL")
+if CHANNEL_REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": (
+                "channels_redis.pubsub.RedisPubSubChannelLayer"
+                if os.getenv("CHANNEL_LAYER") == "pubsub"
+                else "channels_redis.core.RedisChannelLayer"
+            ),
+            "CONFIG": {
+                "hosts": [CHANNEL_REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Comments broadcast within this many seconds are sent to each socket as one
+# batched frame; 0 sends every comment immediately.
+COMMENTS_WS_FLUSH_INTERVAL = float(os.getenv("COMMENTS_WS_FLUSH_INTERVAL", "0.05"))
+# Upper bound on per-thread websocket subscriptions held by one socket.
+COMMENTS_WS_MAX_THREADS = 200
+# Recently published comments kept in Redis for reconnecting sockets, and
+# the largest gap replayed before a client is told to reload over REST.
+COMMENTS_WS_REPLAY_BUFFER = 1000
+COMMENTS_WS_REPLAY_LIMIT = 500
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -155,6 +192,10 @@ REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_simplejwt.authentication.JWTAuthentication",
     ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "comments.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
 }
 from datetime import timedelta
 
@@ -173,6 +214,30 @@ CELERY_TASK_SERIALIZER = 'json'
 
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+CELERY_BEAT_SCHEDULE = {
+    "broadcast-comment-events": {
+        "task": "comments.tasks.broadcast_comment_events",
+        "schedule": 10.0,
+    },
+    "process-pending-renditions": {
+        "task": "comments.tasks.process_pending_renditions",
+        "schedule": 60.0,
+    },
+}
+# Image work gets its own queue and worker so upload spikes cannot delay
+# broadcasts and other light tasks on the default "celery" queue.
+CELERY_TASK_ROUTES = {
+    "comments.tasks.process_pending_renditions": {"queue": "images"},
+    "comments.tasks.resize_comment_attachment": {"queue": "images"},
+}
+# Processes per images worker and uploads rendered per batch; 0 workers
+# renders inline in the task.
+COMMENTS_RENDITION_WORKERS = int(os.getenv("COMMENTS_RENDITION_WORKERS", "2"))
+COMMENTS_RENDITION_BATCH_SIZE = 20
+COMMENTS_EVENT_RETENTION = timedelta(days=1)
+# Longest a comment's transaction may take to commit: websocket frames only
+# count older outbox events as delivered (see comments.events).
+COMMENTS_OUTBOX_COMMIT_GRACE = timedelta(seconds=5)
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -182,3 +247,42 @@ CACHES = {
         }
     }
 }
+
+# Soft TTL (seconds) of cached comment list pages by page depth: the first
+# (max_page, ttl) pair that covers the requested page applies. Expired pages
+# are served for another COMMENTS_PAGE_CACHE_STALE_TTL seconds while a single
+# request recomputes them.
+COMMENTS_PAGE_CACHE_TTLS = [(1, 300), (10, 600)]
+COMMENTS_PAGE_CACHE_DEFAULT_TTL = 1800
+COMMENTS_PAGE_CACHE_STALE_TTL = 60
+# Responses smaller than this many bytes are not compressed.
+COMMENTS_COMPRESS_MIN_SIZE = 1024
+# Lifetime of the per-comment serialized fragments pages are assembled from.
+COMMENTS_FRAGMENT_CACHE_TTL = 86400
+# Per-request timings (SQL, serialization, cache hits) sent to clients in a
+# Server-Timing header; the same numbers are always recorded as metrics.
+COMMENTS_SERVER_TIMING = os.getenv("COMMENTS_SERVER_TIMING", "1") == "1"
+# Addresses allowed to read /metrics/ (Prometheus text format).
+COMMENTS_METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+# Celery pool processes serve their metrics on this port plus their index.
+COMMENTS_METRICS_WORKER_PORT = int(os.getenv("COMMENTS_METRICS_WORKER_PORT", "0"))
+# Each web worker process serves its metrics on the first free port from this
+# one, since /metrics/ reaches a single worker; scrape all of them.
+COMMENTS_METRICS_WEB_PORT = int(os.getenv("COMMENTS_METRICS_WEB_PORT", "0"))
+
+# Uploads whose width * height * frames exceeds this are rejected from the
+# header alone, before any pixel is decoded.
+COMMENTS_IMAGE_MAX_PIXELS = 40_000_000
+
+# comments.search.MySQLFulltextBackend needs the FULLTEXT index from
+# migration 0006; LocalInvertedIndexBackend works on any database but only
+# sees writes made by its own process.
+COMMENTS_SEARCH_BACKEND = os.getenv(
+    "COMMENTS_SEARCH_BACKEND", "comments.search.MySQLFulltextBackend"
+)
+
+# How meta.total of comment listings is computed unless ?count= overrides it:
+# "exact", "cached" (counter kept in step by writes, recounted every
+# COMMENTS_COUNT_CACHE_TTL seconds) or "approximate" (table statistics).
+COMMENTS_COUNT_MODE = os.getenv("COMMENTS_COUNT_MODE", "cached")
+COMMENTS_COUNT_CACHE_TTL = 3600
@@ -21,11 +21,14 @@ from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+from comments.views import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("comments.urls")),
     path("api/", include("user.urls")),
     path("api/login/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
+    path("metrics/", metrics_view, name="metrics"),
 ]
 
 if settings.DEBUG:
@@ -7,4 +7,4 @@ class CommentsConfig(AppConfig):
 
     def ready(self):
 
-        from . import signals
+        from . import checks, instrumentation, signals
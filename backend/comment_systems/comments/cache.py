@@ -0,0 +1,239 @@
+import hashlib
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .instrumentation import record_cache
+
+# Inserting a comment shifts every offset page and changes the total, but
+# leaves keyset pages older than their cursor untouched. Edits and deletes
+# can touch any page. Each kind of write bumps its own version counter and
+# cached list entries record the versions their contents depend on, so a
+# write costs a single INCR and nothing else in the cache is flushed.
+# Replies only change their own thread: pages also record a version per
+# thread they show, and a reply bumps only its root's.
+HEAD_VERSION_KEY = "comments_list_head_version"
+CONTENT_VERSION_KEY = "comments_list_content_version"
+
+DEFAULT_PAGE_CACHE_TTLS = [(1, 300), (10, 600)]
+DEFAULT_PAGE_CACHE_DEFAULT_TTL = 1800
+DEFAULT_PAGE_CACHE_STALE_TTL = 60
+
+# Serialized comments are cached one by one under their id and
+# Comment.version, which every write that changes the output bumps; stale
+# fragments are never read again and simply expire.
+DEFAULT_FRAGMENT_CACHE_TTL = 86400
+
+LOCK_TIMEOUT = 30
+# A lock holder may take up to LOCK_TIMEOUT; after that its lock expires and
+# a waiter takes over, so waiters give up a little later.
+WAIT_TIMEOUT = LOCK_TIMEOUT + 5.0
+WAIT_INTERVAL = 0.05
+EARLY_EXPIRY_BETA = 1.0
+
+
+def get_list_versions():
+    versions = cache.get_many([HEAD_VERSION_KEY, CONTENT_VERSION_KEY])
+    return versions.get(HEAD_VERSION_KEY, 0), versions.get(CONTENT_VERSION_KEY, 0)
+
+
+def _bump(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+        return 1
+
+
+def bump_head_version():
+    """Invalidate pages that show the newest comments or the total"""
+    return _bump(HEAD_VERSION_KEY)
+
+
+def bump_content_version():
+    """Invalidate every cached list page"""
+    return _bump(CONTENT_VERSION_KEY)
+
+
+def thread_version_key(root_id):
+    return f"comments_thread_{root_id}_version"
+
+
+def bump_thread_version(root_id):
+    """Invalidate the cached list pages that show a comment of the thread
+    under ``root_id``, for replies and reply edits"""
+    return _bump(thread_version_key(root_id))
+
+
+def page_cache_key(page, per_page, query_suffix=""):
+    """``query_suffix`` is CommentListQuery.cache_suffix() of the request"""
+    head, content = get_list_versions()
+    key = f"comments_page_{page}_per_{per_page}{query_suffix}"
+    return key, f"{head}.{content}"
+
+
+def cursor_cache_key(
+    cursor, direction, per_page, with_total=False, query_suffix="", newest_first=True
+):
+    head, content = get_list_versions()
+    # Inserts only shift the first page of a newest-first listing; in any
+    # other ordering a new comment can land on any page.
+    if cursor is None or direction == "prev" or with_total or not newest_first:
+        version = f"{head}.{content}"
+    else:
+        version = f"x.{content}"
+    key = f"comments_cursor_{cursor or 'head'}_per_{per_page}{query_suffix}"
+    if with_total:
+        key += "_total"
+    return key, version
+
+
+def page_cache_ttl(depth):
+    """Soft TTL for a list page ``depth`` pages away from the newest comment"""
+    ttls = getattr(settings, "COMMENTS_PAGE_CACHE_TTLS", DEFAULT_PAGE_CACHE_TTLS)
+    for max_depth, ttl in ttls:
+        if depth <= max_depth:
+            return ttl
+    return getattr(
+        settings, "COMMENTS_PAGE_CACHE_DEFAULT_TTL", DEFAULT_PAGE_CACHE_DEFAULT_TTL
+    )
+
+
+def list_etag(key, tag):
+    """Strong ETag of the list entry ``key`` with the tag get_or_compute_versioned
+    returned; unchanged for as long as the page it names is"""
+    digest = hashlib.blake2b(f"{key}:{tag}".encode(), digest_size=12)
+    return f'"{digest.hexdigest()}"'
+
+
+def fragment_cache_key(comment_id, version):
+    return f"comments_fragment_{comment_id}_v{version}"
+
+
+def get_fragments(rows, render):
+    """Serialized comments for ``(id, version)`` rows, in row order.
+
+    The page's fragments are read with one get_many; only the misses are
+    passed to ``render(ids)``, which returns ``{id: data}``, and stored
+    with one set_many. Rows ``render`` does not return are left out.
+    """
+    keys = {
+        comment_id: fragment_cache_key(comment_id, version)
+        for comment_id, version in rows
+    }
+    fragments = cache.get_many(list(keys.values()))
+    missing = [comment_id for comment_id, key in keys.items() if key not in fragments]
+    record_cache("fragment", "hit", len(fragments))
+    record_cache("fragment", "miss", len(missing))
+    if missing:
+        rendered = {
+            keys[comment_id]: data for comment_id, data in render(missing).items()
+        }
+        ttl = getattr(
+            settings, "COMMENTS_FRAGMENT_CACHE_TTL", DEFAULT_FRAGMENT_CACHE_TTL
+        )
+        cache.set_many(rendered, timeout=ttl)
+        fragments.update(rendered)
+    return [fragments[key] for key in keys.values() if key in fragments]
+
+
+def key_family(key):
+    """ "page" for ``comments_page_2_per_25``, "cursor" for cursor pages"""
+    parts = key.split("_", 2)
+    return parts[1] if len(parts) > 1 else key
+
+
+def _is_fresh(entry, version):
+    if entry["version"] != version:
+        return False
+    threads = entry.get("threads")
+    if threads:
+        current = cache.get_many(list(threads))
+        if any(current.get(key, 0) != seen for key, seen in threads.items()):
+            return False
+    # XFetch: refresh ahead of expiry with a probability that grows as the
+    # entry ages and with how long it took to compute.
+    jitter = entry["delta"] * EARLY_EXPIRY_BETA * -math.log(1.0 - random.random())
+    return time.time() + jitter < entry["expires"]
+
+
+def _entry_tag(entry):
+    threads = entry.get("threads")
+    if not threads:
+        return entry["version"]
+    return entry["version"] + "".join(f":{v}" for _, v in sorted(threads.items()))
+
+
+def get_or_compute(key, version, compute, ttl):
+    """Read-through cache with single-flight recomputation.
+
+    Only the request holding ``<key>_lock`` (an atomic SET NX in Redis) runs
+    ``compute``. Concurrent requests serve the previous entry while it is
+    within its stale window, or wait for the lock holder to publish.
+    """
+    return get_or_compute_versioned(key, version, compute, ttl)[0]
+
+
+def get_or_compute_versioned(key, version, compute, ttl, threads=False):
+    """``get_or_compute`` returning ``(value, tag)``. The tag names what the
+    value was computed from, and is None when a stale entry was served.
+
+    With ``threads``, ``compute`` returns ``(value, root ids)`` of the
+    threads shown in ``value``, and the entry also goes stale when one of
+    them changes (bump_thread_version).
+    """
+    family = key_family(key)
+    entry = cache.get(key)
+    if entry is not None and _is_fresh(entry, version):
+        record_cache(family, "hit")
+        return entry["value"], _entry_tag(entry)
+
+    lock_key = f"{key}_lock"
+    if not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        if entry is not None:
+            record_cache(family, "stale")
+            return entry["value"], None
+        # Wait for the holder to publish. If it gives up (compute raised)
+        # or its lock expires, the first waiter to take the lock recomputes
+        # and the others go on waiting for that one.
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            time.sleep(WAIT_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None and entry["version"] == version:
+                record_cache(family, "waited")
+                return entry["value"], _entry_tag(entry)
+            if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+                break
+            if time.monotonic() >= deadline:
+                # Only reached when the cache keeps failing to answer.
+                record_cache(family, "miss")
+                value = compute()
+                return (value[0] if threads else value), None
+
+    record_cache(family, "miss")
+    try:
+        started = time.time()
+        value = compute()
+        finished = time.time()
+        entry = {
+            "value": value,
+            "version": version,
+            "delta": finished - started,
+            "expires": finished + ttl,
+        }
+        if threads:
+            entry["value"], roots = value
+            keys = [thread_version_key(root_id) for root_id in roots]
+            seen = cache.get_many(keys)
+            entry["threads"] = {key: seen.get(key, 0) for key in keys}
+        stale_ttl = getattr(
+            settings, "COMMENTS_PAGE_CACHE_STALE_TTL", DEFAULT_PAGE_CACHE_STALE_TTL
+        )
+        cache.set(key, entry, timeout=ttl + stale_ttl)
+        return entry["value"], _entry_tag(entry)
+    finally:
+        cache.delete(lock_key)
@@ -0,0 +1,36 @@
+from celery.signals import worker_init
+from django.conf import settings
+from django.core import checks
+
+IN_MEMORY_LAYER = "channels.layers.InMemoryChannelLayer"
+
+
+def in_memory_layer_errors():
+    layer = getattr(settings, "CHANNEL_LAYERS", {}).get("default", {})
+    if layer.get("BACKEND") != IN_MEMORY_LAYER:
+        return []
+    return [
+        checks.Error(
+            "The channel layer is in-memory, so comment events published by "
+            "Celery workers never reach the web process's sockets.",
+            hint="Set CHANNEL_REDIS_URL for the web and Celery processes.",
+            id="comments.E001",
+        )
+    ]
+
+
+@checks.register(deploy=True)
+def check_channel_layer(app_configs, **kwargs):
+    """broadcast_comment_events publishes from whichever process runs it"""
+    if getattr(settings, "CELERY_TASK_ALWAYS_EAGER", False):
+        return []
+    return in_memory_layer_errors()
+
+
+@worker_init.connect
+def refuse_in_memory_layer(**kwargs):
+    # Celery runs no system checks, and a worker publishing to a layer of its
+    # own would mark every event delivered.
+    errors = in_memory_layer_errors()
+    if errors:
+        raise SystemExit("\n".join(f"{e.id}: {e.msg} HINT: {e.hint}" for e in errors))
@@ -1,35 +1,254 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Comment, CommentEvent
 from .serializers import CommentSerializer
+from .events import delivered_through, record_events, replay
+from .metrics import counter, histogram
+
+FEED_GROUP = "comments"
+
+broadcast_seconds = histogram(
+    "comments_ws_broadcast_seconds",
+    "Time to serialize and group_send one batch of outbox events",
+)
+broadcast_events = counter(
+    "comments_ws_broadcast_events_total", "Outbox events sent to channel groups"
+)
+frames_sent = counter(
+    "comments_ws_frames_total", "Comment frames sent to sockets, by frame type"
+)
+
+
+def thread_group(root_id):
+    return f"comments_thread_{root_id}"
+
 
 class CommentConsumer(AsyncWebsocketConsumer):
+    """Sockets start on the feed of new root comments and subscribe to the
+    threads they display to receive replies:
+
+        {"action": "subscribe", "threads": [12, 40]}
+        {"action": "unsubscribe", "threads": [12], "feed": true}
+
+    Every comment frame carries ``through``, the outbox sequence number up
+    to which the socket has been sent everything it subscribes to. Clients
+    reconnect with the highest ``through`` they got as ``since_seq`` (query
+    string or subscribe message) and get what they missed in one ``replay``
+    frame, or a ``resync`` frame if the gap is too large. Replayed and live
+    comments may overlap; clients dedupe by id.
+    """
+
     async def connect(self):
-        await self.channel_layer.group_add("comments", self.channel_name)
+        self.pending = []
+        self.flush_task = None
+        self.feed = True
+        self.threads = set()
+        await self.channel_layer.group_add(FEED_GROUP, self.channel_name)
         await self.accept()
 
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        if "since_seq" in query:
+            try:
+                since_seq = int(query["since_seq"][0])
+            except ValueError:
+                await self.send_error("Invalid since_seq")
+                return
+            await self.replay(since_seq, feed=True, threads=set())
+
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard("comments", self.channel_name)
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.feed:
+            await self.channel_layer.group_discard(FEED_GROUP, self.channel_name)
+        for root_id in self.threads:
+            await self.channel_layer.group_discard(
+                thread_group(root_id), self.channel_name
+            )
 
     async def receive(self, text_data):
-      
-        pass
+        try:
+            message = json.loads(text_data)
+            action = message["action"]
+            threads = [int(root_id) for root_id in message.get("threads", [])]
+            feed = bool(message.get("feed", False))
+            since_seq = message.get("since_seq")
+            if since_seq is not None:
+                since_seq = int(since_seq)
+        except (ValueError, TypeError, KeyError):
+            await self.send_error("Invalid message")
+            return
 
+        if action == "subscribe":
+            limit = getattr(settings, "COMMENTS_WS_MAX_THREADS", 200)
+            new_threads = set(threads) - self.threads
+            if len(self.threads) + len(new_threads) > limit:
+                await self.send_error(f"Cannot subscribe to more than {limit} threads")
+                return
+            for root_id in new_threads:
+                await self.channel_layer.group_add(
+                    thread_group(root_id), self.channel_name
+                )
+            self.threads |= new_threads
+            new_feed = feed and not self.feed
+            if new_feed:
+                await self.channel_layer.group_add(FEED_GROUP, self.channel_name)
+                self.feed = True
+        elif action == "unsubscribe":
+            for root_id in set(threads) & self.threads:
+                await self.channel_layer.group_discard(
+                    thread_group(root_id), self.channel_name
+                )
+            self.threads -= set(threads)
+            if feed and self.feed:
+                await self.channel_layer.group_discard(FEED_GROUP, self.channel_name)
+                self.feed = False
+        else:
+            await self.send_error(f"Unknown action: {action}")
+            return
 
-    async def new_comment(self, event):
-        comment = event["comment"]
         await self.send(
-            text_data=json.dumps({"type": "new_comment", "comment": comment})
+            text_data=json.dumps(
+                {
+                    "type": "subscriptions",
+                    "feed": self.feed,
+                    "threads": sorted(self.threads),
+                }
+            )
+        )
+        if action == "subscribe" and since_seq is not None:
+            await self.replay(since_seq, new_feed, new_threads)
+
+    async def replay(self, since_seq, feed, threads):
+        groups = {thread_group(root_id) for root_id in threads}
+        if feed:
+            groups.add(FEED_GROUP)
+        if not groups:
+            return
+        source, through, comments = await database_sync_to_async(replay)(
+            since_seq, feed, threads, groups
+        )
+        if source is None:
+            await self.send(text_data=f'{{"type":"resync","through":{through}}}')
+            return
+        await self.send(
+            text_data=(
+                f'{{"type":"replay","source":"{source}","through":{through},'
+                f'"comments":[{",".join(comments)}]}}'
+            )
         )
-    
-def notify_new_comment(comment_instance):
+
+    async def send_error(self, error):
+        await self.send(text_data=json.dumps({"type": "error", "error": error}))
+
+    async def new_comment(self, event):
+        # The comment arrives already JSON-encoded, so a burst is coalesced
+        # into one frame without re-encoding anything per socket.
+        self.pending.append((event["seq"], event["through"], event["comment_json"]))
+        interval = getattr(settings, "COMMENTS_WS_FLUSH_INTERVAL", 0.05)
+        if interval <= 0:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later(interval))
+
+    async def flush_later(self, interval):
+        await asyncio.sleep(interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        if len(pending) == 1:
+            seq, through, comment = pending[0]
+            frame = (
+                f'{{"type":"new_comment","seq":{seq},"through":{through},'
+                f'"comment":{comment}}}'
+            )
+            frame_type = "new_comment"
+        elif pending:
+            seqs = ",".join(str(seq) for seq, _, _ in pending)
+            through = max(through for _, through, _ in pending)
+            comments = ",".join(comment for _, _, comment in pending)
+            frame = (
+                f'{{"type":"new_comments","seqs":[{seqs}],"through":{through},'
+                f'"comments":[{comments}]}}'
+            )
+            frame_type = "new_comments"
+        else:
+            return
+        await self.send(text_data=frame)
+        frames_sent.inc(type=frame_type)
+
+
+def publish_pending_events(batch_size=100):
+    """Broadcast undelivered outbox events in sequence order.
+
+    Delivery is at-least-once: events are only marked delivered after the
+    group_send succeeded, and concurrent publishers skip rows another one
+    has locked. Workers refuse to start on an in-memory channel layer
+    (comments.checks).
+    """
+    published = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                CommentEvent.objects.select_for_update(skip_locked=True)
+                .filter(delivered_at__isnull=True)
+                .order_by("id")[:batch_size]
+            )
+            if not events:
+                return published
+            started = time.perf_counter()
+            comments = Comment.objects.for_list().in_bulk(
+                [event.comment_id for event in events]
+            )
+            # Each message may only vouch for the events sent before it.
+            through = delivered_through(exclude=[event.id for event in events])
+            messages = [
+                (
+                    comment_group(comments[event.comment_id]),
+                    {
+                        "type": "new_comment",
+                        "seq": event.id,
+                        "through": (
+                            min(through, events[i + 1].id - 1)
+                            if i + 1 < len(events)
+                            else through
+                        ),
+                        "comment_json": json.dumps(
+                            CommentSerializer(comments[event.comment_id]).data,
+                            separators=(",", ":"),
+                        ),
+                    },
+                )
+                for i, event in enumerate(events)
+            ]
+            async_to_sync(group_send_all)(messages)
+            broadcast_seconds.observe(time.perf_counter() - started)
+            broadcast_events.inc(len(messages))
+            record_events(messages)
+            CommentEvent.objects.filter(id__in=[e.id for e in events]).update(
+                delivered_at=timezone.now()
+            )
+        published += len(events)
+
+
+def comment_group(comment):
+    """Root comments go to the feed, replies only to their thread"""
+    if comment.parent_comment_id is None:
+        return FEED_GROUP
+    return thread_group(comment.root_id)
+
+
+async def group_send_all(messages):
     channel_layer = get_channel_layer()
-    serializer = CommentSerializer(comment_instance)
-    async_to_sync(channel_layer.group_send)(
-        "comments",
-        {
-            "type": "new_comment",
-            "comment": serializer.data,
-        }
-    )
\ No newline at end of file
+    for group, message in messages:
+        await channel_layer.group_send(group, message)
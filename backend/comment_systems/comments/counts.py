@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from .instrumentation import record_cache
+from .models import Comment
+
+# How meta.total is produced:
+#   exact        COUNT(*) over the filtered rows
+#   cached       Redis counter kept in step by inserts and deletes, recounted
+#                when it expires; unfiltered and root-only listings only
+#   approximate  row estimate from the database's table statistics;
+#                unfiltered listing only
+# Listings a mode cannot serve fall back to the next more precise mode, and
+# meta.total_mode reports the mode that was used.
+COUNT_MODES = ("exact", "cached", "approximate")
+COUNT_CACHE_KEYS = {
+    "all": "comments_count_all",
+    "root": "comments_count_root",
+}
+DEFAULT_COUNT_CACHE_TTL = 3600
+# Value of a counter whose recount is still running; far enough below zero
+# that the increments it collects meanwhile keep it negative.
+PENDING_COUNT = -(2**62)
+
+
+def default_count_mode():
+    return getattr(settings, "COMMENTS_COUNT_MODE", "cached")
+
+
+def count_scope(query):
+    """Counter a listing can use, or None if only an exact count will do"""
+    if query.sender is not None or query.has_date_range:
+        return None
+    return "root" if query.root else "all"
+
+
+def exact_count(query):
+    return query.filter(Comment.objects.all()).count()
+
+
+def cached_count(query):
+    scope = count_scope(query)
+    if scope is None:
+        return None
+    key = COUNT_CACHE_KEYS[scope]
+    total = cache.get(key)
+    if total is not None and total >= 0:
+        record_cache("count", "hit")
+        return total
+    record_cache("count", "miss")
+    # Seed the counter before counting: inserts and deletes committed while
+    # the COUNT runs incr the seed, and the count is added on top of them.
+    ttl = getattr(settings, "COMMENTS_COUNT_CACHE_TTL", DEFAULT_COUNT_CACHE_TTL)
+    seeded = total is None and cache.add(key, PENDING_COUNT, timeout=ttl)
+    total = exact_count(query)
+    if seeded:
+        try:
+            cache.incr(key, total - PENDING_COUNT)
+        except ValueError:
+            pass
+    return total
+
+
+def approximate_count(query):
+    if count_scope(query) != "all":
+        return None
+    table = Comment._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "mysql":
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [table],
+            )
+        elif connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table]
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    return max(int(row[0]), 0) if row and row[0] is not None else None
+
+
+PROVIDERS = {
+    "exact": exact_count,
+    "cached": cached_count,
+    "approximate": approximate_count,
+}
+
+
+def count_comments(query, mode):
+    """Return ``(total, mode used)`` for a CommentListQuery"""
+    for candidate in COUNT_MODES[: COUNT_MODES.index(mode) + 1][::-1]:
+        total = PROVIDERS[candidate](query)
+        if total is not None:
+            return total, candidate
+
+
+def adjust_cached_counts(is_root, delta):
+    """Keep the cached counters in step with an insert (+1) or delete (-1).
+
+    Missing counters are left alone; the next read recounts them.
+    """
+    keys = [COUNT_CACHE_KEYS["all"]]
+    if is_root:
+        keys.append(COUNT_CACHE_KEYS["root"])
+    for key in keys:
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass
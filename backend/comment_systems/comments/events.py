@@ -0,0 +1,137 @@
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from .models import Comment, CommentEvent, path_segment
+from .serializers import CommentSerializer
+
+# Sorted set of recently published comments scored by their outbox sequence
+# number, so a reconnecting socket can catch up without touching MySQL.
+RECENT_EVENTS_KEY = "comments_recent_events"
+
+
+def get_redis():
+    """Raw Redis client behind the default cache, or None for other backends"""
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except (ImportError, NotImplementedError):
+        return None
+
+
+def buffer_size():
+    return getattr(settings, "COMMENTS_WS_REPLAY_BUFFER", 1000)
+
+
+def delivered_through(exclude=()):
+    """Highest sequence number at or below which every outbox event has
+    been broadcast, leaving out the events ``exclude`` being sent now.
+
+    Publishers lock and send batches concurrently, so events are not
+    broadcast in sequence order; a client that resumes from the highest seq
+    it received could skip one still in flight. Frames carry this value as
+    ``through`` instead.
+    """
+    # Outbox ids are handed out at INSERT but become visible at COMMIT: a
+    # row younger than the grace may follow one that is not visible yet.
+    grace = getattr(settings, "COMMENTS_OUTBOX_COMMIT_GRACE", timedelta(seconds=5))
+    events = CommentEvent.objects.order_by("id").values_list("id", flat=True)
+    settled = events.filter(created_at__lt=timezone.now() - grace).last() or 0
+    pending = events.filter(delivered_at__isnull=True).exclude(id__in=exclude)
+    first_pending = pending.first()
+    if first_pending is not None:
+        return min(settled, first_pending - 1)
+    return settled
+
+
+def record_events(messages):
+    """Remember published ``(group, message)`` pairs in the replay buffer"""
+    redis = get_redis()
+    if redis is None or not messages:
+        return
+    members = {}
+    for group, message in messages:
+        member = json.dumps(
+            {
+                "group": group,
+                "seq": message["seq"],
+                "through": message["through"],
+                "comment": message["comment_json"],
+            }
+        )
+        members[member] = message["seq"]
+    pipe = redis.pipeline()
+    pipe.zadd(RECENT_EVENTS_KEY, members)
+    pipe.zremrangebyrank(RECENT_EVENTS_KEY, 0, -buffer_size() - 1)
+    pipe.execute()
+
+
+def replay_from_buffer(since_seq, groups, limit):
+    """``(through, encoded comments)`` of the events after ``since_seq`` in
+    ``groups``, oldest first.
+
+    Returns None when the buffer does not reach back to ``since_seq``.
+    """
+    redis = get_redis()
+    if redis is None:
+        return None
+    oldest = redis.zrange(RECENT_EVENTS_KEY, 0, 0, withscores=True)
+    if not oldest or oldest[0][1] > since_seq + 1:
+        return None
+    through = since_seq
+    comments = []
+    for member in redis.zrangebyscore(RECENT_EVENTS_KEY, f"({since_seq}", "+inf"):
+        event = json.loads(member)
+        # Every event up to a published ``through`` was published before it,
+        # so it is in the buffer too.
+        through = max(through, event["through"])
+        if event["group"] in groups:
+            comments.append(event["comment"])
+            if len(comments) > limit:
+                break
+    return through, comments
+
+
+def replay_from_db(since_seq, feed, threads, limit):
+    """Same as ``replay_from_buffer``'s comments but read from the outbox;
+    None if events after ``since_seq`` were already purged"""
+    oldest = CommentEvent.objects.aggregate(oldest=Min("id"))["oldest"]
+    if oldest is not None and oldest > since_seq + 1:
+        return None
+    scope = Q()
+    if feed:
+        scope |= Q(parent_comment__isnull=True)
+    for root_id in threads:
+        scope |= Q(parent_comment__isnull=False, path__startswith=path_segment(root_id))
+    if not scope:
+        return []
+    queryset = (
+        Comment.objects.for_list()
+        .filter(scope, events__id__gt=since_seq)
+        .order_by("events__id")[: limit + 1]
+    )
+    return [
+        json.dumps(data, separators=(",", ":"))
+        for data in CommentSerializer(queryset, many=True).data
+    ]
+
+
+def replay(since_seq, feed, threads, groups):
+    """Return ``(source, through, encoded comments)``; source is None if the
+    gap is too large and the client should reload over REST instead."""
+    limit = getattr(settings, "COMMENTS_WS_REPLAY_LIMIT", 500)
+    source = "buffer"
+    result = replay_from_buffer(since_seq, groups, limit)
+    if result is None:
+        source = "db"
+        through = max(since_seq, delivered_through())
+        comments = replay_from_db(since_seq, feed, threads, limit)
+    else:
+        through, comments = result
+    if comments is None or len(comments) > limit:
+        return None, through, []
+    return source, through, comments
@@ -0,0 +1,146 @@
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .counts import COUNT_MODES, default_count_mode
+
+# ?ordering= value -> columns, most significant first. Every ordering ends in
+# (created_at, id) so it is total, and has a composite index per filter
+# combination below (see Comment.Meta.indexes); username and email are read
+# from columns denormalized onto Comment so no join is needed to sort.
+ORDERINGS = {
+    "created_at": ("created_at", "id"),
+    "username": ("sender_username", "created_at", "id"),
+    "email": ("sender_email", "created_at", "id"),
+}
+DEFAULT_ORDERING = "-created_at"
+DEFAULT_PER_PAGE = 25
+MAX_PER_PAGE = 100
+
+
+class InvalidListQuery(ValueError):
+    pass
+
+
+def _parse_moment(value, name):
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            date = parse_date(value)
+            moment = datetime.combine(date, time.min) if date else None
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise InvalidListQuery(f"{name} must be an ISO 8601 date or datetime")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class CommentListQuery:
+    """Validated ordering and filters of a list request.
+
+    ``?ordering=`` is one of ORDERINGS, optionally prefixed with "-".
+    Filters: ``root=1`` (top-level comments only), ``sender=<user id>`` and
+    ``created_after`` / ``created_before`` (ISO 8601, inclusive / exclusive).
+    ``count=`` picks how meta.total is computed, see comments.counts.
+    ``per_page`` is a positive integer, capped at MAX_PER_PAGE.
+    """
+
+    def __init__(self, params):
+        per_page = params.get("per_page", str(DEFAULT_PER_PAGE))
+        if not per_page.isdigit() or int(per_page) < 1:
+            raise InvalidListQuery("per_page must be a positive integer")
+        self.per_page = min(int(per_page), MAX_PER_PAGE)
+
+        ordering = params.get("ordering") or DEFAULT_ORDERING
+        self.descending = ordering.startswith("-")
+        self.ordering = ordering.lstrip("-")
+        if self.ordering not in ORDERINGS:
+            raise InvalidListQuery(
+                f"ordering must be one of {', '.join(sorted(ORDERINGS))}"
+                " with an optional '-' prefix"
+            )
+
+        self.root = params.get("root") in ("1", "true")
+        sender = params.get("sender")
+        if sender is not None and not sender.isdigit():
+            raise InvalidListQuery("sender must be a user id")
+        self.sender = int(sender) if sender is not None else None
+
+        self.created_after = self.created_before = None
+        if params.get("created_after"):
+            self.created_after = _parse_moment(params["created_after"], "created_after")
+        if params.get("created_before"):
+            self.created_before = _parse_moment(
+                params["created_before"], "created_before"
+            )
+        self.count_mode = params.get("count") or default_count_mode()
+        if self.count_mode not in COUNT_MODES:
+            raise InvalidListQuery(f"count must be one of {', '.join(COUNT_MODES)}")
+
+        if self.has_date_range and self.ordering != "created_at":
+            # A range on created_at cannot share an index with an ordering
+            # that starts with another column without a filesort.
+            raise InvalidListQuery("Date filters require ordering by created_at")
+
+    @property
+    def has_date_range(self):
+        return self.created_after is not None or self.created_before is not None
+
+    @property
+    def fields(self):
+        """Ordering columns. A sender's comments share one username and
+        email, so for them those orderings reduce to (created_at, id)."""
+        if self.sender is not None:
+            return ORDERINGS["created_at"]
+        return ORDERINGS[self.ordering]
+
+    @property
+    def is_default(self):
+        return not (
+            self.root
+            or self.sender is not None
+            or self.has_date_range
+            or self.ordering != "created_at"
+            or not self.descending
+            or self.count_mode != default_count_mode()
+        )
+
+    @property
+    def newest_first(self):
+        """New comments can only appear on the first page of this ordering"""
+        return self.fields == ORDERINGS["created_at"] and self.descending
+
+    def order_by(self):
+        prefix = "-" if self.descending else ""
+        return [prefix + field for field in self.fields]
+
+    def filter(self, queryset):
+        if self.root:
+            queryset = queryset.filter(parent_comment__isnull=True)
+        if self.sender is not None:
+            queryset = queryset.filter(sender_id=self.sender)
+        if self.created_after is not None:
+            queryset = queryset.filter(created_at__gte=self.created_after)
+        if self.created_before is not None:
+            queryset = queryset.filter(created_at__lt=self.created_before)
+        return queryset
+
+    def cache_suffix(self):
+        """Canonical form for cache keys; empty for the default listing"""
+        if self.is_default:
+            return ""
+        parts = [("-" if self.descending else "") + self.ordering]
+        if self.root:
+            parts.append("root")
+        if self.sender is not None:
+            parts.append(f"s{self.sender}")
+        if self.created_after is not None:
+            parts.append(f"a{self.created_after.isoformat()}")
+        if self.created_before is not None:
+            parts.append(f"b{self.created_before.isoformat()}")
+        if self.count_mode != default_count_mode():
+            parts.append(f"n{self.count_mode}")
+        return "_" + "_".join(parts)
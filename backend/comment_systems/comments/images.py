@@ -0,0 +1,153 @@
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageSequence
+
+# Rendition name -> bounding box. Written next to the original, which is
+# never modified.
+RENDITIONS = {
+    "thumb": (320, 240),
+    "thumb_2x": (640, 480),
+}
+RENDITIONS_DIR = "attachments/renditions"
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def max_pixels():
+    return getattr(settings, "COMMENTS_IMAGE_MAX_PIXELS", 40_000_000)
+
+
+def inspect_image(file):
+    """Read the image header once and return its format, size and frames.
+
+    Nothing is decoded: the pixel budget (width * height * frames) is
+    checked against COMMENTS_IMAGE_MAX_PIXELS before anything else touches
+    the pixels, and still images have their structure verified. Raises
+    ImageRejected for unreadable or oversized images.
+    """
+    try:
+        image = Image.open(file)
+        info = {
+            "format": image.format,
+            "width": image.width,
+            "height": image.height,
+            "frames": getattr(image, "n_frames", 1),
+        }
+        if info["width"] * info["height"] * info["frames"] > max_pixels():
+            raise ImageRejected(f"Image exceeds the {max_pixels()} pixel limit")
+        if info["frames"] == 1:
+            image.verify()
+    except ImageRejected:
+        raise
+    except Exception as e:
+        raise ImageRejected("Invalid image file") from e
+    finally:
+        file.seek(0)
+    return info
+
+
+def pending_renditions(width, height):
+    """Renditions an image of this size needs; empty if it is already small"""
+    return {
+        name: size
+        for name, size in RENDITIONS.items()
+        if width > size[0] or height > size[1]
+    }
+
+
+def rendition_name(original_name, size, extension):
+    stem = os.path.splitext(os.path.basename(original_name))[0]
+    return f"{RENDITIONS_DIR}/{stem}_{size[0]}x{size[1]}.{extension}"
+
+
+def _shrink(image, sizes):
+    """Thumbnail ``image`` to every size, largest first.
+
+    The first thumbnail replaces the full-size pixels in place and each
+    smaller one is derived from the previous, so only one full-size buffer
+    is ever alive.
+    """
+    thumbs = {}
+    for size in sorted(sizes, reverse=True):
+        if thumbs:
+            image = image.copy()
+        image.thumbnail(size, reducing_gap=None)
+        thumbs[size] = image
+    return thumbs
+
+
+def _encode_animated(image, sizes):
+    """Thumbnail every frame for all ``sizes`` in a single decoding pass"""
+    frames = {size: [] for size in sizes}
+    durations = []
+    for frame in ImageSequence.Iterator(image):
+        durations.append(frame.info.get("duration", image.info.get("duration", 100)))
+        frame = frame.convert("RGBA" if "transparency" in frame.info else "RGB")
+        for size, thumb in _shrink(frame, sizes).items():
+            # Keep frames palettised: a quarter of the memory of RGBA and
+            # nothing left for the GIF encoder to quantise.
+            frames[size].append(thumb.quantize(method=Image.Quantize.FASTOCTREE))
+    encoded = {}
+    for size, thumbs in frames.items():
+        buffer = BytesIO()
+        thumbs[0].save(
+            buffer,
+            format="GIF",
+            save_all=True,
+            append_images=thumbs[1:],
+            duration=durations,
+            loop=image.info.get("loop", 0),
+            disposal=2,
+        )
+        encoded[size] = (buffer.getvalue(), thumbs[0].size)
+    return encoded
+
+
+def _encode_still(image, sizes, image_format):
+    encoded = {}
+    for size, thumb in _shrink(image, sizes).items():
+        if image_format == "JPEG" and thumb.mode not in ("RGB", "L"):
+            thumb = thumb.convert("RGB")
+        buffer = BytesIO()
+        thumb.save(buffer, format=image_format)
+        encoded[size] = (buffer.getvalue(), thumb.size)
+    return encoded
+
+
+def build_renditions(file, original_name, storage):
+    """Write thumbnail renditions of an uploaded image to ``storage``.
+
+    Returns ``{rendition: {"name", "width", "height"}}`` for every rendition
+    smaller than the original. JPEGs are decoded at reduced scale via
+    ``Image.draft`` so memory is bounded by the largest rendition rather
+    than by the upload. Animated GIFs keep all their frames.
+    """
+    image = Image.open(file)
+    image_format = image.format or "PNG"
+    pending = pending_renditions(image.width, image.height)
+    if not pending:
+        return {}
+
+    sizes = set(pending.values())
+    if getattr(image, "is_animated", False):
+        extension = "gif"
+        encoded = _encode_animated(image, sizes)
+    else:
+        extension = image_format.lower().replace("jpeg", "jpg")
+        if image_format == "JPEG":
+            image.draft(None, max(sizes))
+        encoded = _encode_still(image, sizes, image_format)
+
+    renditions = {}
+    for name, size in pending.items():
+        data, (width, height) = encoded[size]
+        saved_name = storage.save(
+            rendition_name(original_name, size, extension), ContentFile(data)
+        )
+        renditions[name] = {"name": saved_name, "width": width, "height": height}
+    return renditions
@@ -0,0 +1,161 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from billiard.process import current_process
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from django.conf import settings
+from django.db import connections
+
+from .metrics import counter, histogram, start_http_server
+
+# Everything recorded per request or task is a few additions and one
+# perf_counter() per SQL query, cache lookup or serialization, so it stays
+# on in production. Metrics are process-local: web processes serve them at
+# /metrics/ and on COMMENTS_METRICS_WEB_PORT, Celery worker processes on
+# COMMENTS_METRICS_WORKER_PORT.
+# Web workers look for a free metrics port among this many.
+WEB_METRICS_PORTS = 64
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+request_seconds = histogram(
+    "http_request_duration_seconds", "Time to respond, by view, method and status"
+)
+request_queries = histogram(
+    "http_request_db_queries", "SQL queries per request, by view", QUERY_BUCKETS
+)
+request_db_seconds = histogram(
+    "http_request_db_seconds", "Time spent in SQL per request, by view"
+)
+request_serialize_seconds = histogram(
+    "http_request_serialize_seconds",
+    "Time spent serializing comments per request, by view",
+)
+cache_lookups = counter(
+    "comments_cache_lookups_total", "Comment cache lookups by key family and result"
+)
+task_seconds = histogram(
+    "celery_task_duration_seconds", "Time to run a Celery task, by task and state"
+)
+task_queries = histogram(
+    "celery_task_db_queries", "SQL queries per Celery task run", QUERY_BUCKETS
+)
+
+_current = ContextVar("comments_instrumentation", default=None)
+_tasks = {}
+
+
+class Collector:
+    """Tallies for one request or task run.
+
+    While started it is the current collector of its context and an
+    execute_wrapper of every database connection.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.cache = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._token = _current.set(self)
+        self._connections = connections.all()
+        for connection in self._connections:
+            connection.execute_wrappers.append(self)
+        return self
+
+    def stop(self):
+        for connection in self._connections:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        _current.reset(self._token)
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def server_timing(self):
+        """Server-Timing header value"""
+        metrics = [
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+        ]
+        if self.serialize_seconds:
+            metrics.append(f"serialize;dur={self.serialize_seconds * 1000:.1f}")
+        for family, results in self.cache.items():
+            desc = ", ".join(f"{count} {result}" for result, count in results.items())
+            metrics.append(f'cache-{family};desc="{desc}"')
+        metrics.append(f"total;dur={self.seconds * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def record_cache(family, result, count=1):
+    """Count ``count`` lookups in the cache key ``family`` ("page",
+    "fragment", ...) with ``result`` "hit", "stale", "waited" or "miss"."""
+    if not count:
+        return
+    cache_lookups.inc(count, family=family, result=result)
+    collector = _current.get()
+    if collector is not None:
+        results = collector.cache.setdefault(family, {})
+        results[result] = results.get(result, 0) + count
+
+
+@contextmanager
+def timed_serialization():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        collector = _current.get()
+        if collector is not None:
+            collector.serialize_seconds += time.perf_counter() - started
+
+
+def observe_request(collector, view, method, status):
+    labels = {"view": view}
+    request_seconds.observe(
+        collector.seconds, method=method, status=f"{status // 100}xx", **labels
+    )
+    request_queries.observe(collector.queries, **labels)
+    request_db_seconds.observe(collector.db_seconds, **labels)
+    request_serialize_seconds.observe(collector.serialize_seconds, **labels)
+
+
+@task_prerun.connect
+def start_task(task_id=None, **kwargs):
+    _tasks[task_id] = Collector().start()
+
+
+@task_postrun.connect
+def finish_task(task_id=None, task=None, state=None, **kwargs):
+    collector = _tasks.pop(task_id, None)
+    if collector is None:
+        return
+    collector.stop()
+    task_seconds.observe(collector.seconds, task=task.name, state=state or "")
+    task_queries.observe(collector.queries, task=task.name)
+
+
+@worker_process_init.connect
+def serve_worker_metrics(**kwargs):
+    port = getattr(settings, "COMMENTS_METRICS_WORKER_PORT", None)
+    if port:
+        # One port per pool process, counting up from the setting.
+        start_http_server(port + getattr(current_process(), "index", 0))
+
+
+def serve_web_metrics():
+    """Serve this web process's metrics from the first free port counting up
+    from COMMENTS_METRICS_WEB_PORT. uvicorn workers share the HTTP port, so
+    /metrics/ only answers for whichever worker accepts the connection."""
+    port = getattr(settings, "COMMENTS_METRICS_WEB_PORT", 0)
+    if port:
+        start_http_server(port, attempts=WEB_METRICS_PORTS)
@@ -0,0 +1,53 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from comments.markup import render_markup
+
+# Inputs that make naive tag/attribute regexes backtrack, as functions of n
+ADVERSARIAL = {
+    "nested_tags": lambda n: "<i><strong>" * n + "x" + "</strong></i>" * n,
+    "many_links": lambda n: '<a href="https://example.com/p?q=1">l</a> ' * n,
+    "unclosed_quotes": lambda n: '<a href="' * n,
+    "lone_brackets": lambda n: "<" * n + ">" * n,
+    "attribute_spaces": lambda n: "<a" + " " * n + "x>",
+    "stray_closing_tags": lambda n: "</i>" * n,
+    "plain_text": lambda n: "word &amp; more " * n,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time render_markup on adversarial inputs of growing size; time per "
+        "KB stays flat when the pass is linear."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="*", default=[100, 1000, 10000, 50000]
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        results = {}
+        for name, build in ADVERSARIAL.items():
+            results[name] = []
+            for n in options["sizes"]:
+                text = build(n)
+                timings = []
+                for _ in range(options["repeat"]):
+                    started = time.perf_counter()
+                    render_markup(text)
+                    timings.append(time.perf_counter() - started)
+                best = min(timings)
+                results[name].append(
+                    {
+                        "chars": len(text),
+                        "ms": best * 1000,
+                        "us_per_kb": best * 1e6 / (len(text) / 1024),
+                    }
+                )
+        self.stdout.write(
+            json.dumps({"benchmark": "markup", "results": results}, indent=2)
+        )
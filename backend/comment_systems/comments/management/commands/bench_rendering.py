@@ -0,0 +1,67 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+
+from comments.middleware import BROTLI_QUALITY, brotli
+from comments.renderers import FastJSONRenderer
+from comments.views import CommentAPIView
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure JSON render time of a list page with DRF's JSONRenderer "
+        "and FastJSONRenderer, its size uncompressed, gzipped and with "
+        "brotli, and the time of a full response versus a 304."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--per-page", type=int, nargs="*", default=[25, 100])
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        results = [
+            self.run(per_page, options["repeat"]) for per_page in options["per_page"]
+        ]
+        self.stdout.write(
+            json.dumps({"benchmark": "rendering", "results": results}, indent=2)
+        )
+
+    def run(self, per_page, repeat):
+        view = CommentAPIView.as_view()
+        factory = RequestFactory()
+        response = view(factory.get("/api/comments/", {"per_page": per_page}))
+        data = response.data
+        etag = response["ETag"]
+
+        result = {"per_page": per_page, "render_ms": {}}
+        for renderer in (JSONRenderer(), FastJSONRenderer()):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                body = renderer.render(data)
+            elapsed = time.perf_counter() - started
+            result["render_ms"][type(renderer).__name__] = elapsed / repeat * 1000
+
+        result["bytes"] = {
+            "identity": len(body),
+            "gzip": len(compress_string(body)),
+            "br": (
+                len(brotli.compress(body, quality=BROTLI_QUALITY)) if brotli else None
+            ),
+        }
+
+        result["response_ms"] = {}
+        for name, headers in (("full", {}), ("not_modified", {"If-None-Match": etag})):
+            request = factory.get(
+                "/api/comments/", {"per_page": per_page}, headers=headers
+            )
+            started = time.perf_counter()
+            for _ in range(repeat):
+                response = view(request)
+                response.render()
+            elapsed = time.perf_counter() - started
+            result["response_ms"][name] = elapsed / repeat * 1000
+        return result
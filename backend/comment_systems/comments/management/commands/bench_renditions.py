@@ -0,0 +1,109 @@
+import json
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+from PIL import Image
+
+from comments.models import Comment
+from comments.tasks import render_batch, reset_pool
+from user.models import User
+
+
+class Rollback(Exception):
+    pass
+
+
+def make_upload(size, seed):
+    buffer = BytesIO()
+    Image.effect_noise(size, 32 + seed % 64).convert("RGB").save(
+        buffer, format="JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure rendition throughput in images/sec: one task per image "
+        "versus batches through process pools of several sizes. Rows are "
+        "created in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=48)
+        parser.add_argument("--width", type=int, default=3000)
+        parser.add_argument("--height", type=int, default=2000)
+        parser.add_argument("--batch-size", type=int, default=16)
+        parser.add_argument("--workers", type=int, nargs="*", default=[1, 2, 4])
+
+    def handle(self, *args, **options):
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                results = self.run(options)
+        finally:
+            shutil.rmtree(media_root)
+        self.stdout.write(json.dumps({"benchmark": "renditions", **results}, indent=2))
+
+    def run(self, options):
+        results = []
+        try:
+            with transaction.atomic():
+                comments = self.create_comments(options)
+                items = [{"id": comment.id, "info": None} for comment in comments]
+
+                # The previous behaviour: one task, one query, one image.
+                with override_settings(COMMENTS_RENDITION_WORKERS=0):
+                    results.append(
+                        self.measure("per_image", 0, [[item] for item in items])
+                    )
+
+                size = options["batch_size"]
+                chunks = [items[i : i + size] for i in range(0, len(items), size)]
+                for workers in options["workers"]:
+                    with override_settings(COMMENTS_RENDITION_WORKERS=workers):
+                        results.append(self.measure("batch", workers, chunks))
+                    reset_pool()
+                raise Rollback
+        except Rollback:
+            pass
+        return {
+            "images": options["images"],
+            "image_size": [options["width"], options["height"]],
+            "batch_size": options["batch_size"],
+            "results": results,
+        }
+
+    def create_comments(self, options):
+        user = User.objects.create_user(
+            username="bench_renditions", email="bench@example.com", password="x"
+        )
+        comments = []
+        for i in range(options["images"]):
+            comment = Comment(text="bench", sender=user)
+            comment.attachment.save(
+                f"bench_{i}.jpg",
+                ContentFile(make_upload((options["width"], options["height"]), i)),
+                save=False,
+            )
+            comment.save()
+            comments.append(comment)
+        return comments
+
+    def measure(self, mode, workers, chunks):
+        Comment.objects.update(renditions={})
+        started = time.perf_counter()
+        rendered = sum(render_batch(chunk) for chunk in chunks)
+        elapsed = time.perf_counter() - started
+        return {
+            "mode": mode,
+            "workers": workers,
+            "rendered": rendered,
+            "seconds": elapsed,
+            "images_per_second": rendered / elapsed,
+        }
@@ -0,0 +1,100 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from comments.management.commands.bench_ws_fanout import percentile
+from comments.models import Comment
+from comments.search import get_search_backend
+from comments.views import CommentSearchAPIView
+from user.models import User
+
+VOCABULARY = (
+    "django mysql redis cache index query search comment thread reply "
+    "latency benchmark python server worker queue image upload thumbnail "
+    "websocket channel cursor page serializer render template database "
+    "migration transaction backend frontend vue component socket event"
+).split()
+
+
+def random_text(rng):
+    return " ".join(rng.choices(VOCABULARY, k=rng.randint(5, 40)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure search endpoint latency. --seed adds rows of random text "
+        "(committed, so a FULLTEXT index sees them) before measuring."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--per-page", type=int, default=25)
+        parser.add_argument(
+            "--backend",
+            default=None,
+            help="Search backend class path, defaults to COMMENTS_SEARCH_BACKEND",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        if options["seed"]:
+            self.seed(options["seed"], rng)
+
+        overrides = {}
+        if options["backend"]:
+            overrides["COMMENTS_SEARCH_BACKEND"] = options["backend"]
+        with override_settings(**overrides):
+            result = self.run(options, rng)
+        self.stdout.write(json.dumps(result, indent=2))
+
+    def seed(self, rows, rng, batch_size=5000):
+        user, _ = User.objects.get_or_create(
+            username="bench_search", defaults={"email": "bench@example.com"}
+        )
+        for start in range(0, rows, batch_size):
+            Comment.objects.bulk_create(
+                Comment(text=random_text(rng), sender=user)
+                for _ in range(min(batch_size, rows - start))
+            )
+
+    def run(self, options, rng):
+        view = CommentSearchAPIView.as_view()
+        factory = RequestFactory()
+        backend = get_search_backend()
+
+        # Warm up: the local backend builds its index on first use.
+        started = time.perf_counter()
+        view(factory.get("/api/comments/search/", {"q": VOCABULARY[0]}))
+        warmup = time.perf_counter() - started
+
+        latencies = []
+        for _ in range(options["queries"]):
+            terms = rng.sample(VOCABULARY, rng.choice((1, 1, 2, 3)))
+            query = " ".join(term[: rng.randint(3, len(term))] for term in terms)
+            request = factory.get(
+                "/api/comments/search/",
+                {"q": query, "per_page": options["per_page"]},
+            )
+            started = time.perf_counter()
+            response = view(request)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.data
+
+        return {
+            "benchmark": "search",
+            "backend": type(backend).__name__,
+            "rows": Comment.objects.count(),
+            "queries": options["queries"],
+            "warmup_ms": warmup * 1000,
+            "latency_ms": {
+                "p50": percentile(latencies, 50) * 1000,
+                "p95": percentile(latencies, 95) * 1000,
+                "max": max(latencies) * 1000,
+                "mean": statistics.mean(latencies) * 1000,
+            },
+        }
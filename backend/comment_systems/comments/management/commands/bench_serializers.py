@@ -0,0 +1,101 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from comments.models import Comment
+from comments.serializers import (
+    COMMENT_VALUES,
+    CommentSerializer,
+    serialize_comment_values,
+)
+from user.models import User
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rows/sec of CommentSerializer and the .values() fast path "
+        "used by the list endpoint, with and without the query. Missing rows "
+        "are created in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.ensure_rows(options["rows"])
+                result = self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+        self.stdout.write(json.dumps({"benchmark": "serializers", **result}, indent=2))
+
+    def ensure_rows(self, rows):
+        missing = rows - Comment.objects.count()
+        if missing <= 0:
+            return
+        user = User.objects.create_user(
+            username="bench_serializers", email="bench@example.com", password="x"
+        )
+        Comment.objects.bulk_create(
+            Comment(
+                text=f"bench comment {i}",
+                sender=user,
+                sender_username=user.username,
+                sender_email=user.email,
+                renditions={"thumb": {"name": f"attachments/{i}_thumb.jpg"}},
+            )
+            for i in range(missing)
+        )
+
+    def run(self, options):
+        ids = list(
+            Comment.objects.order_by("-id").values_list("id", flat=True)[
+                : options["rows"]
+            ]
+        )
+        paths = {
+            "serializer": lambda: CommentSerializer(
+                Comment.objects.for_list().filter(id__in=ids), many=True
+            ).data,
+            "values": lambda: serialize_comment_values(
+                Comment.objects.filter(id__in=ids).values(*COMMENT_VALUES)
+            ),
+        }
+        instances = list(Comment.objects.for_list().filter(id__in=ids))
+        rows = list(Comment.objects.filter(id__in=ids).values(*COMMENT_VALUES))
+        serialize_only = {
+            "serializer": lambda: CommentSerializer(instances, many=True).data,
+            "values": lambda: serialize_comment_values(rows),
+        }
+
+        results = {}
+        for name in paths:
+            results[name] = {
+                "with_query_rows_per_second": self.measure(
+                    paths[name], len(ids), options
+                ),
+                "serialize_rows_per_second": self.measure(
+                    serialize_only[name], len(ids), options
+                ),
+            }
+        results["speedup"] = {
+            key: results["values"][key] / results["serializer"][key]
+            for key in results["values"]
+        }
+        return {"rows": len(ids), "repeat": options["repeat"], "results": results}
+
+    def measure(self, serialize, rows, options):
+        serialize()  # warm up
+        started = time.perf_counter()
+        for _ in range(options["repeat"]):
+            serialize()
+        return rows * options["repeat"] / (time.perf_counter() - started)
@@ -0,0 +1,164 @@
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from comments.management.commands.bench_ws_fanout import percentile
+
+DEFAULT_PATHS = [
+    "/api/comments/",
+    "/api/comments/?page=2&per_page=50",
+    "/api/comments/?pagination=cursor&ordering=username",
+]
+
+
+def parse_env(pairs):
+    return dict(pair.split("=", 1) for pair in pairs)
+
+
+class Command(BaseCommand):
+    help = (
+        "Requests per second and latency of manage.py runserver and manage.py "
+        "serve: starts each as a subprocess of this command's settings (plus "
+        "--runserver-env/--serve-env) and runs --concurrency keep-alive "
+        "clients against the list API. The clients share the machine with "
+        "the server, so compare modes rather than read absolute numbers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--modes", nargs="*", choices=["runserver", "serve"], default=None
+        )
+        parser.add_argument("--paths", nargs="*", default=DEFAULT_PATHS)
+        parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 8, 32])
+        parser.add_argument("--duration", type=float, default=10.0)
+        parser.add_argument("--warmup", type=float, default=2.0)
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--threads", type=int, default=None)
+        parser.add_argument("--runserver-env", nargs="*", default=[])
+        parser.add_argument(
+            "--serve-env",
+            nargs="*",
+            default=[],
+            help="e.g. DJANGO_SETTINGS_MODULE=comment_systems.production_settings",
+        )
+
+    def handle(self, *args, **options):
+        results = []
+        for mode in options["modes"] or ["runserver", "serve"]:
+            server = self.start(mode, options)
+            try:
+                self.wait_until_up(options["port"], options["paths"][0])
+                self.load(options["port"], options["paths"], 4, options["warmup"])
+                for concurrency in options["concurrency"]:
+                    results.append(
+                        {
+                            "mode": mode,
+                            "concurrency": concurrency,
+                            **self.load(
+                                options["port"],
+                                options["paths"],
+                                concurrency,
+                                options["duration"],
+                            ),
+                        }
+                    )
+            finally:
+                server.send_signal(signal.SIGINT)
+                try:
+                    server.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+        self.stdout.write(
+            json.dumps({"benchmark": "serving", "results": results}, indent=2)
+        )
+
+    def start(self, mode, options):
+        command = [sys.executable, "manage.py", mode]
+        if mode == "runserver":
+            command += ["--noreload", f"127.0.0.1:{options['port']}"]
+            env = parse_env(options["runserver_env"])
+        else:
+            command += ["--host", "127.0.0.1", "--port", str(options["port"])]
+            command += ["--log-level", "warning"]
+            if options["workers"]:
+                command += ["--workers", str(options["workers"])]
+            if options["threads"]:
+                command += ["--threads", str(options["threads"])]
+            env = parse_env(options["serve_env"])
+        return subprocess.Popen(
+            command,
+            env={**os.environ, **env},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def wait_until_up(self, port, path, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                connection.request("GET", path)
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise CommandError(f"Server on port {port} did not answer {path}")
+
+    def load(self, port, paths, concurrency, duration):
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        deadline = time.monotonic() + duration
+
+        def client(offset):
+            nonlocal errors
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            mine = []
+            failed = 0
+            i = offset
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    connection.request("GET", paths[i % len(paths)])
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status != 200:
+                        failed += 1
+                except (OSError, http.client.HTTPException):
+                    failed += 1
+                    connection.close()
+                    connection = http.client.HTTPConnection(
+                        "127.0.0.1", port, timeout=30
+                    )
+                mine.append(time.perf_counter() - started)
+                i += 1
+            connection.close()
+            with lock:
+                latencies.extend(mine)
+                errors += failed
+
+        started = time.perf_counter()
+        clients = [
+            threading.Thread(target=client, args=(n,)) for n in range(concurrency)
+        ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "requests_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+        }
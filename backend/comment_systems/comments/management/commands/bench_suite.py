@@ -0,0 +1,294 @@
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from comments.cache import bump_content_version
+from comments.management.commands import bench_renditions, bench_ws_fanout
+from comments.management.commands.bench_ws_fanout import percentile
+from comments.models import Comment
+from comments.transfer import Importer, keep_created_at
+from user.models import User
+
+BENCHMARKS = ("list", "post", "renditions", "ws")
+SEED_USERNAME = "bench_suite"
+
+
+def summarize(latencies):
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def flatten(results, prefix=""):
+    """``{"a": {"b": 1}}`` -> ``{"a.b": 1}``, numbers only"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(current, baseline, tolerance):
+    """Metrics that got worse than ``baseline`` by more than ``tolerance``.
+
+    Metrics ending in ``_ms`` should go down, ``_per_second`` up; others
+    (row counts, sizes) are not compared.
+    """
+    rows = []
+    current = flatten(current)
+    for name, before in flatten(baseline).items():
+        after = current.get(name)
+        if after is None or not before:
+            continue
+        if name.endswith("_ms"):
+            change = after / before - 1
+        elif name.endswith("_per_second"):
+            change = before / after - 1 if after else float("inf")
+        else:
+            continue
+        rows.append(
+            {
+                "metric": name,
+                "baseline": before,
+                "current": after,
+                "slower_by": change,
+                "regression": change > tolerance,
+            }
+        )
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed comments and measure list-page latency by page depth and "
+        "per_page, post throughput, rendition throughput and websocket "
+        "fan-out latency. Prints JSON; --baseline compares against an "
+        "earlier run and fails on regressions. See "
+        "comment_systems/bench_settings.py for running it locally."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--comments",
+            type=int,
+            default=10000,
+            help="Seed comments until the table holds this many",
+        )
+        parser.add_argument(
+            "--replies", type=int, default=3, help="Seeded replies per thread"
+        )
+        parser.add_argument(
+            "--only", nargs="*", choices=BENCHMARKS, default=list(BENCHMARKS)
+        )
+        parser.add_argument("--pages", type=int, nargs="*", default=[1, 10, 100])
+        parser.add_argument("--per-page", type=int, nargs="*", default=[25, 100])
+        parser.add_argument("--requests", type=int, default=50)
+        parser.add_argument("--posts", type=int, default=100)
+        parser.add_argument("--images", type=int, default=16)
+        parser.add_argument("--ws-clients", type=int, default=500)
+        parser.add_argument("--ws-events", type=int, default=10)
+        parser.add_argument("--output", help="Also write the JSON result here")
+        parser.add_argument("--baseline", help="JSON result of an earlier run")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed slowdown against the baseline, as a fraction",
+        )
+
+    def handle(self, *args, **options):
+        seeded = self.seed(options["comments"], options["replies"])
+        results = {}
+        for name in options["only"]:
+            started = time.perf_counter()
+            results[name] = getattr(self, f"bench_{name}")(options)
+            self.stderr.write(f"{name}: {time.perf_counter() - started:.1f}s")
+
+        report = {
+            "benchmark": "suite",
+            "environment": {
+                "database": connection.vendor,
+                "cache": settings.CACHES["default"]["BACKEND"],
+                "python": platform.python_version(),
+                "comments": Comment.objects.count(),
+                "seeded": seeded,
+            },
+            "results": results,
+        }
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                baseline = json.load(file)["results"]
+            report["comparison"] = compare(results, baseline, options["tolerance"])
+
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output)
+
+        regressions = [
+            row["metric"] for row in report.get("comparison", ()) if row["regression"]
+        ]
+        if regressions:
+            raise CommandError(f"Regressed beyond tolerance: {', '.join(regressions)}")
+
+    def seed(self, target, replies, batch_size=1000):
+        """Top up the table to ``target`` comments in threads of a root and
+        ``replies`` replies; returns how many were added"""
+        missing = target - Comment.objects.count()
+        if missing <= 0:
+            return 0
+        User.objects.get_or_create(
+            username=SEED_USERNAME, defaults={"email": "bench_suite@example.com"}
+        )
+        sender = {"username": SEED_USERNAME}
+        next_id = (Comment.objects.aggregate(last=Max("id"))["last"] or 0) + 1
+        started = timezone.now() - timedelta(seconds=missing)
+
+        importer = Importer(batch_size)
+        records = []
+        with keep_created_at():
+            for offset in range(missing):
+                comment_id = next_id + offset
+                in_thread = offset % (replies + 1)
+                records.append(
+                    {
+                        "id": comment_id,
+                        "parent": comment_id - 1 if in_thread else None,
+                        "text": f"Seeded <strong>comment</strong> {comment_id}",
+                        "created_at": (started + timedelta(seconds=offset)).isoformat(),
+                        "sender": sender,
+                        "attachment": None,
+                    }
+                )
+                if len(records) == batch_size:
+                    importer.import_chunk(records)
+                    records = []
+            if records:
+                importer.import_chunk(records)
+        importer.finish()
+        return importer.imported
+
+    def bench_list(self, options):
+        client = APIClient()
+        results = {}
+        for pagination in ("offset", "cursor"):
+            for per_page in options["per_page"]:
+                for page in options["pages"]:
+                    params = self.list_params(client, pagination, page, per_page)
+                    if params is None:
+                        continue
+                    key = f"{pagination}.per_page_{per_page}.page_{page}"
+                    results[key] = self.measure_page(client, params, options)
+        return results
+
+    def list_params(self, client, pagination, page, per_page):
+        """Query string of the ``page``-th page; cursor pages are reached by
+        following ``next`` links"""
+        if pagination == "offset":
+            if (page - 1) * per_page >= Comment.objects.count():
+                return None
+            return {"page": page, "per_page": per_page}
+        params = {"pagination": "cursor", "per_page": per_page}
+        for _ in range(page - 1):
+            cursor = client.get("/api/comments/", params).json()["meta"]["next"]
+            if cursor is None:
+                return None
+            params = {"cursor": cursor, "per_page": per_page}
+        return params
+
+    def measure_page(self, client, params, options):
+        result = {}
+        # hit: served from the page cache; miss: the page is rebuilt from
+        # cached fragments; cold: nothing cached at all.
+        for mode in ("hit", "miss", "cold"):
+            latencies = []
+            for _ in range(options["requests"]):
+                if mode == "miss":
+                    bump_content_version()
+                elif mode == "cold":
+                    cache.clear()
+                started = time.perf_counter()
+                response = client.get("/api/comments/", params)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.content
+            result[mode] = summarize(latencies)
+        return result
+
+    def bench_post(self, options):
+        user, _ = User.objects.get_or_create(
+            username=SEED_USERNAME, defaults={"email": "bench_suite@example.com"}
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        parent = Comment.objects.order_by("-id").values_list("id", flat=True).first()
+        created = []
+        latencies = []
+        with override_settings(CAPTCHA_VERIFIER="comments.captcha.StubCaptchaVerifier"):
+            for i in range(options["posts"]):
+                data = {"text": f"Posted <i>comment</i> {i}", "captcha": "bench"}
+                if i % 2 and parent:
+                    data["parent_comment"] = parent
+                started = time.perf_counter()
+                response = client.post("/api/comments/", data)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 201, response.content
+                created.append(response.json()["comment_id"])
+        # Keep the table at the seeded size for the next run.
+        for comment in Comment.objects.filter(id__in=created).order_by("-depth"):
+            comment.delete()
+        return {
+            "posts": options["posts"],
+            "posts_per_second": len(latencies) / sum(latencies),
+            **summarize(latencies),
+        }
+
+    def bench_renditions(self, options):
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                result = bench_renditions.Command().run(
+                    {
+                        "images": options["images"],
+                        "width": 2000,
+                        "height": 1500,
+                        "batch_size": 8,
+                        "workers": [settings.COMMENTS_RENDITION_WORKERS],
+                    }
+                )
+        finally:
+            shutil.rmtree(media_root)
+        return {
+            entry["mode"]: {"images_per_second": entry["images_per_second"]}
+            for entry in result["results"]
+        }
+
+    def bench_ws(self, options):
+        with override_settings(COMMENTS_WS_FLUSH_INTERVAL=0):
+            result = async_to_sync(bench_ws_fanout.Command().run)(
+                options["ws_clients"], options["ws_events"], 1
+            )
+        return {
+            "clients": result["clients"],
+            "p50_ms": result["latency_ms"]["p50"],
+            "p95_ms": result["latency_ms"]["p95"],
+            "mean_ms": result["latency_ms"]["mean"],
+        }
@@ -0,0 +1,127 @@
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+import django
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from comments.images import build_renditions
+
+CASES = {
+    "jpeg": ("JPEG", (6000, 4000), 1),
+    "png": ("PNG", (3000, 2000), 1),
+    "gif": ("GIF", (1000, 750), 40),
+}
+
+
+def make_image(image_format, size, frames):
+    images = [Image.effect_noise(size, 64 + i).convert("RGB") for i in range(frames)]
+    path = tempfile.NamedTemporaryFile(suffix=f".{image_format.lower()}", delete=False)
+    if frames > 1:
+        images[0].save(
+            path, format=image_format, save_all=True, append_images=images[1:]
+        )
+    else:
+        images[0].save(path, format=image_format)
+    path.close()
+    return path.name
+
+
+def legacy_resize(path, storage):
+    """The previous task: full decode, thumbnail in place, re-encode"""
+    with open(path, "rb") as file:
+        image = Image.open(file)
+        image.thumbnail((320, 240))
+        buffer = BytesIO()
+        image.save(buffer, format=image.format or "PNG")
+
+
+def pipeline_resize(path, storage):
+    with open(path, "rb") as file:
+        build_renditions(file, path, storage)
+
+
+def reset_peak_rss():
+    """Reset VmHWM (Linux only) so the peak covers just the measured call"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+MODES = {
+    "baseline": lambda path, storage: None,
+    "legacy": legacy_resize,
+    "pipeline": pipeline_resize,
+}
+
+
+def measure(mode, path, media_root, queue):
+    # Spawned children start bare; load settings and apps before measuring
+    # so the lazy import on first storage access is not counted.
+    django.setup()
+    storage = FileSystemStorage(location=media_root)
+    reset_peak_rss()
+    started = time.perf_counter()
+    MODES[mode](path, storage)
+    elapsed = time.perf_counter() - started
+    queue.put({"seconds": elapsed, "peak_rss_kb": peak_rss_kb()})
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure time and peak memory of building attachment thumbnails, "
+        "each run in a fresh process"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cases", nargs="*", default=list(CASES), choices=CASES)
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        media_root = tempfile.mkdtemp()
+        results = []
+
+        def run(mode, path):
+            queue = context.Queue()
+            process = context.Process(
+                target=measure, args=(mode, path, media_root, queue)
+            )
+            process.start()
+            result = queue.get()
+            process.join()
+            return result
+
+        try:
+            for case in options["cases"]:
+                path = make_image(*CASES[case])
+                baseline = run("baseline", path)["peak_rss_kb"]
+                for mode in ("legacy", "pipeline"):
+                    result = run(mode, path)
+                    result["peak_rss_growth_kb"] = result["peak_rss_kb"] - baseline
+                    results.append({"case": case, "mode": mode, **result})
+                os.unlink(path)
+        finally:
+            shutil.rmtree(media_root)
+        self.stdout.write(
+            json.dumps({"benchmark": "thumbnails", "results": results}, indent=2)
+        )
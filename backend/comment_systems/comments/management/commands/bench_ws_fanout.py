@@ -0,0 +1,120 @@
+import asyncio
+import json
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from comments.consumers import CommentConsumer
+
+SAMPLE_COMMENT = {
+    "id": 1,
+    "text": "Benchmark comment with <strong>some</strong> markup",
+    "created_at": "2025-01-01T00:00:00Z",
+    "parent_comment": None,
+    "is_reply": False,
+    "sender": 1,
+    "username": "bench",
+    "attachment": None,
+    "email": "bench@example.com",
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "Connect many in-process websocket clients to CommentConsumer and "
+        "measure how long a comment broadcast takes to reach all of them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=2000)
+        parser.add_argument("--events", type=int, default=20)
+        parser.add_argument(
+            "--burst",
+            type=int,
+            default=1,
+            help="Comments broadcast back to back per event",
+        )
+        parser.add_argument("--flush-interval", type=float, default=None)
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options["flush_interval"] is not None:
+            overrides["COMMENTS_WS_FLUSH_INTERVAL"] = options["flush_interval"]
+        with override_settings(**overrides):
+            result = async_to_sync(self.run)(
+                options["clients"], options["events"], options["burst"]
+            )
+        self.stdout.write(json.dumps(result, indent=2))
+
+    async def run(self, clients, events, burst):
+        channel_layer = get_channel_layer()
+        application = CommentConsumer.as_asgi()
+        communicators = [
+            WebsocketCommunicator(application, "/ws/comments/") for _ in range(clients)
+        ]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected
+
+        payload = json.dumps(SAMPLE_COMMENT, separators=(",", ":"))
+        latencies = []
+        frames = 0
+        bytes_sent = 0
+
+        async def drain(communicator, started):
+            nonlocal frames, bytes_sent
+            received = 0
+            while received < burst:
+                frame = json.loads(await communicator.receive_from(timeout=30))
+                received += len(frame.get("comments", [frame.get("comment")]))
+                frames += 1
+                bytes_sent += len(json.dumps(frame))
+            return time.perf_counter() - started
+
+        seq = 0
+        for _ in range(events):
+            started = time.perf_counter()
+            for _ in range(burst):
+                seq += 1
+                await channel_layer.group_send(
+                    "comments",
+                    {
+                        "type": "new_comment",
+                        "seq": seq,
+                        "through": seq,
+                        "comment_json": payload,
+                    },
+                )
+            latencies.extend(
+                await asyncio.gather(*(drain(c, started) for c in communicators))
+            )
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        return {
+            "benchmark": "ws_fanout",
+            "channel_layer": type(channel_layer).__name__,
+            "clients": clients,
+            "events": events,
+            "burst": burst,
+            "frames_per_event": frames / events / clients,
+            "bytes_per_client_per_event": bytes_sent / events / clients,
+            "latency_ms": {
+                "p50": percentile(latencies, 50) * 1000,
+                "p95": percentile(latencies, 95) * 1000,
+                "max": max(latencies) * 1000,
+                "mean": statistics.mean(latencies) * 1000,
+            },
+        }
@@ -0,0 +1,42 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from comments.transfer import export_comments
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream every comment to NDJSON (stdout by default), replies after "
+        "their parents; load it with import_comments"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", "-o", default="-")
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument(
+            "--inline-attachments",
+            action="store_true",
+            help="Embed attachment files base64-encoded instead of by name",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options["output"] == "-":
+            exported = self.export(sys.stdout.buffer, options)
+        else:
+            with open(options["output"], "wb") as stream:
+                exported = self.export(stream, options)
+        elapsed = time.perf_counter() - started
+        self.stderr.write(
+            f"Exported {exported} comments in {elapsed:.1f}s "
+            f"({exported / elapsed if elapsed else 0:.0f} rows/sec)"
+        )
+
+    def export(self, stream, options):
+        return export_comments(
+            stream,
+            batch_size=options["batch_size"],
+            inline_attachments=options["inline_attachments"],
+        )
@@ -0,0 +1,43 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from comments.transfer import Importer
+
+
+class Command(BaseCommand):
+    help = (
+        "Load comments from NDJSON written by export_comments (stdin with "
+        "'-'). Ids that already exist are skipped, so re-running is safe."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--create-users",
+            action="store_true",
+            help="Create senders missing here, with unusable passwords",
+        )
+
+    def handle(self, *args, **options):
+        importer = Importer(options["batch_size"], options["create_users"])
+        started = time.perf_counter()
+
+        def progress(importer):
+            elapsed = time.perf_counter() - started
+            done = importer.imported + importer.existing + importer.skipped
+            self.stderr.write(f"{done} rows, {done / elapsed:.0f} rows/sec")
+
+        if options["input"] == "-":
+            importer.run(sys.stdin.buffer, progress)
+        else:
+            with open(options["input"], "rb") as lines:
+                importer.run(lines, progress)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{importer.imported} imported, {importer.existing} already present, "
+            f"{importer.skipped} skipped in {elapsed:.1f}s "
+            f"({importer.imported / elapsed:.0f} rows/sec)"
+        )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from comments.cache import bump_content_version
+from comments.models import Comment
+from comments.tree import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute reply_count, descendant_count and last_reply_at for every "
+        "comment and fix the rows that drifted"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only report drifted rows"
+        )
+
+    def handle(self, *args, **options):
+        fixed = reconcile_counters(
+            Comment, batch_size=options["batch_size"], dry_run=options["dry_run"]
+        )
+        if fixed and not options["dry_run"]:
+            bump_content_version()
+        verb = "would be fixed" if options["dry_run"] else "fixed"
+        self.stdout.write(f"{fixed} comments {verb}")
@@ -0,0 +1,88 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve comment_systems.asgi under uvicorn with several worker "
+        "processes; use with comment_systems.production_settings.\n\n"
+        "Sizing: workers = CPUs available to the container, since each "
+        "process runs Python on one core at a time (WEB_CONCURRENCY "
+        "overrides it). threads per worker (COMMENTS_HTTP_THREADS) = "
+        "total / (total - waiting) request time, from "
+        "http_request_duration_seconds and http_request_db_seconds on "
+        "/metrics/: requests that wait on MySQL/Redis 75% of the time keep "
+        "a core busy with 4 threads. Every thread holds a database "
+        "connection, so keep workers * threads, plus the Celery pools, "
+        "below MySQL's max_connections (151 by default).\n\n"
+        "Metrics are per worker and labelled with its pid, and /metrics/ is "
+        "answered by whichever worker accepts the connection: set "
+        "COMMENTS_METRICS_WEB_PORT and scrape that port and the ones above "
+        "it, one per worker, then sum across pid."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=None,
+            help="Overrides COMMENTS_HTTP_THREADS of the production profile",
+        )
+        parser.add_argument("--log-level", default="info")
+        parser.add_argument("--access-log", action="store_true")
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn
+        except ImportError:
+            raise CommandError("manage.py serve needs uvicorn: pip install uvicorn")
+
+        workers = (
+            options["workers"]
+            or int(os.getenv("WEB_CONCURRENCY", "0"))
+            or available_cpus()
+        )
+        if options["threads"]:
+            # Read by production_settings in every worker process.
+            os.environ["COMMENTS_HTTP_THREADS"] = str(options["threads"])
+        threads = options["threads"] or getattr(settings, "COMMENTS_HTTP_THREADS", 0)
+        if threads:
+            self.stdout.write(
+                f"{workers} workers x {threads} threads: up to "
+                f"{workers * threads} database connections"
+            )
+        else:
+            self.stdout.write(
+                f"{workers} workers; COMMENTS_HTTP_THREADS is not set, so "
+                "database connections are not kept between requests"
+            )
+        metrics_port = getattr(settings, "COMMENTS_METRICS_WEB_PORT", 0)
+        if metrics_port:
+            self.stdout.write(
+                f"per-worker metrics on 127.0.0.1:{metrics_port}-"
+                f"{metrics_port + workers - 1}"
+            )
+
+        uvicorn.run(
+            "comment_systems.asgi:application",
+            host=options["host"],
+            port=options["port"],
+            workers=workers,
+            # Django's ASGI handler does not implement the lifespan protocol.
+            lifespan="off",
+            log_level=options["log_level"],
+            access_log=options["access_log"],
+            timeout_graceful_shutdown=30,
+        )
@@ -0,0 +1,137 @@
+import html
+import re
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+
+ALLOWED_TAGS = {"i", "strong", "code", "a"}
+ALLOWED_ATTRS = {"a": ("href", "title")}
+
+# Splits text into tag-like chunks ("<" up to the next ">", with no "<" in
+# between), runs of text and lone "<". No pattern below can match past the
+# chunk it is given, so a pass is linear in the length of the text.
+TOKEN_RE = re.compile(r"<[^<>]*>|[^<]+|<")
+TAG_RE = re.compile(r"<(/?)([A-Za-z][A-Za-z0-9]*)([^<>]*)>")
+ATTR_RE = re.compile(
+    r"""\s+([^\s"'<>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?"""
+)
+URL_VALIDATOR = URLValidator()
+
+
+def is_valid_url(url):
+    if not url or url.strip().lower().startswith("javascript:"):
+        return False
+    try:
+        URL_VALIDATOR(url)
+    except ValidationError:
+        return False
+    return True
+
+
+def _parse_attrs(source):
+    """``{name: value}`` of a tag's attribute string, or None if malformed"""
+    attrs = {}
+    source = source.rstrip()
+    position = 0
+    while position < len(source):
+        match = ATTR_RE.match(source, position)
+        if match is None:
+            return None
+        name, *values = match.groups()
+        value = next((value for value in values if value is not None), "")
+        attrs.setdefault(name.lower(), html.unescape(value))
+        position = match.end()
+    return attrs
+
+
+def _check_attrs(name, attrs, errors):
+    allowed = ALLOWED_ATTRS.get(name, ())
+    if not allowed:
+        if attrs:
+            errors.append(f"<{name}> tag should not have attributes")
+        return
+    for attr in attrs:
+        if attr not in allowed:
+            errors.append(f"Disallowed attribute in <{name}> tag: {attr}")
+    if name == "a":
+        href = attrs.get("href")
+        if href is None:
+            errors.append("<a> tag must have href attribute")
+        elif not is_valid_url(href):
+            errors.append(f"Invalid URL in href attribute: {href}")
+
+
+def _open_tag(name, attrs):
+    parts = [name]
+    for attr in ALLOWED_ATTRS.get(name, ()):
+        if attr in attrs:
+            parts.append(f'{attr}="{html.escape(attrs[attr])}"')
+    return f"<{' '.join(parts)}>"
+
+
+def render_markup(text):
+    """Validate comment text in one pass and return ``(html, errors)``.
+
+    ``html`` is the normalized rendering readers can insert as is: allowed
+    tags with only their allowed attributes, quoted and escaped, text
+    re-escaped, and every tag closed. Whatever produced an error (other
+    tags, bad links, stray or mis-nested closing tags) is rendered as
+    escaped text, so ``html`` is safe even when ``errors`` is not empty.
+    """
+    errors = []
+    out = []
+    stack = []
+    depth = dict.fromkeys(ALLOWED_TAGS, 0)  # open tags by name, for O(1) lookups
+    rejected = {}  # tag name -> opening tags escaped because of an error
+    for match in TOKEN_RE.finditer(text):
+        chunk = match.group()
+        tag = TAG_RE.fullmatch(chunk) if chunk[0] == "<" else None
+        if tag is None:
+            out.append(html.escape(html.unescape(chunk), quote=False))
+            continue
+
+        closing, name, attr_source = tag.groups()
+        name = name.lower()
+        if name not in ALLOWED_TAGS:
+            errors.append(f"Disallowed HTML tag: <{name}>")
+            out.append(html.escape(chunk, quote=False))
+            continue
+
+        if closing:
+            if attr_source.strip():
+                errors.append(f"</{name}> tag should not have attributes")
+            elif stack and stack[-1] == name:
+                stack.pop()
+                depth[name] -= 1
+                out.append(f"</{name}>")
+                continue
+            elif depth[name]:
+                errors.append(f"</{name}> closes <{name}> before <{stack[-1]}>")
+            elif rejected.get(name):
+                # Closes a tag that was already reported and escaped
+                rejected[name] -= 1
+            else:
+                errors.append(f"</{name}> has no matching <{name}>")
+            out.append(html.escape(chunk, quote=False))
+            continue
+
+        attrs = _parse_attrs(attr_source)
+        valid = len(errors)
+        if attrs is None:
+            errors.append(f"Malformed attributes in <{name}> tag")
+        else:
+            _check_attrs(name, attrs, errors)
+        if name == "a" and depth["a"]:
+            errors.append("<a> tags cannot be nested")
+        if len(errors) > valid:
+            rejected[name] = rejected.get(name, 0) + 1
+            out.append(html.escape(chunk, quote=False))
+            continue
+        stack.append(name)
+        depth[name] += 1
+        out.append(_open_tag(name, attrs))
+
+    for name in reversed(stack):
+        errors.append(f"Unclosed <{name}> tag")
+        out.append(f"</{name}>")
+    return "".join(out), list(dict.fromkeys(errors))
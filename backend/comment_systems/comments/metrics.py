@@ -0,0 +1,144 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    """Process-local histogram rendered in the Prometheus text format"""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {key: (list(b), s, c) for key, (b, s, c) in self._series.items()}
+        process = _process_labels()
+        for key, (bucket_counts, total, count) in sorted(series.items()):
+            key = process + key
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = _format_labels(key + (("le", repr(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(key + (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Counter:
+    """Process-local monotonically increasing counter"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            series = dict(self._series)
+        process = _process_labels()
+        for key, value in sorted(series.items()):
+            lines.append(f"{self.name}{_format_labels(process + key)} {value}")
+        return lines
+
+
+def _process_labels():
+    # Series are per process: uvicorn and Celery workers each count their
+    # own, and Prometheus sums them across this label.
+    return (("pid", str(os.getpid())),)
+
+
+def _format_labels(items):
+    if not items:
+        return ""
+    inner = ",".join(f'{name}="{value}"' for name, value in items)
+    return "{" + inner + "}"
+
+
+def _register(name, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(name, lambda: Histogram(name, documentation, buckets))
+
+
+def counter(name, documentation):
+    return _register(name, lambda: Counter(name, documentation))
+
+
+def render():
+    lines = []
+    for metric in list(_registry.values()):
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address="127.0.0.1", attempts=1):
+    """Serve render() from a daemon thread on the first free port among
+    ``attempts`` ports from ``port``, for processes without a web server of
+    their own (Celery workers) or sharing one (uvicorn workers)"""
+    for offset in range(attempts):
+        try:
+            server = ThreadingHTTPServer((address, port + offset), _MetricsHandler)
+            break
+        except OSError:
+            if offset == attempts - 1:
+                raise
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
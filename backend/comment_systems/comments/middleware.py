@@ -0,0 +1,73 @@
+import re
+
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .instrumentation import Collector, observe_request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+BROTLI_QUALITY = 5
+re_accepts_brotli = re.compile(r"\bbr\b")
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Brotli when the client accepts it and the brotli package is
+    installed, gzip otherwise. Bodies shorter than COMMENTS_COMPRESS_MIN_SIZE
+    bytes are sent as they are; streaming responses are gzipped only."""
+
+    def process_response(self, request, response):
+        min_size = getattr(
+            settings, "COMMENTS_COMPRESS_MIN_SIZE", DEFAULT_COMPRESS_MIN_SIZE
+        )
+        if not response.streaming and len(response.content) < min_size:
+            return response
+        accepts = request.META.get("HTTP_ACCEPT_ENCODING", "")
+        if (
+            brotli is None
+            or response.streaming
+            or response.has_header("Content-Encoding")
+            or not re_accepts_brotli.search(accepts)
+        ):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        compressed_content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response.headers["Content-Length"] = str(len(response.content))
+        # Weak ETag, as GZipMiddleware does (RFC 9110 Section 8.8.1)
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
+        return response
+
+
+class InstrumentationMiddleware:
+    """Records each request's duration, SQL queries and time, serialization
+    time and cache lookups as metrics, and in a Server-Timing header unless
+    COMMENTS_SERVER_TIMING is False. Goes first, so the total covers the
+    other middleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        collector = Collector().start()
+        try:
+            response = self.get_response(request)
+        finally:
+            collector.stop()
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        observe_request(collector, view, request.method, response.status_code)
+        if getattr(settings, "COMMENTS_SERVER_TIMING", True):
+            response["Server-Timing"] = collector.server_timing()
+        return response
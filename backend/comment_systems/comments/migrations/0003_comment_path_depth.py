@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:30
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# Ten-digit segments plus "/" in a 255-character path: 23 levels, root
+# included. Frozen here rather than imported from comments.models.
+MAX_DEPTH = 22
+
+
+def check_depths(Comment):
+    """Refuse to start on threads nested too deep for a path, naming the
+    comments to move before migrating again"""
+    parents = dict(
+        Comment.objects.values_list("id", "parent_comment_id").iterator(
+            chunk_size=BATCH_SIZE
+        )
+    )
+    depths = {}
+    for comment_id in parents:
+        chain = []
+        node = comment_id
+        while node is not None and node not in depths and len(chain) <= len(parents):
+            chain.append(node)
+            node = parents.get(node)
+        depth = -1 if node is None else depths.get(node, -1)
+        for node in reversed(chain):
+            depth += 1
+            depths[node] = depth
+    too_deep = sorted(i for i, depth in depths.items() if depth == MAX_DEPTH + 1)
+    if too_deep:
+        shown = ", ".join(map(str, too_deep[:50]))
+        more = f" and {len(too_deep) - 50} more" if len(too_deep) > 50 else ""
+        raise RuntimeError(
+            f"Replies cannot be nested deeper than {MAX_DEPTH} levels, but "
+            f"these comments are at level {MAX_DEPTH + 1}: ids {shown}{more}. "
+            "Point their parent_comment_id at a shallower comment (or NULL), "
+            "then migrate again."
+        )
+
+
+def backfill_paths(apps, schema_editor):
+    Comment = apps.get_model("comments", "Comment")
+    check_depths(Comment)
+
+    def segment(comment_id):
+        return f"{comment_id:010d}/"
+
+    # Roots first, then any comment whose parent already has a path, until
+    # the whole forest is filled in. Batches keep memory flat.
+    pending = Comment.objects.filter(path="")
+    roots = pending.filter(parent_comment__isnull=True).only("id")
+    while batch := list(roots[:BATCH_SIZE]):
+        for comment in batch:
+            comment.path = segment(comment.id)
+            comment.depth = 0
+        Comment.objects.bulk_update(batch, ["path", "depth"])
+
+    children = (
+        pending.filter(parent_comment__path__gt="")
+        .select_related("parent_comment")
+        .only("id", "parent_comment__path", "parent_comment__depth")
+    )
+    while batch := list(children[:BATCH_SIZE]):
+        for comment in batch:
+            comment.path = comment.parent_comment.path + segment(comment.id)
+            comment.depth = comment.parent_comment.depth + 1
+        Comment.objects.bulk_update(batch, ["path", "depth"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0002_comment_created_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="path",
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
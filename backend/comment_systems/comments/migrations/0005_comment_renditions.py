@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0004_commentevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="renditions",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
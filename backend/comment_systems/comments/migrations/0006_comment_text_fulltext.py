@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def create_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        schema_editor.execute(
+            "CREATE FULLTEXT INDEX comment_text_ft ON comments_comment (text)"
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        schema_editor.execute("DROP INDEX comment_text_ft ON comments_comment")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0005_comment_renditions"),
+    ]
+
+    operations = [
+        # Not expressible as a model index; other databases use the local
+        # search backend instead.
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:57
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 10000
+
+
+def backfill_sender_columns(apps, schema_editor):
+    Comment = apps.get_model("comments", "Comment")
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    sender = User.objects.filter(pk=OuterRef("sender_id"))
+
+    # Primary key ranges keep each UPDATE short on large tables.
+    last_id = Comment.objects.order_by("-id").values_list("id", flat=True).first()
+    for start in range(0, (last_id or 0) + 1, BATCH_SIZE):
+        Comment.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE).update(
+            sender_username=Subquery(sender.values("username")[:1]),
+            sender_email=Subquery(sender.values("email")[:1]),
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0006_comment_text_fulltext"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="sender_email",
+            field=models.EmailField(blank=True, default="", max_length=254),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="sender_username",
+            field=models.CharField(blank=True, default="", max_length=150),
+        ),
+        migrations.RunPython(backfill_sender_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["parent_comment", "created_at", "id"],
+                name="comment_root_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["sender", "created_at", "id"], name="comment_sender_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["sender_username", "created_at", "id"],
+                name="comment_username_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["sender_email", "created_at", "id"], name="comment_email_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["parent_comment", "sender_username", "created_at", "id"],
+                name="comment_root_username_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["parent_comment", "sender_email", "created_at", "id"],
+                name="comment_root_email_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+COUNTER_FIELDS = ["reply_count", "descendant_count", "last_reply_at"]
+
+
+def backfill_counters(apps, schema_editor):
+    # Frozen copy of comments.tree.reconcile_counters as of this migration.
+    # Rows come in path order, a preorder walk of every thread, so a stack
+    # of open ancestors is enough to aggregate subtrees.
+    Comment = apps.get_model("comments", "Comment")
+    rows = (
+        Comment.objects.exclude(path="")
+        .order_by("path")
+        .values_list("id", "path", "created_at")
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    stack = []
+    changed = []
+
+    def close():
+        node = stack.pop()
+        if node["replies"]:
+            changed.append(
+                Comment(
+                    id=node["id"],
+                    reply_count=node["replies"],
+                    descendant_count=node["descendants"],
+                    last_reply_at=node["last"],
+                )
+            )
+            if len(changed) >= BATCH_SIZE:
+                Comment.objects.bulk_update(changed, COUNTER_FIELDS)
+                changed.clear()
+        if stack:
+            parent = stack[-1]
+            parent["descendants"] += node["descendants"] + 1
+            latest = max(node["created_at"], node["last"] or node["created_at"])
+            if parent["last"] is None or latest > parent["last"]:
+                parent["last"] = latest
+
+    for comment_id, path, created_at in rows:
+        while stack and not path.startswith(stack[-1]["path"]):
+            close()
+        if stack:
+            stack[-1]["replies"] += 1
+        stack.append(
+            {
+                "id": comment_id,
+                "path": path,
+                "created_at": created_at,
+                "replies": 0,
+                "descendants": 0,
+                "last": None,
+            }
+        )
+    while stack:
+        close()
+    if changed:
+        Comment.objects.bulk_update(changed, COUNTER_FIELDS)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0007_comment_sender_orderings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="descendant_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="last_reply_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="reply_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
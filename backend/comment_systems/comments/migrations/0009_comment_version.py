@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0008_comment_thread_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:00
+
+from django.db import migrations, models
+from django.db.models import F
+
+from comments.markup import render_markup
+
+
+def render_existing(apps, schema_editor):
+    Comment = apps.get_model("comments", "Comment")
+    batch = []
+    for comment in Comment.objects.only("id", "text").iterator(chunk_size=2000):
+        comment.text_html = render_markup(comment.text)[0]
+        batch.append(comment)
+        if len(batch) >= 500:
+            Comment.objects.bulk_update(batch, ["text_html"])
+            batch = []
+    Comment.objects.bulk_update(batch, ["text_html"])
+    # New fragments, since the cached ones lack text_html
+    Comment.objects.update(version=F("version") + 1)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("comments", "0009_comment_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="text_html",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.RunPython(render_existing, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,109 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Max, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.core.validators import URLValidator, RegexValidator
 from django.core.validators import FileExtensionValidator
 
+from .markup import render_markup
+
+# Materialized path: the zero-padded ids of every ancestor and of the comment
+# itself, each followed by "/". A subtree is then a single prefix range scan.
+PATH_SEGMENT_WIDTH = 10
+PATH_MAX_LENGTH = 255
+MAX_DEPTH = PATH_MAX_LENGTH // (PATH_SEGMENT_WIDTH + 1) - 1
+
+
+# Reply counters of a comment, see CommentQuerySet.record_reply.
+COUNTER_FIELDS = ("reply_count", "descendant_count", "last_reply_at")
+
+
+def path_segment(comment_id):
+    return f"{comment_id:0{PATH_SEGMENT_WIDTH}d}/"
+
+
+def path_ids(path):
+    """Comment ids along a materialized path, root first"""
+    return [int(segment) for segment in path.split("/") if segment]
+
+
+class CommentQuerySet(models.QuerySet):
+    def for_list(self):
+        """Only the columns CommentSerializer reads, with the sender joined in"""
+        return self.select_related("sender").only(
+            "id",
+            "text",
+            "text_html",
+            "created_at",
+            "parent_comment_id",
+            "is_reply",
+            "depth",
+            "path",
+            "attachment",
+            "renditions",
+            "sender_username",
+            "sender_email",
+            "reply_count",
+            "descendant_count",
+            "last_reply_at",
+            "version",
+            "sender__id",
+            "sender__username",
+            "sender__email",
+        )
+
+    def record_reply(self, reply):
+        """Count a new reply on its parent and every other ancestor in one
+        UPDATE. F() keeps concurrent replies from losing increments."""
+        ancestors = path_ids(reply.path)[:-1]
+        return self.filter(id__in=ancestors).update(
+            version=F("version") + 1,
+            reply_count=Case(
+                When(id=reply.parent_comment_id, then=F("reply_count") + 1),
+                default=F("reply_count"),
+                output_field=models.PositiveIntegerField(),
+            ),
+            descendant_count=F("descendant_count") + 1,
+            last_reply_at=Greatest(
+                Coalesce("last_reply_at", Value(reply.created_at)),
+                Value(reply.created_at),
+            ),
+        )
+
+    def forget_reply(self, reply):
+        """Undo ``record_reply`` for a deleted reply and the replies deleted
+        with it, once their rows are gone. Does nothing when the parent went
+        too: the top of the deleted subtree accounts for the whole of it.
+        Ancestors whose latest reply was in the subtree get last_reply_at
+        recomputed from what is left."""
+        if not self.filter(id=reply.parent_comment_id).exists():
+            return
+        ancestors = path_ids(reply.path)[:-1]
+        self.filter(id__in=ancestors).update(
+            version=F("version") + 1,
+            reply_count=Case(
+                When(id=reply.parent_comment_id, then=F("reply_count") - 1),
+                default=F("reply_count"),
+                output_field=models.PositiveIntegerField(),
+            ),
+            descendant_count=F("descendant_count") - (reply.descendant_count + 1),
+        )
+        stale = self.filter(id__in=ancestors, last_reply_at__gte=reply.created_at)
+        for ancestor in stale.only("id", "path"):
+            latest = (
+                self.filter(path__startswith=ancestor.path)
+                .exclude(id=ancestor.id)
+                .aggregate(latest=Max("created_at"))["latest"]
+            )
+            self.filter(id=ancestor.id).update(
+                last_reply_at=latest, version=F("version") + 1
+            )
+
 
 class Comment(models.Model):
     text = models.TextField(max_length=500)
+    # Normalized, escaped rendering of text made by save(), which clients
+    # insert as is (see comments.markup.render_markup)
+    text_html = models.TextField(blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     parent_comment = models.ForeignKey(
         "self",
@@ -29,3 +128,135 @@ class Comment(models.Model):
             )
         ],
     )
+
+    # Thumbnails generated from an image attachment:
+    # {"thumb": {"name": ..., "width": ..., "height": ...}, ...}
+    renditions = models.JSONField(default=dict, blank=True)
+    path = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, db_index=True)
+    depth = models.PositiveSmallIntegerField(default=0)
+    # Copied from the sender so the list can be sorted by them from a
+    # composite index; kept in sync by comments.signals.
+    sender_username = models.CharField(max_length=150, blank=True, default="")
+    sender_email = models.EmailField(blank=True, default="")
+    # Thread activity, maintained by CommentQuerySet.record_reply and
+    # forget_reply; `manage.py reconcile_reply_counts` repairs drift.
+    reply_count = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
+    last_reply_at = models.DateTimeField(null=True, blank=True)
+    # Bumped by every write that changes how the comment is serialized; part
+    # of its fragment cache key (see comments.cache.get_fragments).
+    version = models.PositiveIntegerField(default=0)
+
+    objects = CommentQuerySet.as_manager()
+
+    class Meta:
+        # One index per ordering/filter combination the list endpoint
+        # accepts, see comments.filters.
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="comment_created_id_idx"),
+            models.Index(
+                fields=["parent_comment", "created_at", "id"],
+                name="comment_root_created_idx",
+            ),
+            models.Index(
+                fields=["sender", "created_at", "id"],
+                name="comment_sender_created_idx",
+            ),
+            models.Index(
+                fields=["sender_username", "created_at", "id"],
+                name="comment_username_idx",
+            ),
+            models.Index(
+                fields=["sender_email", "created_at", "id"],
+                name="comment_email_idx",
+            ),
+            models.Index(
+                fields=["parent_comment", "sender_username", "created_at", "id"],
+                name="comment_root_username_idx",
+            ),
+            models.Index(
+                fields=["parent_comment", "sender_email", "created_at", "id"],
+                name="comment_root_email_idx",
+            ),
+        ]
+
+    @property
+    def root_id(self):
+        if not self.path:
+            return self.id
+        return int(self.path[:PATH_SEGMENT_WIDTH])
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if adding and self.parent_comment_id:
+            self.depth = self.parent_comment.depth + 1
+        update_fields = kwargs.get("update_fields")
+        # Callers that already rendered the text (CommentSerializer) pass
+        # text_html along with it.
+        if adding:
+            render = not self.text_html
+        else:
+            render = update_fields is None or (
+                "text" in update_fields and "text_html" not in update_fields
+            )
+        if render:
+            self.text_html = render_markup(self.text)[0]
+        if adding and not self.sender_username:
+            self.sender_username = self.sender.username
+            self.sender_email = self.sender.email
+        if not adding:
+            if update_fields is None:
+                # The counters change under concurrent replies and are only
+                # ever written by record_reply and forget_reply, with F().
+                update_fields = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in COUNTER_FIELDS
+                ]
+            # Bumped by the UPDATE itself: an instance loaded before another
+            # edit must not write back, and so reuse, an older version.
+            self.version = F("version") + 1
+            kwargs["update_fields"] = {*update_fields, "version"}
+            if "text" in update_fields:
+                kwargs["update_fields"].add("text_html")
+        # The row, its path, the ancestors' counters and the outbox event
+        # written by comments.signals commit together or not at all.
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+
+    def _save_table(self, *args, **kwargs):
+        updated = super()._save_table(*args, **kwargs)
+        if updated:
+            self.refresh_from_db(fields=["version"])
+        # The path needs the new id, so it is written right after the INSERT
+        # and before save_base sends post_save: receivers see the final row.
+        if not updated and not self.path:
+            parent_path = self.parent_comment.path if self.parent_comment_id else ""
+            self.path = parent_path + path_segment(self.id)
+            Comment.objects.filter(pk=self.pk).update(path=self.path)
+            if self.parent_comment_id:
+                Comment.objects.record_reply(self)
+        return updated
+
+
+class CommentEvent(models.Model):
+    """Transactional outbox of comments waiting to be broadcast.
+
+    Rows are written in the same transaction as the comment; the id doubles
+    as the sequence number clients use to detect gaps.
+    """
+
+    comment = models.ForeignKey(
+        Comment,
+        on_delete=models.CASCADE,
+        related_name="events",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["delivered_at", "id"], name="commentevent_pending_idx"
+            ),
+        ]
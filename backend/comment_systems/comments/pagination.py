@@ -0,0 +1,99 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_FIELDS = ("created_at", "id")
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(comment, direction, fields=DEFAULT_FIELDS):
+    values = []
+    for field in fields:
+        value = getattr(comment, field)
+        values.append(value.isoformat() if isinstance(value, datetime) else value)
+    payload = {"k": values, "d": direction}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, fields=DEFAULT_FIELDS):
+    """Return ``(values, direction)``; ``values`` line up with ``fields``"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values = list(payload["k"])
+        direction = payload["d"]
+        if len(values) != len(fields):
+            raise ValueError
+        for index, field in enumerate(fields):
+            if field == "created_at":
+                values[index] = datetime.fromisoformat(values[index])
+            elif field == "id":
+                values[index] = int(values[index])
+            elif not isinstance(values[index], str):
+                raise ValueError
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if direction not in ("next", "prev"):
+        raise InvalidCursor("Invalid cursor")
+    return values, direction
+
+
+def keyset_filter(fields, values, descending):
+    """Rows strictly after ``values`` in the (fields) ordering"""
+    lookup = "lt" if descending else "gt"
+    condition = Q()
+    for index, field in enumerate(fields):
+        equal = dict(zip(fields[:index], values[:index]))
+        condition |= Q(**equal, **{f"{field}__{lookup}": values[index]})
+    return condition
+
+
+class CommentCursorPaginator:
+    """Keyset pagination over ``fields``, newest first by default.
+
+    Each page is a single index range scan on the composite index matching
+    the ordering, so the cost does not depend on how deep the page is.
+    """
+
+    def __init__(self, per_page, fields=DEFAULT_FIELDS, descending=True):
+        self.per_page = per_page
+        self.fields = fields
+        self.descending = descending
+
+    def paginate(self, queryset, cursor=None):
+        if cursor is None:
+            values, direction = None, "next"
+        else:
+            values, direction = decode_cursor(cursor, self.fields)
+
+        # "prev" pages walk the ordering backwards from the cursor.
+        descending = self.descending == (direction == "next")
+        prefix = "-" if descending else ""
+        queryset = queryset.order_by(*(prefix + field for field in self.fields))
+        if values is not None:
+            queryset = queryset.filter(keyset_filter(self.fields, values, descending))
+
+        rows = list(queryset[: self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+
+        if direction == "prev":
+            rows.reverse()
+            has_next = cursor is not None
+            has_prev = has_more
+        else:
+            has_next = has_more
+            has_prev = cursor is not None
+
+        next_cursor = prev_cursor = None
+        if rows and has_next:
+            next_cursor = encode_cursor(rows[-1], "next", self.fields)
+        if rows and has_prev:
+            prev_cursor = encode_cursor(rows[0], "prev", self.fields)
+        return rows, next_cursor, prev_cursor
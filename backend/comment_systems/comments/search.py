@@ -0,0 +1,200 @@
+import bisect
+import heapq
+import html
+import re
+import threading
+
+from django.conf import settings
+from django.db import NotSupportedError
+from django.db.models import Lookup
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Comment
+
+TAG_RE = re.compile(r"<[^>]+>")
+WORD_RE = re.compile(r"\w+")
+MAX_TERMS = 8
+
+
+def tokenize(text):
+    """Lowercased words of ``text`` with the allowed HTML tags stripped"""
+    return WORD_RE.findall(html.unescape(TAG_RE.sub(" ", text)).lower())
+
+
+def search_terms(query):
+    """Distinct words of a user query, in order; operators are dropped"""
+    return list(dict.fromkeys(tokenize(query)))[:MAX_TERMS]
+
+
+def highlight(text, terms, width=160):
+    """Plain-text snippet of ``text`` around the first match, HTML-escaped,
+    with every word starting with one of ``terms`` wrapped in <mark>."""
+    plain = " ".join(html.unescape(TAG_RE.sub(" ", text)).split())
+    pattern = re.compile(
+        r"\b(?:%s)\w*" % "|".join(re.escape(term) for term in terms), re.IGNORECASE
+    )
+    first = pattern.search(plain)
+    start = max(0, first.start() - width // 3) if first else 0
+    end = min(len(plain), start + width)
+
+    parts = ["…"] if start else []
+    position = start
+    for match in pattern.finditer(plain, start, end):
+        parts.append(html.escape(plain[position : match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        position = match.end()
+    parts.append(html.escape(plain[position:end]))
+    if end < len(plain):
+        parts.append("…")
+    return "".join(parts)
+
+
+class BaseSearchBackend:
+    """Finds comments whose text contains every term (as a word prefix).
+
+    ``search`` returns ``(ids, total)`` for one page of results ordered by
+    relevance; the view loads and serializes the rows. ``index_comment``
+    and ``remove_comment`` are called on every write for backends that keep
+    their own index.
+    """
+
+    def search(self, terms, offset, limit):
+        raise NotImplementedError
+
+    def index_comment(self, comment):
+        pass
+
+    def remove_comment(self, comment_id):
+        pass
+
+
+@Comment._meta.get_field("text").register_lookup
+class FulltextMatch(Lookup):
+    """``text__match="+word*"``: MATCH ... AGAINST in boolean mode, so the
+    FULLTEXT index drives the query"""
+
+    lookup_name = "match"
+
+    def as_mysql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return (
+            f"MATCH ({lhs}) AGAINST ({rhs} IN BOOLEAN MODE)",
+            [*lhs_params, *rhs_params],
+        )
+
+    def as_sql(self, compiler, connection):
+        raise NotSupportedError("Full-text search requires MySQL")
+
+
+class MySQLFulltextBackend(BaseSearchBackend):
+    """Uses the comment_text_ft FULLTEXT index from migration 0006"""
+
+    def search(self, terms, offset, limit):
+        against = " ".join(f"+{term}*" for term in terms)
+        queryset = Comment.objects.filter(text__match=against)
+        total = queryset.count()
+        if not total or offset >= total:
+            return [], total
+        score = RawSQL(
+            "MATCH (`comments_comment`.`text`) AGAINST (%s IN BOOLEAN MODE)",
+            (against,),
+        )
+        ids = list(
+            queryset.annotate(score=score)
+            .order_by("-score", "-id")
+            .values_list("id", flat=True)[offset : offset + limit]
+        )
+        return ids, total
+
+
+class LocalInvertedIndexBackend(BaseSearchBackend):
+    """In-process inverted index for tests and development databases.
+
+    Built from the table on first search and kept up to date by the write
+    hooks of this process only, so it is not meant for multi-process
+    deployments.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = None  # token -> {comment id: term frequency}
+        self.tokens = []  # sorted, for prefix lookups
+        self.documents = {}  # comment id -> its distinct tokens
+
+    def ensure_built(self):
+        if self.postings is not None:
+            return
+        self.postings = {}
+        rows = Comment.objects.values_list("id", "text").iterator(chunk_size=2000)
+        for comment_id, text in rows:
+            self._add(comment_id, text)
+
+    def _add(self, comment_id, text):
+        counts = {}
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                bisect.insort(self.tokens, token)
+            self.postings[token][comment_id] = count
+        self.documents[comment_id] = list(counts)
+
+    def _remove(self, comment_id):
+        for token in self.documents.pop(comment_id, ()):
+            self.postings[token].pop(comment_id, None)
+
+    def index_comment(self, comment):
+        with self.lock:
+            if self.postings is not None:
+                self._remove(comment.id)
+                self._add(comment.id, comment.text)
+
+    def remove_comment(self, comment_id):
+        with self.lock:
+            if self.postings is not None:
+                self._remove(comment_id)
+
+    def _prefix_matches(self, term):
+        matches = {}
+        index = bisect.bisect_left(self.tokens, term)
+        while index < len(self.tokens) and self.tokens[index].startswith(term):
+            for comment_id, count in self.postings[self.tokens[index]].items():
+                matches[comment_id] = matches.get(comment_id, 0) + count
+            index += 1
+        return matches
+
+    def search(self, terms, offset, limit):
+        with self.lock:
+            self.ensure_built()
+            scores = None
+            for term in terms:
+                matches = self._prefix_matches(term)
+                if scores is not None:
+                    matches = {
+                        comment_id: scores[comment_id] + count
+                        for comment_id, count in matches.items()
+                        if comment_id in scores
+                    }
+                scores = matches
+                if not scores:
+                    break
+        top = heapq.nsmallest(
+            offset + limit, scores.items(), key=lambda item: (-item[1], -item[0])
+        )
+        return [comment_id for comment_id, _ in top[offset:]], len(scores)
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """The configured backend; one shared instance per class"""
+    path = getattr(
+        settings, "COMMENTS_SEARCH_BACKEND", "comments.search.MySQLFulltextBackend"
+    )
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
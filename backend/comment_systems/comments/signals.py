@@ -1,10 +1,74 @@
-from django.db.models.signals import post_save
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from .models import Comment
-from .consumers import notify_new_comment
+from .models import Comment, CommentEvent
+from .cache import bump_content_version, bump_head_version, bump_thread_version
+from .tasks import broadcast_comment_events
+from .search import get_search_backend
+from .counts import adjust_cached_counts
 
 
 @receiver(post_save, sender=Comment)
 def comment_created(sender, instance, created, **kwargs):
+    get_search_backend().index_comment(instance)
     if created:
-        notify_new_comment(instance)
+        CommentEvent.objects.create(comment=instance)
+        is_root = instance.parent_comment_id is None
+        transaction.on_commit(partial(adjust_cached_counts, is_root, 1))
+        transaction.on_commit(bump_head_version)
+        if instance.parent_comment_id:
+            # The reply changed its ancestors' counters, all in its thread.
+            transaction.on_commit(partial(bump_thread_version, instance.root_id))
+        transaction.on_commit(broadcast_comment_events.delay, robust=True)
+    elif instance.parent_comment_id:
+        transaction.on_commit(partial(bump_thread_version, instance.root_id))
+    else:
+        transaction.on_commit(bump_content_version)
+
+
+@receiver(pre_delete, sender=Comment)
+def comment_deleting(sender, instance, origin=None, **kwargs):
+    # Rows cascaded to are loaded by the deletion itself; the instance
+    # delete() was called on may be older than its counters.
+    if origin is instance and instance.parent_comment_id:
+        instance.refresh_from_db(fields=["descendant_count"])
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, origin=None, **kwargs):
+    get_search_backend().remove_comment(instance.id)
+    is_root = instance.parent_comment_id is None
+    transaction.on_commit(partial(adjust_cached_counts, is_root, -1))
+    # post_delete is sent for every row of a cascade once all of them are
+    # gone; only the top of each deleted subtree changes what is left.
+    below_origin = (
+        isinstance(origin, Comment)
+        and origin is not instance
+        and origin.path
+        and instance.path.startswith(origin.path)
+    )
+    if instance.parent_comment_id and instance.path and not below_origin:
+        Comment.objects.forget_reply(instance)
+    transaction.on_commit(bump_content_version)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def sender_changed(sender, instance, created, update_fields=None, **kwargs):
+    """Keep the denormalized sender columns used for sorting in sync, and
+    the sender's cached comment fragments, which show username and email"""
+    if created or (update_fields and not {"username", "email"} & set(update_fields)):
+        return
+    updated = (
+        Comment.objects.filter(sender=instance)
+        .exclude(sender_username=instance.username, sender_email=instance.email)
+        .update(
+            sender_username=instance.username,
+            sender_email=instance.email,
+            version=F("version") + 1,
+        )
+    )
+    if updated:
+        transaction.on_commit(bump_content_version)
@@ -1,29 +1,179 @@
 # comments/tasks.py
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from celery import shared_task
-from PIL import Image
-from io import BytesIO
-from django.core.files.base import ContentFile
-from .models import Comment
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import F
+from django.utils import timezone
+from .models import Comment, CommentEvent
+from .cache import bump_content_version
+from .images import build_renditions, pending_renditions
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def resize_comment_attachment(comment_id):
+# Uploads waiting for renditions, as JSON {"id", "info"} items. Drained in
+# chunks by process_pending_renditions on the "images" queue.
+PENDING_RENDITIONS_KEY = "comments_pending_renditions"
+RENDITIONS_SCHEDULED_KEY = "comments_renditions_scheduled"
+
+# Worth retrying with backoff; anything else is a bad image and is logged.
+TRANSIENT_ERRORS = (DatabaseError, ConnectionError, BrokenProcessPool)
+
+RETRY_OPTIONS = {
+    "autoretry_for": TRANSIENT_ERRORS,
+    "retry_backoff": True,
+    "retry_backoff_max": 300,
+    "retry_jitter": True,
+    "max_retries": 5,
+}
+
+
+def _get_redis():
+    from .events import get_redis
+
+    return get_redis()
+
+
+def queue_renditions(comment_id, image_info=None):
+    """Queue an uploaded image for the next rendition batch.
+
+    Falls back to one resize task per image without Redis.
+    """
+    redis = _get_redis()
+    if redis is None:
+        resize_comment_attachment.delay(comment_id, image_info)
+        return
+    redis.rpush(
+        PENDING_RENDITIONS_KEY, json.dumps({"id": comment_id, "info": image_info})
+    )
+    # Uploads arriving while a batch is already scheduled just join it.
+    if cache.add(RENDITIONS_SCHEDULED_KEY, True, timeout=60):
+        process_pending_renditions.delay()
+
+
+def pop_pending_renditions(redis, count):
+    pipe = redis.pipeline()
+    pipe.lrange(PENDING_RENDITIONS_KEY, 0, count - 1)
+    pipe.ltrim(PENDING_RENDITIONS_KEY, count, -1)
+    items, _ = pipe.execute()
+    return [json.loads(item) for item in items]
+
+
+def render_attachment(job):
+    """Build renditions for ``(comment_id, attachment name)``; runs in the pool"""
+    comment_id, name = job
+    storage = Comment._meta.get_field("attachment").storage
+    try:
+        with storage.open(name, "rb") as file:
+            return comment_id, build_renditions(file, name, storage)
+    except Exception:
+        logger.exception("Failed to build renditions for comment %s", comment_id)
+        return comment_id, {}
+
+
+_pool = None
 
+
+def get_pool():
+    """Process pool shared by batches in this worker, or None to run inline"""
+    global _pool
+    workers = getattr(settings, "COMMENTS_RENDITION_WORKERS", 2)
+    if workers <= 0:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def reset_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+def render_batch(items):
+    """Build renditions for queued ``{"id", "info"}`` items; returns how many
+    comments got renditions. Images already small enough are never opened."""
+    ids = [
+        item["id"]
+        for item in items
+        if not item["info"]
+        or pending_renditions(item["info"]["width"], item["info"]["height"])
+    ]
+    comments = Comment.objects.only("id", "attachment", "renditions").in_bulk(ids)
+    jobs = [
+        (comment.id, comment.attachment.name)
+        for comment in comments.values()
+        if comment.attachment
+    ]
+    if not jobs:
+        return 0
+
+    pool = get_pool()
     try:
-        comment = Comment.objects.get(id=comment_id)
-        if not comment.attachment:
-            return
-
-        image = Image.open(comment.attachment)
-        if image.width > 320 or image.height > 240:
-            image.thumbnail((320, 240))
-            buffer = BytesIO()
-            image_format = image.format or "PNG"
-            image.save(buffer, format=image_format)
-
-            comment.attachment.save(
-                comment.attachment.name, ContentFile(buffer.getvalue()), save=True
+        mapper = pool.map if pool else map
+        results = list(mapper(render_attachment, jobs))
+    except BrokenProcessPool:
+        reset_pool()
+        raise
+
+    updated = []
+    for comment_id, renditions in results:
+        if renditions:
+            comments[comment_id].renditions = renditions
+            comments[comment_id].version = F("version") + 1
+            updated.append(comments[comment_id])
+    if updated:
+        Comment.objects.bulk_update(updated, ["renditions", "version"])
+        bump_content_version()
+    return len(updated)
+
+
+@shared_task(**RETRY_OPTIONS)
+def process_pending_renditions(chunk_size=None):
+    """Drain queued uploads in chunks through a bounded process pool"""
+    redis = _get_redis()
+    if redis is None:
+        return 0
+    # Cleared first so uploads arriving from now on schedule another run.
+    cache.delete(RENDITIONS_SCHEDULED_KEY)
+    chunk_size = chunk_size or getattr(settings, "COMMENTS_RENDITION_BATCH_SIZE", 20)
+    processed = 0
+    while True:
+        items = pop_pending_renditions(redis, chunk_size)
+        if not items:
+            return processed
+        try:
+            processed += render_batch(items)
+        except TRANSIENT_ERRORS:
+            redis.lpush(
+                PENDING_RENDITIONS_KEY, *(json.dumps(item) for item in reversed(items))
             )
-    except Exception as e:
-  
-        print(f"[resize_comment_attachment] Failed: {e}")
+            raise
+
+
+@shared_task(**RETRY_OPTIONS)
+def resize_comment_attachment(comment_id, image_info=None):
+    """Write thumbnail renditions next to the original image attachment.
+
+    ``image_info`` is the header metadata recorded at upload; images that
+    are already small enough are skipped without being opened.
+    """
+    render_batch([{"id": comment_id, "info": image_info}])
+
+
+@shared_task
+def broadcast_comment_events():
+    """Drain the comment outbox; also run periodically to retry failures"""
+    from .consumers import publish_pending_events
+
+    published = publish_pending_events()
+    retention = getattr(settings, "COMMENTS_EVENT_RETENTION", timedelta(days=1))
+    CommentEvent.objects.filter(delivered_at__lt=timezone.now() - retention).delete()
+    return published
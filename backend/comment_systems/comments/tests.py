@@ -1,3 +1,2149 @@
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from html.parser import HTMLParser
+from decimal import Decimal
+from urllib.parse import urlencode
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
+import requests
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core import checks
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.db.models.signals import post_save
+from django.http import QueryDict
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from PIL import Image
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
 
+from comment_systems.serving import FileServingApp, ThreadPoolWSGIApp
+from user.models import User
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+from . import metrics, tasks
+from .models import Comment, CommentEvent
+from .views import CommentAPIView
+from .consumers import CommentConsumer, publish_pending_events, thread_group
+from .tasks import (
+    PENDING_RENDITIONS_KEY,
+    broadcast_comment_events,
+    process_pending_renditions,
+    queue_renditions,
+    reset_pool,
+    resize_comment_attachment,
+)
+from .images import ImageRejected, build_renditions, inspect_image
+from .serializers import COMMENT_VALUES, CommentSerializer, serialize_comment_values
+from .search import MySQLFulltextBackend, highlight, search_terms
+from .events import (
+    RECENT_EVENTS_KEY,
+    delivered_through,
+    get_redis,
+    record_events,
+    replay,
+)
+from .checks import refuse_in_memory_layer
+from .captcha import RecaptchaVerifier, StubCaptchaVerifier, get_captcha_verifier
+from .filters import MAX_PER_PAGE, CommentListQuery
+from .renderers import FastJSONRenderer
+from .markup import is_valid_url, render_markup
+from .transfer import Importer, export_comments
+from .middleware import brotli
+from .cache import bump_head_version, get_or_compute, page_cache_key, page_cache_ttl
+
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentCursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="alice", email="alice@example.com", password="pass12345"
+        )
+        cls.comments = [
+            Comment.objects.create(text=f"comment {i}", sender=cls.user)
+            for i in range(7)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def get_page(self, **params):
+        params.setdefault("pagination", "cursor")
+        response = self.client.get("/api/comments/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_walks_all_comments_newest_first(self):
+        expected = [
+            c.id
+            for c in sorted(
+                self.comments, key=lambda c: (c.created_at, c.id), reverse=True
+            )
+        ]
+        seen = []
+        body = self.get_page(per_page=3)
+        while True:
+            seen.extend(item["id"] for item in body["data"])
+            if not body["meta"]["next"]:
+                break
+            body = self.get_page(per_page=3, cursor=body["meta"]["next"])
+        self.assertEqual(seen, expected)
+
+    def test_prev_cursor_returns_previous_page(self):
+        first = self.get_page(per_page=3)
+        self.assertIsNone(first["meta"]["prev"])
+        second = self.get_page(per_page=3, cursor=first["meta"]["next"])
+        back = self.get_page(per_page=3, cursor=second["meta"]["prev"])
+        self.assertEqual(back["data"], first["data"])
+        self.assertIsNone(back["meta"]["prev"])
+
+    def test_total_is_skipped_unless_requested(self):
+        self.assertIsNone(self.get_page(per_page=3)["meta"]["total"])
+        meta = self.get_page(per_page=3, with_total="1")["meta"]
+        self.assertEqual(meta["total"], 7)
+        self.assertEqual(meta["last_page"], 3)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/api/comments/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+SUPPORTED_LIST_QUERIES = [
+    {"ordering": ordering, **filters}
+    for ordering in ("created_at", "-created_at")
+    for filters in (
+        {},
+        {"root": "1"},
+        {"sender": "1"},
+        {"root": "1", "sender": "1"},
+        {"created_after": "2024-01-01", "created_before": "2025-01-01"},
+        {"root": "1", "created_after": "2024-01-01"},
+        {"sender": "1", "created_after": "2024-01-01"},
+    )
+] + [
+    {"ordering": prefix + field, **filters}
+    for prefix in ("", "-")
+    for field in ("username", "email")
+    for filters in ({}, {"root": "1"}, {"sender": "1"})
+]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentListOrderingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                username=name, email=f"{email}@example.com", password="pass12345"
+            )
+            for name, email in (("bob", "zed"), ("amy", "yan"), ("cat", "xia"))
+        ]
+        cls.comments = []
+        for i in range(9):
+            parent = cls.comments[0] if i % 3 == 2 else None
+            cls.comments.append(
+                Comment.objects.create(
+                    text=f"c{i}",
+                    sender=cls.users[i % 3],
+                    parent_comment=parent,
+                    is_reply=bool(parent),
+                )
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def ids(self, **params):
+        response = self.client.get("/api/comments/", {"per_page": 50, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return [item["id"] for item in response.json()["data"]]
+
+    def expected(self, key, reverse=False, rows=None):
+        rows = self.comments if rows is None else rows
+        return [c.id for c in sorted(rows, key=key, reverse=reverse)]
+
+    def test_orderings(self):
+        by_date = lambda c: (c.created_at, c.id)
+        self.assertEqual(self.ids(ordering="created_at"), self.expected(by_date))
+        self.assertEqual(self.ids(), self.expected(by_date, reverse=True))
+        self.assertEqual(
+            self.ids(ordering="-username"),
+            self.expected(
+                lambda c: (c.sender.username, c.created_at, c.id), reverse=True
+            ),
+        )
+        self.assertEqual(
+            self.ids(ordering="email"),
+            self.expected(lambda c: (c.sender.email, c.created_at, c.id)),
+        )
+
+    def test_filters(self):
+        roots = [c for c in self.comments if c.parent_comment_id is None]
+        self.assertEqual(
+            self.ids(root="1", ordering="created_at"),
+            self.expected(lambda c: c.id, rows=roots),
+        )
+        amy = self.users[1]
+        self.assertEqual(
+            self.ids(sender=amy.id, ordering="username"),
+            self.expected(
+                lambda c: c.id, rows=[c for c in self.comments if c.sender == amy]
+            ),
+        )
+        middle = self.comments[4].created_at
+        self.assertEqual(
+            self.ids(created_after=middle.isoformat()),
+            self.expected(
+                lambda c: c.id,
+                reverse=True,
+                rows=[c for c in self.comments if c.created_at >= middle],
+            ),
+        )
+
+    def test_cursor_pages_follow_the_ordering(self):
+        params = {"pagination": "cursor", "per_page": 2, "ordering": "-email"}
+        seen = []
+        body = self.client.get("/api/comments/", params).json()
+        while True:
+            seen.extend(item["id"] for item in body["data"])
+            if not body["meta"]["next"]:
+                break
+            body = self.client.get(
+                "/api/comments/", {**params, "cursor": body["meta"]["next"]}
+            ).json()
+        self.assertEqual(
+            seen,
+            self.expected(lambda c: (c.sender.email, c.created_at, c.id), reverse=True),
+        )
+
+    def test_invalid_parameters_are_rejected(self):
+        for params in (
+            {"ordering": "text"},
+            {"ordering": "username", "created_after": "2024-01-01"},
+            {"sender": "amy"},
+            {"created_before": "yesterday"},
+            {"ordering": "username", "pagination": "cursor", "cursor": "e30"},
+            {"per_page": "0"},
+            {"per_page": "-5"},
+            {"per_page": "ten"},
+            {"per_page": "0", "pagination": "cursor"},
+        ):
+            response = self.client.get("/api/comments/", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_per_page_is_capped(self):
+        for params in ({}, {"pagination": "cursor"}):
+            response = self.client.get("/api/comments/", {"per_page": "5000", **params})
+            self.assertEqual(response.json()["meta"]["per_page"], MAX_PER_PAGE)
+
+    def test_cache_keys_include_the_parameters(self):
+        self.assertNotEqual(self.ids(ordering="username"), self.ids(ordering="email"))
+        self.assertEqual(len(self.ids(root="1")), 6)
+
+    def test_renamed_sender_is_resorted(self):
+        bob = self.users[0]
+        bob.username = "aaron"
+        with self.captureOnCommitCallbacks(execute=True):
+            bob.save()
+        first = self.ids(ordering="username")[0]
+        self.assertEqual(Comment.objects.get(pk=first).sender_id, bob.id)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMMENTS_COUNT_MODE="cached")
+class CommentCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="jan", email="jan@example.com", password="pass12345"
+        )
+        cls.root = Comment.objects.create(text="root", sender=cls.user)
+        for i in range(3):
+            Comment.objects.create(
+                text=f"reply {i}", sender=cls.user, parent_comment=cls.root
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def meta(self, **params):
+        response = self.client.get("/api/comments/", {"per_page": 2, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()["meta"]
+
+    def test_cached_total_skips_count_after_first_request(self):
+        self.assertEqual(self.meta()["total"], 4)
+        bump_head_version()
+        with self.assertNumQueries(1):
+            meta = self.meta()
+        self.assertEqual((meta["total"], meta["total_mode"]), (4, "cached"))
+        self.assertEqual(self.meta(root="1")["total"], 1)
+
+    def test_cached_total_follows_inserts_and_deletes(self):
+        self.meta()
+        self.meta(root="1")
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(text="new", sender=self.user)
+        self.assertEqual(self.meta()["total"], 5)
+        self.assertEqual(self.meta(root="1")["total"], 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.root.delete()
+        self.assertEqual(self.meta()["total"], 1)
+        self.assertEqual(self.meta(root="1")["total"], 1)
+
+    def test_inserts_during_a_recount_are_kept(self):
+        def count_then_insert(query):
+            total = Comment.objects.count()
+            with self.captureOnCommitCallbacks(execute=True):
+                Comment.objects.create(text="new", sender=self.user)
+            return total
+
+        with mock.patch("comments.counts.exact_count", count_then_insert):
+            self.assertEqual(self.meta()["total"], 4)
+        meta = self.meta()
+        self.assertEqual((meta["total"], meta["total_mode"]), (5, "cached"))
+
+    def test_modes_fall_back_when_they_cannot_serve_a_listing(self):
+        self.assertEqual(self.meta(count="exact")["total_mode"], "exact")
+        self.assertEqual(self.meta(sender=self.user.id)["total_mode"], "exact")
+        # SQLite keeps no row estimate
+        meta = self.meta(count="approximate")
+        self.assertEqual((meta["total"], meta["total_mode"]), (4, "cached"))
+        self.assertEqual(
+            self.client.get("/api/comments/", {"count": "guess"}).status_code, 400
+        )
+
+
+class CommentListIndexTests(TransactionTestCase):
+    """Every supported ordering/filter combination is served from an index:
+    no filesort and no full table scan."""
+
+    def setUp(self):
+        users = [
+            User.objects.create_user(
+                username=f"idx{i}", email=f"idx{i}@example.com", password="x"
+            )
+            for i in range(4)
+        ]
+        Comment.objects.bulk_create(
+            Comment(
+                text="x",
+                sender=users[i % 4],
+                sender_username=users[i % 4].username,
+                sender_email=users[i % 4].email,
+            )
+            for i in range(200)
+        )
+        if connection.vendor == "mysql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE TABLE comments_comment")
+
+    def assert_uses_index(self, queryset, params):
+        if connection.vendor == "mysql":
+            plan = queryset.explain(format="json")
+            self.assertNotIn('"using_filesort": true', plan, params)
+            self.assertNotIn('"access_type": "ALL"', plan, params)
+        elif connection.vendor == "sqlite":
+            plan = queryset.explain()
+            self.assertNotIn("TEMP B-TREE", plan, params)
+            self.assertNotRegex(plan, r"SCAN comments_comment(?! USING)", params)
+        else:
+            self.skipTest(f"No plan checks for {connection.vendor}")
+
+    def test_supported_combinations_use_an_index(self):
+        for params in SUPPORTED_LIST_QUERIES:
+            query = CommentListQuery(QueryDict(urlencode(params)))
+            queryset = query.filter(Comment.objects.for_list()).order_by(
+                *query.order_by()
+            )
+            self.assert_uses_index(queryset[:25], params)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentCacheInvalidationTests(TestCase):
+    CACHE_METHODS = [
+        "get",
+        "set",
+        "add",
+        "incr",
+        "delete",
+        "get_many",
+        "set_many",
+        "delete_many",
+        "clear",
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="bob", email="bob@example.com", password="pass12345"
+        )
+        for i in range(30):
+            Comment.objects.create(text=f"comment {i}", sender=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        captcha = mock.patch.object(CommentAPIView, "verify_captcha", return_value=True)
+        captcha.start()
+        self.addCleanup(captcha.stop)
+        broadcast = mock.patch.object(broadcast_comment_events, "delay")
+        broadcast.start()
+        self.addCleanup(broadcast.stop)
+
+    def post_comment(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/comments/", {"text": "fresh", "captcha": "token"}
+            )
+        self.assertEqual(response.status_code, 201)
+
+    def test_write_costs_constant_cache_operations(self):
+        cache.set("unrelated_key", "keep me")
+        self.post_comment()
+        for page in (1, 2):
+            self.client.get("/api/comments/", {"page": page, "per_page": 10})
+
+        calls = []
+        patches = [
+            mock.patch.object(
+                cache,
+                name,
+                side_effect=lambda *a, _name=name, _orig=getattr(cache, name), **kw: (
+                    calls.append(_name) or _orig(*a, **kw)
+                ),
+            )
+            for name in self.CACHE_METHODS
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.post_comment()
+        self.post_comment()
+
+        # Per root comment: the spent captcha token, then the all/root total
+        # counters and the head version.
+        self.assertEqual(calls, ["delete", "incr", "incr", "incr"] * 2)
+        self.assertEqual(cache.get("unrelated_key"), "keep me")
+
+    def test_new_comment_refreshes_offset_pages(self):
+        first = self.client.get("/api/comments/", {"per_page": 10}).json()
+        self.post_comment()
+        second = self.client.get("/api/comments/", {"per_page": 10}).json()
+        self.assertEqual(second["meta"]["total"], first["meta"]["total"] + 1)
+        self.assertEqual(second["data"][0]["text"], "fresh")
+
+    def test_new_comment_keeps_older_cursor_pages_cached(self):
+        head = self.client.get(
+            "/api/comments/", {"pagination": "cursor", "per_page": 10}
+        ).json()
+        older_params = {"cursor": head["meta"]["next"], "per_page": 10}
+        self.client.get("/api/comments/", older_params)
+
+        self.post_comment()
+
+        with self.assertNumQueries(0):
+            self.client.get("/api/comments/", older_params)
+        new_head = self.client.get(
+            "/api/comments/", {"pagination": "cursor", "per_page": 10}
+        ).json()
+        self.assertEqual(new_head["data"][0]["text"], "fresh")
+
+    def test_edit_invalidates_cursor_pages(self):
+        head = self.client.get(
+            "/api/comments/", {"pagination": "cursor", "per_page": 10}
+        ).json()
+        older_params = {"cursor": head["meta"]["next"], "per_page": 10}
+        older = self.client.get("/api/comments/", older_params).json()
+
+        comment = Comment.objects.get(id=older["data"][0]["id"])
+        comment.text = "edited"
+        with self.captureOnCommitCallbacks(execute=True):
+            comment.save()
+
+        refreshed = self.client.get("/api/comments/", older_params).json()
+        self.assertEqual(refreshed["data"][0]["text"], "edited")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentPageCacheStampedeTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_misses_recompute_once(self):
+        computations = []
+        barrier = threading.Barrier(500)
+        results = []
+
+        def compute():
+            computations.append(1)
+            time.sleep(0.2)
+            return {"data": ["page"]}
+
+        def reader():
+            barrier.wait()
+            key, version = page_cache_key(1, 25)
+            results.append(get_or_compute(key, version, compute, ttl=300))
+
+        bump_head_version()
+        threads = [threading.Thread(target=reader) for _ in range(500)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computations), 1)
+        self.assertEqual(results, [{"data": ["page"]}] * 500)
+
+    def test_failed_recompute_is_taken_over_by_one_waiter(self):
+        key, version = page_cache_key(1, 25)
+        locked = threading.Event()
+        computations = []
+        results = []
+
+        def failing():
+            locked.set()
+            time.sleep(0.2)
+            raise DatabaseError("timeout")
+
+        def holder():
+            with self.assertRaises(DatabaseError):
+                get_or_compute(key, version, failing, ttl=300)
+
+        def compute():
+            computations.append(1)
+            time.sleep(0.1)
+            return "page"
+
+        def waiter():
+            results.append(get_or_compute(key, version, compute, ttl=300))
+
+        threads = [threading.Thread(target=holder)]
+        threads[0].start()
+        locked.wait()
+        threads += [threading.Thread(target=waiter) for _ in range(20)]
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computations), 1)
+        self.assertEqual(results, ["page"] * 20)
+
+    def test_stale_entry_is_served_while_another_request_recomputes(self):
+        key, version = page_cache_key(1, 25)
+        get_or_compute(key, version, lambda: "old", ttl=300)
+        bump_head_version()
+        key, version = page_cache_key(1, 25)
+
+        cache.add(f"{key}_lock", 1)
+        self.assertEqual(get_or_compute(key, version, lambda: "new", ttl=300), "old")
+        cache.delete(f"{key}_lock")
+        self.assertEqual(get_or_compute(key, version, lambda: "new", ttl=300), "new")
+
+    @override_settings(
+        COMMENTS_PAGE_CACHE_TTLS=[(1, 30)], COMMENTS_PAGE_CACHE_DEFAULT_TTL=900
+    )
+    def test_ttl_depends_on_page_depth(self):
+        self.assertEqual(page_cache_ttl(1), 30)
+        self.assertEqual(page_cache_ttl(2), 900)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentListQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [
+            User.objects.create_user(
+                username=f"user{i}", email=f"user{i}@example.com", password="pass12345"
+            )
+            for i in range(5)
+        ]
+        root = Comment.objects.create(text="root", sender=users[0])
+        for i in range(60):
+            Comment.objects.create(
+                text=f"reply {i}",
+                sender=users[i % 5],
+                parent_comment=root,
+                is_reply=True,
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_offset_page_query_count_is_constant(self):
+        # ids, total, then the rows whose fragments were not cached
+        for per_page in (5, 50):
+            cache.clear()
+            with self.assertNumQueries(3):
+                response = self.client.get("/api/comments/", {"per_page": per_page})
+            self.assertEqual(len(response.json()["data"]), per_page)
+
+    def test_cursor_page_query_count_is_constant(self):
+        for per_page in (5, 50):
+            cache.clear()
+            with self.assertNumQueries(2):
+                response = self.client.get(
+                    "/api/comments/", {"pagination": "cursor", "per_page": per_page}
+                )
+            data = response.json()["data"]
+            self.assertEqual(len(data), per_page)
+            self.assertTrue(data[0]["username"].startswith("user"))
+            self.assertIsNotNone(data[0]["parent_comment"])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentFragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="dave", email="dave@example.com", password="pass12345"
+        )
+        cls.comments = [
+            Comment.objects.create(text=f"comment {i}", sender=cls.user)
+            for i in range(10)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def page(self):
+        return self.client.get("/api/comments/", {"per_page": 5}).json()["data"]
+
+    def test_page_miss_serializes_only_new_comments(self):
+        self.page()
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(text="fresh", sender=self.user)
+        # ids of the page, then the one comment without a fragment
+        with self.assertNumQueries(2):
+            data = self.page()
+        self.assertEqual(data[0]["text"], "fresh")
+        self.assertEqual(len(data), 5)
+
+        bump_head_version()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.page(), data)
+
+    def test_fragments_follow_updates_replies_and_sender_changes(self):
+        self.page()
+        newest = Comment.objects.get(pk=self.comments[-1].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            newest.text = "edited"
+            newest.save(update_fields=["text"])
+            Comment.objects.create(
+                text="reply", sender=self.user, parent_comment=newest
+            )
+            self.user.username = "david"
+            self.user.save()
+
+        data = self.page()
+        self.assertEqual(data[0]["text"], "reply")
+        self.assertEqual(data[1]["text"], "edited")
+        self.assertEqual(data[1]["reply_count"], 1)
+        self.assertEqual({item["username"] for item in data}, {"david"})
+
+    def test_replies_invalidate_only_pages_of_their_thread(self):
+        params = {"pagination": "cursor", "per_page": 5}
+        first = self.client.get("/api/comments/", params).json()
+        params["cursor"] = first["meta"]["next"]
+        self.client.get("/api/comments/", params)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(
+                text="reply", sender=self.user, parent_comment=self.comments[-1]
+            )
+        with self.assertNumQueries(0):
+            self.client.get("/api/comments/", params)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(
+                text="reply", sender=self.user, parent_comment=self.comments[0]
+            )
+        data = self.client.get("/api/comments/", params).json()["data"]
+        self.assertEqual(data[-1]["id"], self.comments[0].id)
+        self.assertEqual(data[-1]["reply_count"], 1)
+
+    def test_stale_instance_does_not_reuse_a_version(self):
+        first = Comment.objects.get(pk=self.comments[0].pk)
+        stale = Comment.objects.get(pk=self.comments[0].pk)
+        first.text = "first edit"
+        first.save(update_fields=["text"])
+        self.page()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stale.text = "second edit"
+            stale.save(update_fields=["text"])
+
+        self.assertEqual(stale.version, first.version + 1)
+        self.assertEqual(
+            Comment.objects.values_list("version", flat=True).get(pk=stale.pk),
+            stale.version,
+        )
+        data = self.client.get("/api/comments/", {"per_page": 25}).json()["data"]
+        self.assertEqual(data[-1]["text"], "second edit")
+
+
+class CommentValuesSerializerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="erin", email="erin@example.com", password="pass12345"
+        )
+        root = Comment.objects.create(text="<i>root</i> & more", sender=cls.user)
+        reply = Comment.objects.create(
+            text="reply", sender=cls.user, parent_comment=root, is_reply=True
+        )
+        Comment.objects.create(
+            text="attached",
+            sender=cls.user,
+            parent_comment=reply,
+            is_reply=True,
+            attachment="attachments/photo.jpg",
+            renditions={
+                "thumb": {"name": "attachments/photo_thumb.jpg", "width": 1},
+                "medium": {"name": "attachments/photo_medium.jpg", "width": 2},
+            },
+        )
+        Comment.objects.create(
+            text="plain", sender=cls.user, attachment="attachments/notes.txt"
+        )
+
+    def assert_same_json(self):
+        comments = Comment.objects.for_list().order_by("id")
+        rows = Comment.objects.order_by("id").values(*COMMENT_VALUES)
+        self.assertEqual(
+            JSONRenderer().render(serialize_comment_values(rows)),
+            JSONRenderer().render(CommentSerializer(comments, many=True).data),
+        )
+
+    def test_output_matches_comment_serializer(self):
+        self.assert_same_json()
+
+    def test_output_matches_in_other_timezones(self):
+        with timezone.override("America/St_Johns"):
+            self.assert_same_json()
+
+
+class FastJSONRendererTests(SimpleTestCase):
+    def test_renders_the_same_bytes_as_json_renderer(self):
+        data = {
+            "text": 'naïve <i>ü</i> \u2028 "quoted"',
+            "created": datetime(2026, 1, 2, 3, 4, 5, 678901, tzinfo=dt_timezone.utc),
+            "amount": Decimal("1.5"),
+            "lazy": gettext_lazy("Invalid page."),
+            "nested": [{"id": 1, "none": None, "flag": True}, (2, 3)],
+            7: "int key",
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_indented_output_uses_stdlib(self):
+        data = {"a": [1, 2]}
+        self.assertEqual(
+            FastJSONRenderer().render(data, "application/json; indent=2"),
+            JSONRenderer().render(data, "application/json; indent=2"),
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMMENTS_COMPRESS_MIN_SIZE=1024)
+class CommentListHTTPCachingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="fay", email="fay@example.com", password="pass12345"
+        )
+        for i in range(30):
+            Comment.objects.create(text=f"comment number {i}", sender=cls.user)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unchanged_page_returns_304(self):
+        for params in ({"per_page": 10}, {"pagination": "cursor", "per_page": 10}):
+            response = self.client.get("/api/comments/", params)
+            etag = response["ETag"]
+            with self.assertNumQueries(0):
+                cached = self.client.get(
+                    "/api/comments/", params, HTTP_IF_NONE_MATCH=etag
+                )
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached.content, b"")
+            weak = self.client.get(
+                "/api/comments/", params, HTTP_IF_NONE_MATCH=f"W/{etag}"
+            )
+            self.assertEqual(weak.status_code, 304)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                Comment.objects.create(text="fresh", sender=self.user)
+            changed = self.client.get("/api/comments/", params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed["ETag"], etag)
+
+    def test_large_responses_are_gzipped(self):
+        response = self.client.get(
+            "/api/comments/", {"per_page": 30}, HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+        small = self.client.get(
+            "/api/comments/", {"per_page": 1}, HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertFalse(small.has_header("Content-Encoding"))
+
+    @skipUnless(brotli, "brotli is not installed")
+    def test_brotli_is_preferred_when_accepted(self):
+        response = self.client.get(
+            "/api/comments/", {"per_page": 30}, HTTP_ACCEPT_ENCODING="gzip, br"
+        )
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(
+            json.loads(brotli.decompress(response.content))["meta"]["total"], 30
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class InstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="gil", email="gil@example.com", password="pass12345"
+        )
+        for i in range(5):
+            Comment.objects.create(text=f"comment number {i}", sender=cls.user)
+
+    def setUp(self):
+        cache.clear()
+
+    def server_timing(self, response):
+        return {
+            entry.split(";")[0]: entry
+            for entry in response["Server-Timing"].split(", ")
+        }
+
+    def test_server_timing_reports_queries_and_cache_lookups(self):
+        first = self.server_timing(self.client.get("/api/comments/"))
+        self.assertIn('desc="3 queries"', first["db"])
+        self.assertIn('desc="1 miss"', first["cache-page"])
+        self.assertIn('desc="5 miss"', first["cache-fragment"])
+        self.assertIn("serialize", first)
+        self.assertIn("total", first)
+
+        second = self.server_timing(self.client.get("/api/comments/"))
+        self.assertIn('desc="0 queries"', second["db"])
+        self.assertIn('desc="1 hit"', second["cache-page"])
+        self.assertNotIn("cache-fragment", second)
+
+    @override_settings(COMMENTS_SERVER_TIMING=False)
+    def test_server_timing_can_be_turned_off(self):
+        self.assertFalse(self.client.get("/api/comments/").has_header("Server-Timing"))
+
+    def test_metrics_endpoint(self):
+        self.client.get("/api/comments/")
+        response = self.client.get("/metrics/")
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn(
+            f'http_request_duration_seconds_count{{pid="{os.getpid()}",'
+            'method="GET",status="2xx",view="comment"}',
+            body,
+        )
+        self.assertIn(
+            f'http_request_db_queries_bucket{{pid="{os.getpid()}",view="comment",'
+            'le="3"}',
+            body,
+        )
+        self.assertIn(
+            f'comments_cache_lookups_total{{pid="{os.getpid()}",family="page",'
+            'result="miss"}',
+            body,
+        )
+
+        remote = self.client.get("/metrics/", REMOTE_ADDR="203.0.113.9")
+        self.assertEqual(remote.status_code, 404)
+
+    def test_celery_tasks_are_timed(self):
+        before = metrics.render()
+        tasks.broadcast_comment_events.delay()
+        after = metrics.render()
+        name = (
+            f'celery_task_duration_seconds_count{{pid="{os.getpid()}",state="SUCCESS",'
+            'task="comments.tasks.broadcast_comment_events"}'
+        )
+        self.assertIn(name, after)
+        count = lambda body: int(  # noqa: E731
+            next(
+                (line for line in body.splitlines() if line.startswith(name)), "0 0"
+            ).rsplit(" ", 1)[1]
+        )
+        self.assertEqual(count(after), count(before) + 1)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_counter_renders_in_prometheus_format(self):
+        counter = metrics.Counter("test_things_total", "Things")
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind="b")
+        self.assertEqual(
+            counter.collect(),
+            [
+                "# HELP test_things_total Things",
+                "# TYPE test_things_total counter",
+                f'test_things_total{{pid="{os.getpid()}",kind="a"}} 3',
+                f'test_things_total{{pid="{os.getpid()}",kind="b"}} 1',
+            ],
+        )
+
+    def test_http_server_moves_up_from_a_taken_port(self):
+        first = metrics.start_http_server(0)
+        self.addCleanup(first.shutdown)
+        port = first.server_address[1]
+        with self.assertRaises(OSError):
+            metrics.start_http_server(port)
+        second = metrics.start_http_server(port, attempts=64)
+        self.addCleanup(second.shutdown)
+        self.assertGreater(second.server_address[1], port)
+
+
+class ServingTests(SimpleTestCase):
+    def request(self, app, path, method="GET", headers=(), body=b""):
+        async def run():
+            communicator = ApplicationCommunicator(
+                app,
+                {
+                    "type": "http",
+                    "method": method,
+                    "path": path,
+                    "raw_path": path.encode(),
+                    "query_string": b"",
+                    "http_version": "1.1",
+                    "root_path": "",
+                    "headers": list(headers),
+                    "server": ("testserver", 80),
+                },
+            )
+            await communicator.send_input({"type": "http.request", "body": body})
+            start = await communicator.receive_output(5)
+            content = b""
+            while True:
+                message = await communicator.receive_output(5)
+                content += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            return start["status"], dict(start["headers"]), content
+
+        return async_to_sync(run)()
+
+    def test_thread_pool_app_reuses_its_threads(self):
+        def wsgi_app(environ, start_response):
+            body = environ["wsgi.input"].read()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [str(threading.get_ident()).encode(), b" ", body]
+
+        app = ThreadPoolWSGIApp(wsgi_app, threads=1)
+        idents = set()
+        for i in range(3):
+            status, _, content = self.request(
+                app, "/", method="POST", body=f"body {i}".encode()
+            )
+            self.assertEqual(status, 200)
+            ident, body = content.split(b" ", 1)
+            self.assertEqual(body, f"body {i}".encode())
+            idents.add(ident)
+        self.assertEqual(len(idents), 1)
+        self.assertNotEqual(idents, {str(threading.get_ident()).encode()})
+
+    def test_thread_pool_app_builds_the_environ(self):
+        def wsgi_app(environ, start_response):
+            start_response("200 OK", [("X-Seen", environ["HTTP_ACCEPT"])])
+            return [environ["PATH_INFO"].encode(), environ["SERVER_NAME"].encode()]
+
+        app = ThreadPoolWSGIApp(wsgi_app, threads=1)
+        status, headers, content = self.request(
+            app, "/api/", headers=[(b"accept", b"a"), (b"accept", b"b")]
+        )
+        self.assertEqual((status, content), (200, b"/api/testserver"))
+        self.assertEqual(headers[b"x-seen"], b"a,b")
+
+        status, _, _ = self.request(app, "/", headers=[(b"accept", b"a")] * 101)
+        self.assertEqual(status, 400)
+
+    def test_file_serving_app(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(f"{root}/photo.jpg", "wb") as file:
+            file.write(b"x" * 100_000)
+
+        async def fallback(scope, receive, send):
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body"})
+
+        app = FileServingApp(fallback, [("/media/", root)], max_age=60)
+        status, headers, content = self.request(app, "/media/photo.jpg")
+        self.assertEqual(status, 200)
+        self.assertEqual(content, b"x" * 100_000)
+        self.assertEqual(headers[b"content-type"], b"image/jpeg")
+        self.assertEqual(headers[b"content-length"], b"100000")
+        self.assertEqual(headers[b"cache-control"], b"public, max-age=60")
+
+        etag = headers[b"etag"]
+        status, _, content = self.request(
+            app, "/media/photo.jpg", headers=[(b"if-none-match", etag)]
+        )
+        self.assertEqual((status, content), (304, b""))
+
+        self.assertEqual(self.request(app, "/media/missing.jpg")[0], 404)
+        self.assertEqual(self.request(app, "/media/../etc/passwd")[0], 404)
+        self.assertEqual(self.request(app, "/media/")[0], 404)
+        self.assertEqual(self.request(app, "/api/comments/")[0], 204)
+        self.assertEqual(self.request(app, "/media/photo.jpg", method="POST")[0], 204)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentThreadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="carol", email="carol@example.com", password="pass12345"
+        )
+        cls.root = Comment.objects.create(text="root", sender=cls.user)
+        parent = cls.root
+        cls.chain = [cls.root]
+        for level in range(1, 8):
+            parent = Comment.objects.create(
+                text=f"level {level}",
+                sender=cls.user,
+                parent_comment=parent,
+                is_reply=True,
+            )
+            cls.chain.append(parent)
+        cls.sibling = Comment.objects.create(
+            text="sibling", sender=cls.user, parent_comment=cls.root, is_reply=True
+        )
+        Comment.objects.create(text="other thread", sender=cls.user)
+
+    def test_path_and_depth_are_maintained_on_insert(self):
+        leaf = Comment.objects.get(pk=self.chain[-1].pk)
+        self.assertEqual(leaf.depth, 7)
+        self.assertEqual(leaf.path, "".join(f"{c.id:010d}/" for c in self.chain))
+
+    def test_post_save_receivers_see_the_path(self):
+        seen = []
+
+        def receiver(instance, created, **kwargs):
+            if created:
+                seen.append(Comment.objects.get(pk=instance.pk).path)
+
+        post_save.connect(receiver, sender=Comment)
+        self.addCleanup(post_save.disconnect, receiver, sender=Comment)
+        reply = Comment.objects.create(
+            text="reply", sender=self.user, parent_comment=self.root, is_reply=True
+        )
+
+        self.assertEqual(seen, [f"{self.root.id:010d}/{reply.id:010d}/"])
+
+    def test_comment_without_path_is_not_found(self):
+        Comment.objects.filter(pk=self.sibling.pk).update(path="")
+
+        response = self.client.get(f"/api/comments/{self.sibling.id}/thread/")
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_whole_thread_is_nested_in_two_queries(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/comments/{self.root.id}/thread/")
+        node = response.json()["data"]
+        self.assertEqual(node["id"], self.root.id)
+        self.assertEqual(
+            [reply["id"] for reply in node["replies"]],
+            [self.chain[1].id, self.sibling.id],
+        )
+        levels = 0
+        while node["replies"]:
+            node = node["replies"][0]
+            levels += 1
+        self.assertEqual(levels, 7)
+
+    def test_subtree_respects_depth_limit(self):
+        response = self.client.get(
+            f"/api/comments/{self.chain[2].id}/thread/", {"depth": 2}
+        )
+        node = response.json()["data"]
+        self.assertEqual(node["id"], self.chain[2].id)
+        self.assertEqual(node["replies"][0]["id"], self.chain[3].id)
+        self.assertEqual(node["replies"][0]["replies"][0]["id"], self.chain[4].id)
+        self.assertEqual(node["replies"][0]["replies"][0]["replies"], [])
+
+    def test_unknown_comment_returns_404(self):
+        response = self.client.get("/api/comments/999999/thread/")
+        self.assertEqual(response.status_code, 404)
+
+    def counters(self, comment):
+        comment = Comment.objects.get(pk=comment.pk)
+        return comment.reply_count, comment.descendant_count, comment.last_reply_at
+
+    def test_counters_are_maintained_on_insert(self):
+        leaf = self.chain[-1]
+        self.assertEqual(
+            self.counters(self.root),
+            (2, 8, Comment.objects.get(pk=self.sibling.pk).created_at),
+        )
+        self.assertEqual(self.counters(self.chain[6]), (1, 1, leaf.created_at))
+        self.assertEqual(self.counters(leaf), (0, 0, None))
+
+        data = self.client.get("/api/comments/", {"root": "1"}).json()["data"]
+        root = next(item for item in data if item["id"] == self.root.id)
+        self.assertEqual((root["reply_count"], root["descendant_count"]), (2, 8))
+
+    def test_deleting_a_subtree_updates_ancestors(self):
+        self.chain[3].delete()
+        self.assertEqual(self.counters(self.chain[2])[:2], (0, 0))
+        self.assertIsNone(self.counters(self.chain[2])[2])
+        self.assertEqual(self.counters(self.root)[:2], (2, 3))
+
+    def test_deleting_by_queryset_counts_each_subtree_once(self):
+        Comment.objects.filter(pk__in=[self.chain[1].pk, self.chain[5].pk]).delete()
+        self.assertEqual(
+            self.counters(self.root),
+            (1, 1, Comment.objects.get(pk=self.sibling.pk).created_at),
+        )
+
+    def test_saving_a_stale_instance_keeps_counters(self):
+        stale = Comment.objects.get(pk=self.root.pk)
+        Comment.objects.create(
+            text="late reply", sender=self.user, parent_comment=self.root
+        )
+        expected = self.counters(self.root)
+
+        stale.text = "edited"
+        stale.save()
+
+        self.assertEqual(self.counters(self.root), expected)
+        self.assertEqual(expected[:2], (3, 9))
+
+    def test_reconcile_repairs_drift(self):
+        expected = {c.pk: self.counters(c) for c in Comment.objects.all()}
+        Comment.objects.update(reply_count=5, descendant_count=0, last_reply_at=None)
+        out = StringIO()
+        call_command("reconcile_reply_counts", "--batch-size", "3", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "10 comments fixed")
+        self.assertEqual(
+            {c.pk: self.counters(c) for c in Comment.objects.all()}, expected
+        )
+
+
+class SearchHelperTests(SimpleTestCase):
+    def test_query_terms_drop_operators_and_duplicates(self):
+        self.assertEqual(
+            search_terms('+Django -"ORM" django* <b>x</b>'), ["django", "orm", "x"]
+        )
+
+    def test_highlight_marks_word_prefixes_and_escapes(self):
+        self.assertEqual(
+            highlight("<i>Fast</i> faster & fastest", ["fast"]),
+            "<mark>Fast</mark> <mark>faster</mark> &amp; <mark>fastest</mark>",
+        )
+
+    def test_highlight_centres_long_text_on_the_first_match(self):
+        snippet = highlight("word " * 100 + "needle " + "word " * 100, ["needle"])
+        self.assertTrue(snippet.startswith("…") and snippet.endswith("…"))
+        self.assertIn("<mark>needle</mark>", snippet)
+
+
+MARKUP_FRAGMENTS = [
+    "<i>",
+    "</i>",
+    "<strong>",
+    "</strong>",
+    "<code>",
+    "</code>",
+    '<a href="https://example.com/?a=1&amp;b=2">',
+    "<a href='https://example.com' title=\"x > y\">",
+    '<a href="javascript:alert(1)">',
+    "<a title=t>",
+    "</a>",
+    "<script>",
+    "<i onclick=x>",
+    "<I>",
+    '<a href="https://x.org"',
+    "<",
+    ">",
+    "&",
+    "&amp;",
+    "&lt;b&gt;",
+    '"',
+    "'",
+    " ",
+    "text",
+    " ",
+]
+
+
+class MarkupTests(SimpleTestCase):
+    def assert_safe(self, rendered):
+        """Only allowed tags and attributes survive, properly nested"""
+        allowed = {"i": set(), "strong": set(), "code": set(), "a": {"href", "title"}}
+        test = self
+        stack = []
+
+        class Checker(HTMLParser):
+            def handle_starttag(self, tag, attrs):
+                test.assertIn(tag, allowed)
+                test.assertLessEqual({name for name, _ in attrs}, allowed[tag])
+                if tag == "a":
+                    test.assertTrue(is_valid_url(dict(attrs)["href"]))
+                stack.append(tag)
+
+            def handle_endtag(self, tag):
+                test.assertEqual(stack.pop(), tag)
+
+        checker = Checker()
+        checker.feed(rendered)
+        checker.close()
+        self.assertEqual(stack, [])
+
+    def test_valid_markup_is_normalized(self):
+        self.assertEqual(
+            render_markup(
+                "a < b & <I>c</I> "
+                '<a title=\'t"\' href="https://e.com/?a=1&amp;b=2">l</a>'
+            ),
+            (
+                'a &lt; b &amp; <i>c</i> <a href="https://e.com/?a=1&amp;b=2"'
+                ' title="t&quot;">l</a>',
+                [],
+            ),
+        )
+
+    def test_errors(self):
+        cases = {
+            "<b>x</b>": ["Disallowed HTML tag: <b>"],
+            "<i class=x>y</i>": ["<i> tag should not have attributes"],
+            '<a href="https://x.org" onclick="z">q</a>': [
+                "Disallowed attribute in <a> tag: onclick"
+            ],
+            "<a>q</a>": ["<a> tag must have href attribute"],
+            '<a href="javascript:alert(1)">x</a>': [
+                "Invalid URL in href attribute: javascript:alert(1)"
+            ],
+            "<i><strong>x</i></strong>": [
+                "</i> closes <i> before <strong>",
+                "Unclosed <i> tag",
+            ],
+            "</code>": ["</code> has no matching <code>"],
+            "<i>open": ["Unclosed <i> tag"],
+            '<a href="https://x.org"><a href="https://y.org">n</a></a>': [
+                "<a> tags cannot be nested"
+            ],
+        }
+        for text, errors in cases.items():
+            with self.subTest(text=text):
+                rendered, found = render_markup(text)
+                self.assertEqual(found, errors)
+                self.assert_safe(rendered)
+
+    def test_fuzz_renderings_are_safe_and_stable(self):
+        rng = random.Random(1234)
+        for _ in range(2000):
+            text = "".join(rng.choices(MARKUP_FRAGMENTS, k=rng.randint(1, 40)))
+            rendered, _ = render_markup(text)
+            self.assert_safe(rendered)
+            self.assertEqual(render_markup(rendered), (rendered, []), text)
+
+    def test_adversarial_inputs_are_handled_in_one_pass(self):
+        n = 20000
+        link = '<a href="https://x.org">l</a>'
+        cases = [
+            ("<i>" * n + "x" + "</i>" * n, "<i>" * n + "x" + "</i>" * n, []),
+            ("<" * n, "&lt;" * n, []),
+            (link * n, link * n, []),
+            ("<i " + " " * n + "x>", None, ["<i> tag should not have attributes"]),
+            ('<a href="' * n, '&lt;a href="' * n, []),
+        ]
+        for text, rendered, errors in cases:
+            with self.subTest(text=text[:20]):
+                result = render_markup(text)
+                if rendered is not None:
+                    self.assertEqual(result[0], rendered)
+                self.assertEqual(result[1], errors)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentMarkupTests(TestCase):
+    def test_rendering_is_stored_and_follows_edits(self):
+        user = User.objects.create_user(
+            username="gus", email="gus@example.com", password="pass12345"
+        )
+        comment = Comment.objects.create(text="<I>hi</I> & bye", sender=user)
+        self.assertEqual(comment.text_html, "<i>hi</i> &amp; bye")
+        comment.text = "<code>x</code>"
+        comment.save(update_fields=["text"])
+        comment.refresh_from_db()
+        self.assertEqual(comment.text_html, "<code>x</code>")
+
+    def test_posting_renders_the_text_once(self):
+        user = User.objects.create_user(
+            username="hal", email="hal@example.com", password="pass12345"
+        )
+        serializer = CommentSerializer(data={"text": "<I>hi</I>", "sender": user.id})
+        with mock.patch(
+            "comments.models.render_markup", side_effect=AssertionError
+        ), mock.patch(
+            "comments.serializers.render_markup", wraps=render_markup
+        ) as render:
+            self.assertTrue(serializer.is_valid())
+            comment = serializer.save()
+            serializer = CommentSerializer(comment, data={"text": "<i>edited</i>"})
+            self.assertTrue(serializer.is_valid())
+            serializer.save()
+        self.assertEqual(render.call_count, 2)
+        comment.refresh_from_db()
+        self.assertEqual(comment.text_html, "<i>edited</i>")
+
+    def test_serializer_rejects_invalid_markup(self):
+        serializer = CommentSerializer(data={"text": "<i><b>x</b>"})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(
+            serializer.errors["text"],
+            ["Disallowed HTML tag: <b>", "Unclosed <i> tag"],
+        )
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    COMMENTS_SEARCH_BACKEND="comments.search.LocalInvertedIndexBackend",
+)
+class CommentSearchTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict("comments.search._backends", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(
+            username="hal", email="hal@example.com", password="pass12345"
+        )
+        self.create("Caching <strong>strategies</strong> for Django")
+        self.create("Django caching caching everywhere")
+        self.create("Nothing relevant here")
+
+    def create(self, text):
+        return Comment.objects.create(text=text, sender=self.user)
+
+    def search(self, **params):
+        return self.client.get("/api/comments/search/", params)
+
+    def test_results_match_all_terms_by_prefix_ranked_by_relevance(self):
+        response = self.search(q="cach djan")
+        body = response.json()
+        self.assertEqual(
+            [item["text"] for item in body["data"]],
+            [
+                "Django caching caching everywhere",
+                "Caching <strong>strategies</strong> for Django",
+            ],
+        )
+        self.assertEqual(body["meta"]["total"], 2)
+        self.assertEqual(
+            body["data"][1]["highlight"],
+            "<mark>Caching</mark> strategies for <mark>Django</mark>",
+        )
+
+    def test_pagination(self):
+        body = self.search(q="django", per_page=1, page=2).json()
+        self.assertEqual(len(body["data"]), 1)
+        self.assertEqual(body["meta"]["last_page"], 2)
+        self.assertEqual(body["meta"]["current_page"], 2)
+
+    def test_index_follows_writes(self):
+        self.search(q="django")
+        comment = self.create("More django")
+        self.assertEqual(self.search(q="django").json()["meta"]["total"], 3)
+        comment.text = "changed"
+        comment.save()
+        self.assertEqual(self.search(q="django").json()["meta"]["total"], 2)
+        Comment.objects.filter(text__startswith="Django").first().delete()
+        self.assertEqual(self.search(q="django").json()["meta"]["total"], 1)
+
+    def test_empty_query_is_rejected(self):
+        self.assertEqual(self.search(q=" +- ").status_code, 400)
+        self.assertEqual(self.search(q="django", page=0).status_code, 400)
+
+
+# InnoDB only updates FULLTEXT indexes on commit, so these rows must be
+# committed rather than wrapped in a test transaction.
+@skipUnless(connection.vendor == "mysql", "FULLTEXT search needs MySQL")
+class MySQLFulltextSearchTests(TransactionTestCase):
+    def test_boolean_prefix_search_uses_the_index(self):
+        user = User.objects.create_user(
+            username="ivy", email="ivy@example.com", password="pass12345"
+        )
+        Comment.objects.create(text="Caching strategies for Django", sender=user)
+        Comment.objects.create(text="Nothing relevant here", sender=user)
+        ids, total = MySQLFulltextBackend().search(["cach", "djan"], 0, 10)
+        self.assertEqual(total, 1)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "EXPLAIN SELECT id FROM comments_comment WHERE "
+                "MATCH (text) AGAINST (%s IN BOOLEAN MODE)",
+                ["+cach*"],
+            )
+            self.assertEqual(cursor.fetchone()[4], "fulltext")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CaptchaVerifierTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(CAPTCHA_VERIFIER="comments.captcha.StubCaptchaVerifier")
+    def test_backend_is_configurable(self):
+        self.assertIsInstance(get_captcha_verifier(), StubCaptchaVerifier)
+        self.assertTrue(get_captcha_verifier().verify("token"))
+
+    def test_verified_tokens_are_not_rechecked(self):
+        verifier = StubCaptchaVerifier()
+        with mock.patch.object(verifier, "check", return_value=True) as check:
+            self.assertTrue(verifier.verify("token"))
+            self.assertTrue(verifier.verify("token"))
+        self.assertEqual(check.call_count, 1)
+
+    def test_failed_tokens_are_rechecked(self):
+        verifier = StubCaptchaVerifier()
+        with mock.patch.object(verifier, "check", return_value=False) as check:
+            self.assertFalse(verifier.verify("token"))
+            self.assertFalse(verifier.verify("token"))
+        self.assertEqual(check.call_count, 2)
+
+    def test_verified_tokens_are_bound_to_address_and_user(self):
+        verifier = StubCaptchaVerifier()
+        with mock.patch.object(verifier, "check", return_value=True) as check:
+            self.assertTrue(verifier.verify("token", "10.0.0.1", 1))
+            self.assertTrue(verifier.verify("token", "10.0.0.1", 1))
+            self.assertTrue(verifier.verify("token", "10.0.0.2", 1))
+            self.assertTrue(verifier.verify("token", "10.0.0.1", 2))
+        self.assertEqual(check.call_count, 3)
+
+    def test_forgotten_tokens_are_rechecked(self):
+        verifier = StubCaptchaVerifier()
+        with mock.patch.object(verifier, "check", return_value=True) as check:
+            verifier.verify("token", "10.0.0.1", 1)
+            verifier.forget("token", "10.0.0.1", 1)
+            verifier.verify("token", "10.0.0.1", 1)
+        self.assertEqual(check.call_count, 2)
+
+    @override_settings(CAPTCHA_CONNECT_TIMEOUT=1, CAPTCHA_READ_TIMEOUT=2)
+    def test_recaptcha_uses_pooled_session_with_timeouts(self):
+        response = mock.Mock()
+        response.json.return_value = {"success": True}
+        with mock.patch("requests.Session.post", return_value=response) as post:
+            self.assertTrue(RecaptchaVerifier().verify("token", "127.0.0.1"))
+        self.assertEqual(post.call_args.kwargs["timeout"], (1, 2))
+
+    def test_recaptcha_network_errors_fail_closed(self):
+        with mock.patch("requests.Session.post", side_effect=requests.Timeout()):
+            with self.assertLogs("comments.captcha", "WARNING"):
+                self.assertFalse(RecaptchaVerifier().verify("token"))
+
+    def test_async_variant(self):
+        self.assertTrue(async_to_sync(StubCaptchaVerifier().averify)("token"))
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, CAPTCHA_VERIFIER="comments.captcha.StubCaptchaVerifier"
+)
+class CaptchaReplayTests(TestCase):
+    def test_token_is_not_reusable_after_posting(self):
+        user = User.objects.create_user(
+            username="frank", email="frank@example.com", password="pass12345"
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        data = {"text": "x" * 501, "captcha": "token"}
+        with mock.patch.object(
+            StubCaptchaVerifier, "check", return_value=True
+        ) as check:
+            # A rejected submission may be retried on the same token...
+            self.assertEqual(client.post("/api/comments/", data).status_code, 400)
+            data["text"] = "hello"
+            self.assertEqual(client.post("/api/comments/", data).status_code, 201)
+            self.assertEqual(check.call_count, 1)
+            # ...a created comment may not be repeated without a new check.
+            client.post("/api/comments/", data)
+        self.assertEqual(check.call_count, 2)
+
+
+class CommentConsumerBatchingTests(SimpleTestCase):
+    async def broadcast(self, *texts):
+        for seq, text in enumerate(texts, start=1):
+            await get_channel_layer().group_send(
+                "comments",
+                {
+                    "type": "new_comment",
+                    "seq": seq,
+                    "through": seq,
+                    "comment_json": json.dumps({"text": text}),
+                },
+            )
+
+    @override_settings(COMMENTS_WS_FLUSH_INTERVAL=0.05)
+    async def test_burst_is_coalesced_into_one_frame(self):
+        communicator = WebsocketCommunicator(CommentConsumer.as_asgi(), "/ws/comments/")
+        await communicator.connect()
+        await self.broadcast("a", "b", "c")
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "new_comments")
+        self.assertEqual(frame["seqs"], [1, 2, 3])
+        self.assertEqual(frame["through"], 3)
+        self.assertEqual([c["text"] for c in frame["comments"]], ["a", "b", "c"])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    @override_settings(COMMENTS_WS_FLUSH_INTERVAL=0)
+    async def test_single_comment_keeps_new_comment_frame(self):
+        communicator = WebsocketCommunicator(CommentConsumer.as_asgi(), "/ws/comments/")
+        await communicator.connect()
+        await self.broadcast("a")
+        frame = await communicator.receive_json_from()
+        self.assertEqual(
+            frame,
+            {"type": "new_comment", "seq": 1, "through": 1, "comment": {"text": "a"}},
+        )
+        await communicator.disconnect()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentOutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="dave", email="dave@example.com", password="pass12345"
+        )
+
+    def setUp(self):
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.group_add)("comments", "outbox-test")
+        self.addCleanup(
+            async_to_sync(self.layer.group_discard), "comments", "outbox-test"
+        )
+
+    def receive(self):
+        return async_to_sync(self.layer.receive)("outbox-test")
+
+    def test_broadcast_is_queued_after_commit(self):
+        with mock.patch.object(broadcast_comment_events, "delay") as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                comment = Comment.objects.create(text="hello", sender=self.user)
+            delay.assert_not_called()
+            for callback in callbacks:
+                callback()
+        delay.assert_called_once_with()
+        self.assertTrue(
+            CommentEvent.objects.filter(
+                comment=comment, delivered_at__isnull=True
+            ).exists()
+        )
+
+    def test_comment_is_rolled_back_with_its_outbox_row(self):
+        root = Comment.objects.create(text="root", sender=self.user)
+        with mock.patch.object(
+            CommentEvent.objects, "create", side_effect=DatabaseError("outbox")
+        ):
+            with self.assertRaises(DatabaseError):
+                Comment.objects.create(
+                    text="reply", sender=self.user, parent_comment=root
+                )
+
+        self.assertEqual(Comment.objects.count(), 1)
+        root.refresh_from_db()
+        self.assertEqual(root.reply_count, 0)
+        self.assertEqual(root.descendant_count, 0)
+
+    @override_settings(COMMENTS_OUTBOX_COMMIT_GRACE=timedelta(0))
+    def test_events_are_published_in_sequence(self):
+        first = Comment.objects.create(text="first", sender=self.user)
+        second = Comment.objects.create(text="second", sender=self.user)
+
+        self.assertEqual(publish_pending_events(), 2)
+
+        messages = [self.receive(), self.receive()]
+        self.assertEqual(
+            [json.loads(m["comment_json"])["id"] for m in messages],
+            [first.id, second.id],
+        )
+        self.assertLess(messages[0]["seq"], messages[1]["seq"])
+        # The first message cannot vouch for the second, sent after it.
+        self.assertEqual(
+            [m["through"] for m in messages],
+            [messages[1]["seq"] - 1, messages[1]["seq"]],
+        )
+        self.assertFalse(
+            CommentEvent.objects.filter(delivered_at__isnull=True).exists()
+        )
+        self.assertEqual(publish_pending_events(), 0)
+
+    def test_replies_are_published_to_their_thread(self):
+        root = Comment.objects.create(text="root", sender=self.user)
+        reply = Comment.objects.create(
+            text="reply", sender=self.user, parent_comment=root, is_reply=True
+        )
+        async_to_sync(self.layer.group_add)(thread_group(root.id), "thread-test")
+
+        publish_pending_events()
+
+        self.assertEqual(json.loads(self.receive()["comment_json"])["id"], root.id)
+        message = async_to_sync(self.layer.receive)("thread-test")
+        self.assertEqual(json.loads(message["comment_json"])["id"], reply.id)
+
+    def test_failed_publish_is_retried(self):
+        Comment.objects.create(text="retry me", sender=self.user)
+        with mock.patch(
+            "comments.consumers.group_send_all", side_effect=ConnectionError
+        ):
+            with self.assertRaises(ConnectionError):
+                publish_pending_events()
+        self.assertEqual(
+            CommentEvent.objects.filter(delivered_at__isnull=True).count(), 1
+        )
+        self.assertEqual(publish_pending_events(), 1)
+
+
+class ChannelLayerCheckTests(SimpleTestCase):
+    in_memory = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+    def test_deploy_check_rejects_in_memory_layer_with_workers(self):
+        with self.settings(
+            CHANNEL_LAYERS=self.in_memory, CELERY_TASK_ALWAYS_EAGER=False
+        ):
+            errors = checks.run_checks(include_deployment_checks=True)
+        self.assertIn("comments.E001", [error.id for error in errors])
+        with self.settings(
+            CHANNEL_LAYERS=self.in_memory, CELERY_TASK_ALWAYS_EAGER=True
+        ):
+            errors = checks.run_checks(include_deployment_checks=True)
+        self.assertNotIn("comments.E001", [error.id for error in errors])
+
+    def test_worker_refuses_to_start_on_in_memory_layer(self):
+        with self.settings(CHANNEL_LAYERS=self.in_memory):
+            with self.assertRaisesMessage(SystemExit, "comments.E001"):
+                refuse_in_memory_layer()
+        redis_layer = {"default": {"BACKEND": "channels_redis.core.RedisChannelLayer"}}
+        with self.settings(CHANNEL_LAYERS=redis_layer):
+            refuse_in_memory_layer()
+
+
+@override_settings(COMMENTS_WS_FLUSH_INTERVAL=0)
+class CommentConsumerSubscriptionTests(SimpleTestCase):
+    async def connect(self):
+        communicator = WebsocketCommunicator(CommentConsumer.as_asgi(), "/ws/comments/")
+        await communicator.connect()
+        return communicator
+
+    async def send_to(self, group, seq):
+        await get_channel_layer().group_send(
+            group,
+            {
+                "type": "new_comment",
+                "seq": seq,
+                "through": seq,
+                "comment_json": json.dumps({}),
+            },
+        )
+
+    async def test_replies_reach_only_thread_subscribers(self):
+        subscriber = await self.connect()
+        bystander = await self.connect()
+        await subscriber.send_json_to({"action": "subscribe", "threads": [7]})
+        self.assertEqual(
+            await subscriber.receive_json_from(),
+            {"type": "subscriptions", "feed": True, "threads": [7]},
+        )
+
+        await self.send_to(thread_group(7), 1)
+        self.assertEqual((await subscriber.receive_json_from())["seq"], 1)
+        self.assertTrue(await bystander.receive_nothing())
+
+        await self.send_to("comments", 2)
+        self.assertEqual((await subscriber.receive_json_from())["seq"], 2)
+        self.assertEqual((await bystander.receive_json_from())["seq"], 2)
+
+        await subscriber.disconnect()
+        await bystander.disconnect()
+
+    async def test_unsubscribe_from_thread_and_feed(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"action": "subscribe", "threads": [7, 8]})
+        await communicator.receive_json_from()
+        await communicator.send_json_to(
+            {"action": "unsubscribe", "threads": [7], "feed": True}
+        )
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "subscriptions", "feed": False, "threads": [8]},
+        )
+        await self.send_to(thread_group(7), 1)
+        await self.send_to("comments", 2)
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    @override_settings(COMMENTS_WS_MAX_THREADS=2)
+    async def test_subscription_limit_and_bad_messages(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({"action": "subscribe", "threads": [1, 2, 3]})
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+        await communicator.send_to(text_data="not json")
+        self.assertEqual((await communicator.receive_json_from())["type"], "error")
+        await communicator.disconnect()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMMENTS_WS_FLUSH_INTERVAL=0)
+class CommentReplayTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="erin", email="erin@example.com", password="pass12345"
+        )
+        cls.root = Comment.objects.create(text="root", sender=cls.user)
+        cls.other_root = Comment.objects.create(text="other", sender=cls.user)
+        cls.reply = Comment.objects.create(
+            text="reply", sender=cls.user, parent_comment=cls.root, is_reply=True
+        )
+        cls.other_reply = Comment.objects.create(
+            text="other reply",
+            sender=cls.user,
+            parent_comment=cls.other_root,
+            is_reply=True,
+        )
+
+    def seq(self, comment):
+        return CommentEvent.objects.get(comment=comment).id
+
+    def replayed_ids(self, since_seq, feed, threads):
+        groups = {thread_group(root_id) for root_id in threads}
+        if feed:
+            groups.add("comments")
+        source, _, comments = replay(since_seq, feed, threads, groups)
+        return source, [json.loads(comment)["id"] for comment in comments]
+
+    def test_db_fallback_filters_by_subscription(self):
+        self.assertEqual(
+            self.replayed_ids(self.seq(self.root), True, {self.root.id}),
+            ("db", [self.other_root.id, self.reply.id]),
+        )
+        self.assertEqual(
+            self.replayed_ids(0, False, {self.other_root.id}),
+            ("db", [self.other_reply.id]),
+        )
+
+    @override_settings(COMMENTS_WS_REPLAY_LIMIT=1)
+    def test_large_gap_asks_client_to_resync(self):
+        self.assertEqual(self.replayed_ids(0, True, set()), (None, []))
+
+    def test_db_fallback_follows_the_outbox_order(self):
+        # Comment ids and outbox sequence disagree when the INSERTs of two
+        # transactions interleave; the outbox order is the publishing order.
+        CommentEvent.objects.filter(comment=self.other_root).update(id=100)
+        self.assertEqual(
+            self.replayed_ids(self.seq(self.reply), True, set()),
+            ("db", [self.other_root.id]),
+        )
+
+    def test_purged_events_ask_client_to_resync(self):
+        since_seq = self.seq(self.root) - 1
+        CommentEvent.objects.filter(comment=self.root).delete()
+        self.assertEqual(self.replayed_ids(since_seq, True, set()), (None, []))
+
+    @override_settings(COMMENTS_OUTBOX_COMMIT_GRACE=timedelta(0))
+    def test_through_stops_before_undelivered_events(self):
+        CommentEvent.objects.update(delivered_at=timezone.now())
+        self.assertEqual(delivered_through(), self.seq(self.other_reply))
+        CommentEvent.objects.filter(comment=self.reply).update(delivered_at=None)
+        self.assertEqual(delivered_through(), self.seq(self.reply) - 1)
+        self.assertEqual(
+            delivered_through(exclude=[self.seq(self.reply)]),
+            self.seq(self.other_reply),
+        )
+
+    def test_through_leaves_out_recent_events(self):
+        CommentEvent.objects.update(delivered_at=timezone.now())
+        self.assertEqual(delivered_through(), 0)
+
+    async def test_since_seq_on_connect_replays_feed(self):
+        since_seq = await database_sync_to_async(self.seq)(self.root)
+        communicator = WebsocketCommunicator(
+            CommentConsumer.as_asgi(), f"/ws/comments/?since_seq={since_seq}"
+        )
+        await communicator.connect()
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "replay")
+        self.assertEqual(frame["through"], since_seq)
+        self.assertEqual([c["id"] for c in frame["comments"]], [self.other_root.id])
+        await communicator.disconnect()
+
+
+def fakeredis_caches():
+    """django_redis cache on a fresh in-process fake server"""
+    return {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": "redis://localhost:6379/1",
+            "OPTIONS": {
+                "CONNECTION_POOL_KWARGS": {
+                    "connection_class": fakeredis.FakeConnection,
+                    "server": fakeredis.FakeServer(),
+                },
+            },
+        }
+    }
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class CommentReplayBufferTests(TestCase):
+    def setUp(self):
+        settings = override_settings(
+            CACHES=fakeredis_caches(), COMMENTS_WS_REPLAY_BUFFER=3
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        get_redis().delete(RECENT_EVENTS_KEY)
+
+    def message(self, seq, group="comments", comment_id=None, through=None):
+        return (
+            group,
+            {
+                "type": "new_comment",
+                "seq": seq,
+                "through": seq if through is None else through,
+                "comment_json": json.dumps({"id": comment_id or seq}),
+            },
+        )
+
+    def test_gap_inside_buffer_is_served_without_db(self):
+        record_events([self.message(i) for i in range(1, 6)])
+        record_events([self.message(6, thread_group(1))])
+        with self.assertNumQueries(0):
+            source, through, comments = replay(4, True, set(), {"comments"})
+        self.assertEqual((source, through), ("buffer", 6))
+        self.assertEqual([json.loads(c)["id"] for c in comments], [5])
+
+    def test_buffer_is_ordered_by_sequence(self):
+        # Published out of order by two publishers: seq 5 before seq 4.
+        record_events([self.message(i) for i in range(1, 4)])
+        record_events([self.message(5, comment_id=40, through=3)])
+        record_events([self.message(4, comment_id=50)])
+        source, through, comments = replay(3, True, set(), {"comments"})
+        self.assertEqual((source, through), ("buffer", 4))
+        self.assertEqual([json.loads(c)["id"] for c in comments], [50, 40])
+
+    def test_gap_older_than_buffer_falls_back_to_db(self):
+        record_events([self.message(i) for i in range(1, 6)])
+        self.assertEqual(replay(1, True, set(), {"comments"}), ("db", 1, []))
+
+
+def make_image(image_format, size, frames=1):
+    buffer = BytesIO()
+    images = [Image.new("RGB", size, (i * 40 % 256, 120, 200)) for i in range(frames)]
+    if frames > 1:
+        images[0].save(
+            buffer,
+            format=image_format,
+            save_all=True,
+            append_images=images[1:],
+            duration=80,
+            loop=0,
+        )
+    else:
+        images[0].save(buffer, format=image_format)
+    buffer.seek(0)
+    return buffer
+
+
+class TempMediaMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+
+class ImageRenditionTests(TempMediaMixin, SimpleTestCase):
+    def test_jpeg_renditions_fit_their_boxes(self):
+        renditions = build_renditions(
+            make_image("JPEG", (4000, 3000)), "attachments/big.jpg", default_storage
+        )
+        self.assertEqual(set(renditions), {"thumb", "thumb_2x"})
+        self.assertEqual(
+            (renditions["thumb"]["width"], renditions["thumb"]["height"]), (320, 240)
+        )
+        with default_storage.open(renditions["thumb_2x"]["name"]) as file:
+            self.assertEqual(Image.open(file).size, (640, 480))
+
+    def test_animated_gif_keeps_its_frames(self):
+        renditions = build_renditions(
+            make_image("GIF", (800, 600), frames=5),
+            "attachments/a.gif",
+            default_storage,
+        )
+        with default_storage.open(renditions["thumb"]["name"]) as file:
+            thumb = Image.open(file)
+            self.assertEqual(thumb.n_frames, 5)
+            self.assertEqual(thumb.size, (320, 240))
+
+    def test_only_renditions_smaller_than_the_original_are_written(self):
+        renditions = build_renditions(
+            make_image("PNG", (500, 300)), "attachments/mid.png", default_storage
+        )
+        self.assertEqual(set(renditions), {"thumb"})
+        self.assertEqual(
+            build_renditions(
+                make_image("PNG", (100, 100)), "attachments/s.png", default_storage
+            ),
+            {},
+        )
+
+
+class ImageInspectionTests(SimpleTestCase):
+    def test_header_metadata_is_recorded(self):
+        file = make_image("GIF", (300, 200), frames=3)
+        self.assertEqual(
+            inspect_image(file),
+            {"format": "GIF", "width": 300, "height": 200, "frames": 3},
+        )
+        self.assertEqual(file.tell(), 0)
+
+    @override_settings(COMMENTS_IMAGE_MAX_PIXELS=1000 * 1000)
+    def test_oversized_images_are_rejected_before_decoding(self):
+        with mock.patch("PIL.ImageFile.ImageFile.load") as load:
+            with self.assertRaises(ImageRejected):
+                inspect_image(make_image("PNG", (1001, 1000)))
+            with self.assertRaises(ImageRejected):
+                inspect_image(make_image("GIF", (500, 500), frames=5))
+        load.assert_not_called()
+
+    def test_upload_validation_rejects_broken_images(self):
+        upload = SimpleUploadedFile("bad.png", b"\x89PNG\r\n\x1a\nnot really")
+        with self.assertRaises(serializers.ValidationError):
+            CommentSerializer().validate_attachment(upload)
+
+        upload = SimpleUploadedFile("ok.png", make_image("PNG", (800, 600)).read())
+        CommentSerializer().validate_attachment(upload)
+        self.assertEqual(upload.image_info["width"], 800)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMMENTS_RENDITION_WORKERS=0)
+class ResizeTaskTests(TempMediaMixin, TestCase):
+    def test_original_is_kept_and_thumbnails_are_listed(self):
+        user = User.objects.create_user(
+            username="fay", email="fay@example.com", password="pass12345"
+        )
+        comment = Comment(text="pic", sender=user)
+        comment.attachment.save(
+            "photo.png", ContentFile(make_image("PNG", (1000, 800)).read()), save=False
+        )
+        comment.save()
+        original = comment.attachment.name
+
+        resize_comment_attachment(comment.id)
+
+        comment.refresh_from_db()
+        self.assertEqual(comment.attachment.name, original)
+        with comment.attachment.open("rb") as file:
+            self.assertEqual(Image.open(file).size, (1000, 800))
+        data = self.client.get("/api/comments/").json()["data"][0]
+        self.assertEqual(
+            data["thumbnails"]["thumb"],
+            "/media/" + comment.renditions["thumb"]["name"],
+        )
+
+    def test_small_images_are_skipped_without_opening(self):
+        info = {"format": "PNG", "width": 200, "height": 100, "frames": 1}
+        with mock.patch("comments.tasks.build_renditions") as build:
+            with self.assertNumQueries(0):
+                resize_comment_attachment(1, info)
+        build.assert_not_called()
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+@override_settings(COMMENTS_RENDITION_WORKERS=0)
+class RenditionBatchTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches = override_settings(CACHES=fakeredis_caches())
+        caches.enable()
+        self.addCleanup(caches.disable)
+        self.user = User.objects.create_user(
+            username="gus", email="gus@example.com", password="pass12345"
+        )
+
+    def make_comment(self, size):
+        comment = Comment(text="pic", sender=self.user)
+        comment.attachment.save(
+            "photo.png", ContentFile(make_image("PNG", size).read()), save=False
+        )
+        comment.save()
+        return comment
+
+    def queue(self, comments):
+        with mock.patch.object(process_pending_renditions, "delay") as delay:
+            for comment in comments:
+                queue_renditions(comment.id)
+        return delay
+
+    def test_uploads_are_drained_in_chunks(self):
+        comments = [self.make_comment((800, 600)) for _ in range(5)]
+        delay = self.queue(comments)
+        self.assertEqual(delay.call_count, 1)
+
+        with mock.patch(
+            "comments.tasks.render_batch", wraps=tasks.render_batch
+        ) as render_batch:
+            self.assertEqual(process_pending_renditions(chunk_size=2), 5)
+        self.assertEqual(
+            [len(call.args[0]) for call in render_batch.call_args_list], [2, 2, 1]
+        )
+        for comment in comments:
+            comment.refresh_from_db()
+            self.assertEqual(set(comment.renditions), {"thumb", "thumb_2x"})
+
+    def test_transient_failures_requeue_the_chunk(self):
+        comments = [self.make_comment((800, 600)) for _ in range(2)]
+        self.queue(comments)
+        with mock.patch(
+            "comments.tasks.render_batch", side_effect=DatabaseError("gone")
+        ):
+            with self.assertRaises(DatabaseError):
+                process_pending_renditions()
+        self.assertEqual(get_redis().llen(PENDING_RENDITIONS_KEY), 2)
+
+        self.assertEqual(process_pending_renditions(), 2)
+
+    @override_settings(COMMENTS_RENDITION_WORKERS=2)
+    def test_process_pool_renders_batches(self):
+        self.addCleanup(reset_pool)
+        comments = [self.make_comment((800, 600)) for _ in range(3)]
+        self.queue(comments)
+        self.assertEqual(process_pending_renditions(), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, COMMENTS_RENDITION_WORKERS=0)
+class CommentTransferTests(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username="hal", email="hal@example.com", password="pass12345"
+        )
+        self.root = Comment.objects.create(text="<i>root</i>", sender=self.user)
+        reply = Comment.objects.create(
+            text="reply", sender=self.user, parent_comment=self.root, is_reply=True
+        )
+        self.leaf = Comment(
+            text="leaf", sender=self.user, parent_comment=reply, is_reply=True
+        )
+        self.leaf.attachment.save(
+            "notes.txt", ContentFile(b"attached notes"), save=False
+        )
+        self.leaf.save()
+        Comment.objects.create(text="other", sender=self.user)
+
+    def export(self, **kwargs):
+        stream = BytesIO()
+        self.assertEqual(export_comments(stream, **kwargs), 4)
+        return stream.getvalue().splitlines()
+
+    def snapshot(self):
+        return list(
+            Comment.objects.order_by("id").values(
+                "id",
+                "parent_comment_id",
+                "text",
+                "text_html",
+                "created_at",
+                "sender__username",
+                "path",
+                "depth",
+                "reply_count",
+                "descendant_count",
+                "last_reply_at",
+            )
+        )
+
+    def test_round_trip_is_idempotent(self):
+        before = self.snapshot()
+        lines = self.export(inline_attachments=True)
+        self.assertEqual(
+            [json.loads(line)["id"] for line in lines],
+            [row["id"] for row in sorted(before, key=lambda row: row["path"])],
+        )
+        attachment = self.leaf.attachment.name
+        default_storage.delete(attachment)
+        Comment.objects.all().delete()
+
+        importer = Importer(batch_size=2).run(lines)
+        self.assertEqual((importer.imported, importer.skipped), (4, 0))
+        self.assertEqual(self.snapshot(), before)
+        with default_storage.open(attachment) as file:
+            self.assertEqual(file.read(), b"attached notes")
+
+        again = Importer(batch_size=2).run(lines)
+        self.assertEqual((again.imported, again.existing), (0, 4))
+        self.assertEqual(Comment.objects.count(), 4)
+
+    def test_failed_chunk_leaves_no_attachment_files(self):
+        lines = self.export(inline_attachments=True)
+        attachment = self.leaf.attachment.name
+        default_storage.delete(attachment)
+        Comment.objects.all().delete()
+
+        with mock.patch.object(
+            Comment.objects, "bulk_create", side_effect=DatabaseError("gone")
+        ):
+            with self.assertRaises(DatabaseError):
+                Importer(batch_size=4).run(lines)
+        self.assertFalse(default_storage.exists(attachment))
+
+    def test_unknown_senders_are_skipped_with_their_replies(self):
+        lines = self.export()
+        Comment.objects.all().delete()
+        self.user.delete()
+
+        importer = Importer().run(lines)
+        self.assertEqual((importer.imported, importer.skipped), (0, 4))
+
+        importer = Importer(create_users=True).run(lines)
+        self.assertEqual(importer.imported, 4)
+        self.assertFalse(User.objects.get(username="hal").has_usable_password())
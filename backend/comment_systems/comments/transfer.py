@@ -0,0 +1,231 @@
+import base64
+import json
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management.color import no_style
+from django.db import connection, reset_queries, transaction
+from django.utils.dateparse import parse_datetime
+
+from .cache import bump_content_version, bump_head_version
+from .counts import COUNT_CACHE_KEYS
+from .markup import render_markup
+from .models import Comment, path_segment
+from .tasks import queue_renditions
+from .tree import reconcile_counters
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# NDJSON, one comment per line. Comments are written in path order, so
+# every reply follows its parent, and keep their ids: parents are referenced
+# by id, senders by username. Import skips ids that already exist, which
+# makes re-running it a no-op.
+EXPORT_VALUES = (
+    "id",
+    "parent_comment_id",
+    "text",
+    "created_at",
+    "attachment",
+    "sender__username",
+    "sender__email",
+    "sender__homepage",
+)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+
+
+def dumps(record):
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return json.dumps(record, separators=(",", ":")).encode() + b"\n"
+
+
+def loads(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+def export_comments(stream, batch_size=2000, inline_attachments=False):
+    """Write every comment to the binary ``stream``; returns the count.
+
+    Attachments are referenced by storage name, or with
+    ``inline_attachments`` embedded base64-encoded.
+    """
+    storage = Comment._meta.get_field("attachment").storage
+    rows = (
+        Comment.objects.order_by("path", "id")
+        .values(*EXPORT_VALUES)
+        .iterator(chunk_size=batch_size)
+    )
+    exported = 0
+    for row in rows:
+        record = {
+            "id": row["id"],
+            "parent": row["parent_comment_id"],
+            "text": row["text"],
+            "created_at": row["created_at"].isoformat(),
+            "sender": {
+                "username": row["sender__username"],
+                "email": row["sender__email"],
+                "homepage": row["sender__homepage"],
+            },
+            "attachment": row["attachment"] or None,
+        }
+        if inline_attachments and row["attachment"]:
+            with storage.open(row["attachment"]) as file:
+                record["attachment_data"] = base64.b64encode(file.read()).decode()
+        stream.write(dumps(record))
+        exported += 1
+    return exported
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+@contextmanager
+def keep_created_at():
+    """Let bulk_create write the exported created_at instead of now()"""
+    field = Comment._meta.get_field("created_at")
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Importer:
+    """Imports NDJSON lines chunk by chunk; memory is bounded by the chunk.
+
+    Within a chunk, missing parents and senders are looked up with one
+    query each. Rows whose parent or sender cannot be found are skipped,
+    and so are their replies.
+    """
+
+    def __init__(self, batch_size=1000, create_users=False):
+        self.batch_size = batch_size
+        self.create_users = create_users
+        self.storage = Comment._meta.get_field("attachment").storage
+        self.imported = self.existing = self.skipped = 0
+
+    def run(self, lines, progress=None):
+        with keep_created_at():
+            for chunk in chunked(lines, self.batch_size):
+                self.import_chunk([loads(line) for line in chunk if line.strip()])
+                reset_queries()  # DEBUG keeps every query otherwise
+                if progress:
+                    progress(self)
+        if self.imported:
+            self.finish()
+        return self
+
+    def import_chunk(self, records):
+        present = set(
+            Comment.objects.filter(
+                id__in=[record["id"] for record in records]
+            ).values_list("id", flat=True)
+        )
+        self.existing += len(present)
+        records = [record for record in records if record["id"] not in present]
+        if not records:
+            return
+
+        senders = self.resolve_senders(records)
+        chunk_ids = {record["id"] for record in records}
+        parents = {
+            parent_id: (path, depth)
+            for parent_id, path, depth in Comment.objects.filter(
+                id__in={record["parent"] for record in records} - chunk_ids - {None}
+            ).values_list("id", "path", "depth")
+        }
+
+        comments = []
+        files = []
+        for record in records:
+            sender = senders.get(record["sender"]["username"])
+            parent = parents.get(record["parent"]) if record["parent"] else ("", -1)
+            if sender is None or parent is None:
+                self.skipped += 1
+                continue
+            comment = Comment(
+                id=record["id"],
+                parent_comment_id=record["parent"],
+                is_reply=record["parent"] is not None,
+                text=record["text"],
+                text_html=render_markup(record["text"])[0],
+                created_at=parse_datetime(record["created_at"]),
+                sender_id=sender.id,
+                sender_username=sender.username,
+                sender_email=sender.email,
+                path=parent[0] + path_segment(record["id"]),
+                depth=parent[1] + 1,
+                attachment=record["attachment"] or "",
+            )
+            # Replies later in this chunk find their parent here.
+            parents[comment.id] = (comment.path, comment.depth)
+            if record.get("attachment_data"):
+                files.append((comment, record["attachment_data"]))
+            comments.append(comment)
+
+        # Parents before replies, whatever the database checks foreign
+        # keys against.
+        comments.sort(key=lambda comment: comment.depth)
+        saved = []
+        try:
+            for comment, data in files:
+                comment.attachment.name = self.storage.save(
+                    comment.attachment.name, ContentFile(base64.b64decode(data))
+                )
+                saved.append(comment.attachment.name)
+            with transaction.atomic():
+                Comment.objects.bulk_create(comments, batch_size=self.batch_size)
+                for comment in comments:
+                    if comment.attachment.name.lower().endswith(IMAGE_EXTENSIONS):
+                        transaction.on_commit(partial(queue_renditions, comment.id))
+        except Exception:
+            # No row of the chunk points at these files any more.
+            for name in saved:
+                self.storage.delete(name)
+            raise
+        self.imported += len(comments)
+
+    def resolve_senders(self, records):
+        User = get_user_model()
+        wanted = {record["sender"]["username"]: record["sender"] for record in records}
+        users = User.objects.filter(username__in=wanted).in_bulk(field_name="username")
+        missing = [sender for name, sender in wanted.items() if name not in users]
+        if missing and self.create_users:
+            User.objects.bulk_create(
+                [
+                    User(
+                        username=sender["username"],
+                        email=sender["email"],
+                        homepage=sender.get("homepage"),
+                        password=make_password(None),
+                    )
+                    for sender in missing
+                ],
+                ignore_conflicts=True,
+            )
+            users = User.objects.filter(username__in=wanted).in_bulk(
+                field_name="username"
+            )
+        return users
+
+    def finish(self):
+        """Bring everything bulk_create bypassed up to date"""
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Comment]):
+                cursor.execute(sql)
+        reconcile_counters(Comment)
+        cache.delete_many(list(COUNT_CACHE_KEYS.values()))
+        bump_head_version()
+        bump_content_version()
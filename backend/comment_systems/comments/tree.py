@@ -0,0 +1,85 @@
+from django.db.models import F
+
+
+def nest_comments(items, root_id):
+    """Turn serialized comments of one subtree into a nested reply tree.
+
+    ``items`` must contain every comment between ``root_id`` and the
+    deepest level requested; each node gets a ``replies`` list ordered like
+    ``items``.
+    """
+    nodes = {}
+    for item in items:
+        item["replies"] = []
+        nodes[item["id"]] = item
+    for item in items:
+        parent = nodes.get(item["parent_comment"])
+        if parent is not None and item["id"] != root_id:
+            parent["replies"].append(item)
+    return nodes.get(root_id)
+
+
+COUNTER_FIELDS = ["reply_count", "descendant_count", "last_reply_at"]
+
+
+def reconcile_counters(model, batch_size=1000, dry_run=False):
+    """Recompute every comment's thread counters in one pass over the table.
+
+    Rows are streamed in path order, which is a preorder walk of every
+    thread, so a stack of open ancestors is enough to aggregate subtrees.
+    Only rows whose stored counters drifted are written. Returns the number
+    of rows that were (or, with ``dry_run``, would be) fixed.
+    """
+    rows = (
+        model.objects.exclude(path="")
+        .order_by("path")
+        .values_list("id", "path", "created_at", *COUNTER_FIELDS)
+        .iterator(chunk_size=batch_size)
+    )
+    stack = []
+    drifted = []
+    fixed = 0
+
+    def flush():
+        if drifted and not dry_run:
+            model.objects.bulk_update(drifted, [*COUNTER_FIELDS, "version"])
+        drifted.clear()
+
+    def close():
+        nonlocal fixed
+        node = stack.pop()
+        actual = (node["replies"], node["descendants"], node["last"])
+        if actual != node["stored"]:
+            fixed += 1
+            row = model(id=node["id"], **dict(zip(COUNTER_FIELDS, actual)))
+            row.version = F("version") + 1
+            drifted.append(row)
+            if len(drifted) >= batch_size:
+                flush()
+        if stack:
+            parent = stack[-1]
+            parent["descendants"] += node["descendants"] + 1
+            latest = max(node["created_at"], node["last"] or node["created_at"])
+            if parent["last"] is None or latest > parent["last"]:
+                parent["last"] = latest
+
+    for comment_id, path, created_at, *stored in rows:
+        while stack and not path.startswith(stack[-1]["path"]):
+            close()
+        if stack:
+            stack[-1]["replies"] += 1
+        stack.append(
+            {
+                "id": comment_id,
+                "path": path,
+                "created_at": created_at,
+                "stored": tuple(stored),
+                "replies": 0,
+                "descendants": 0,
+                "last": None,
+            }
+        )
+    while stack:
+        close()
+    flush()
+    return fixed
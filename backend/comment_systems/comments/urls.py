@@ -1,6 +1,12 @@
-from .views import CommentAPIView
+from .views import CommentAPIView, CommentSearchAPIView, CommentThreadAPIView
 from django.urls import path
 
 urlpatterns = [
     path("comments/", CommentAPIView.as_view(), name="comment"),
+    path("comments/search/", CommentSearchAPIView.as_view(), name="comment_search"),
+    path(
+        "comments/<int:pk>/thread/",
+        CommentThreadAPIView.as_view(),
+        name="comment_thread",
+    ),
 ]
@@ -1,36 +1,87 @@
-import requests
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.pagination import PageNumberPagination
-from django.core.cache import cache
-from .serializers import CommentSerializer
-from .models import Comment
+from rest_framework.exceptions import NotFound
+from django.http import Http404, HttpResponse
+from django.utils.http import parse_etags
+from .serializers import (
+    COMMENT_VALUES,
+    CommentSerializer,
+    serialize_comment_values,
+)
+from .models import Comment, path_ids
+from .pagination import CommentCursorPaginator, InvalidCursor, decode_cursor
+from .filters import CommentListQuery, InvalidListQuery
+from .counts import count_comments
+from .tree import nest_comments
+from .search import get_search_backend, highlight, search_terms
+from .captcha import get_captcha_verifier
+from .instrumentation import timed_serialization
+from . import metrics
+from .cache import (
+    page_cache_key,
+    cursor_cache_key,
+    page_cache_ttl,
+    get_or_compute_versioned,
+    get_fragments,
+    list_etag,
+)
 import math
 from django.conf import settings
 
 
-class CommentAPIView(APIView):
-    authentication_classes = [JWTAuthentication]
+def render_comments(ids):
+    """Serialize the comments ``ids``, for get_fragments"""
+    rows = list(Comment.objects.filter(id__in=ids).values(*COMMENT_VALUES))
+    with timed_serialization():
+        return {item["id"]: item for item in serialize_comment_values(rows)}
 
-    def verify_captcha(self, token, remote_ip=None):
-        """Verify captcha token with Google"""
-        url = "https://www.google.com/recaptcha/api/siteverify"
-        data = {
-            "secret": settings.RECAPTCHA_SECRET_KEY,
-            "response": token,
-        }
-        if remote_ip:
-            data["remoteip"] = remote_ip
 
-        try:
-            r = requests.post(url, data=data)
-            result = r.json()
-            return result.get("success", False)
-        except Exception as e:
+def thread_roots(paths):
+    """Root ids of the threads of comments at ``paths``"""
+    return sorted({path_ids(path)[0] for path in paths if path})
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; 404 outside COMMENTS_METRICS_ALLOWED_IPS"""
+    allowed = getattr(settings, "COMMENTS_METRICS_ALLOWED_IPS", ("127.0.0.1", "::1"))
+    if request.META.get("REMOTE_ADDR") not in allowed:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def etag_matches(request, etag):
+    """Weak If-None-Match comparison, so compressed (W/) ETags match too"""
+    etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    return "*" in etags or any(tag.removeprefix("W/") == etag for tag in etags)
+
+
+def cached_list_response(request, key, version, compute, ttl):
+    """The cached list page at ``key``, or 304 when the client already has
+    it. ``compute`` returns the page and the threads it shows, see
+    get_or_compute_versioned. Pages served stale while being recomputed
+    carry no ETag."""
+    data, tag = get_or_compute_versioned(key, version, compute, ttl, threads=True)
+    if tag is None:
+        response = Response(data)
+    else:
+        etag = list_etag(key, tag)
+        if etag_matches(request, etag):
+            response = Response(status=304, headers={"ETag": etag})
+        else:
+            response = Response(data, headers={"ETag": etag})
+    # Browsers may keep the page but must revalidate it on every use.
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+class CommentAPIView(APIView):
+    authentication_classes = [JWTAuthentication]
 
-            return False
+    def verify_captcha(self, token, remote_ip=None, user_id=None):
+        """Verify captcha token with the configured backend"""
+        return get_captcha_verifier().verify(token, remote_ip, user_id)
 
     def post(self, request):
         captcha_token = request.data.get("captcha")
@@ -38,7 +89,7 @@ class CommentAPIView(APIView):
             return Response({"error": "Captcha token is required."}, status=400)
 
         user_ip = request.META.get("REMOTE_ADDR")
-        if not self.verify_captcha(captcha_token, user_ip):
+        if not self.verify_captcha(captcha_token, user_ip, request.user.pk):
             return Response({"error": "Captcha verification failed."}, status=400)
 
         data = request.data.copy()
@@ -50,9 +101,12 @@ class CommentAPIView(APIView):
         data["homepage"] = getattr(user, "homepage", "")
 
         serializer = CommentSerializer(data=data)
-        if serializer.is_valid():
+        with timed_serialization():
+            valid = serializer.is_valid()
+        if valid:
             comment = serializer.save()
-            cache.clear()
+            # One solved captcha, one comment.
+            get_captcha_verifier().forget(captcha_token, user_ip, request.user.pk)
             return Response(
                 {"message": "Comment created successfully", "comment_id": comment.id},
                 status=201,
@@ -61,34 +115,185 @@ class CommentAPIView(APIView):
 
     def get(self, request):
         page_num = request.query_params.get("page", "1")
-        per_page = int(request.query_params.get("per_page", 25))
+        try:
+            query = CommentListQuery(request.query_params)
+        except InvalidListQuery as e:
+            return Response({"error": str(e)}, status=400)
+        per_page = query.per_page
 
-        cache_key = f"comments_page_{page_num}_per_{per_page}"
-        cached_response = cache.get(cache_key)
-        if cached_response:
-            return Response(cached_response)
+        if (
+            request.query_params.get("pagination") == "cursor"
+            or "cursor" in request.query_params
+        ):
+            return self.get_cursor_page(request, per_page, query)
 
-        queryset = Comment.objects.all().order_by("-created_at")
-        paginator = PageNumberPagination()
-        paginator.page_size = per_page
-        page = paginator.paginate_queryset(queryset, request)
+        cache_key, version = page_cache_key(page_num, per_page, query.cache_suffix())
+        return cached_list_response(
+            request,
+            cache_key,
+            version,
+            lambda: self.build_page(request, page_num, per_page, query),
+            ttl=page_cache_ttl(int(page_num) if page_num.isdigit() else 1),
+        )
 
-        total = queryset.count()
-        last_page = math.ceil(total / per_page)
+    def build_page(self, request, page_num, per_page, query):
+        if not page_num.isdigit() or int(page_num) < 1:
+            raise NotFound("Invalid page.")
         current_page = int(page_num)
+        offset = (current_page - 1) * per_page
 
-        serializer = CommentSerializer(page, many=True)
+        # Only ids, versions and paths here; the rows come from the fragment
+        # cache.
+        queryset = query.filter(Comment.objects.all()).order_by(*query.order_by())
+        rows = queryset.values_list("id", "version", "path")
+        page = list(rows[offset : offset + per_page])
+        if not page and current_page > 1:
+            raise NotFound("Invalid page.")
 
-        response_data = {
-            "data": serializer.data,
+        total, total_mode = count_comments(query, query.count_mode)
+        last_page = math.ceil(total / per_page)
+
+        data = get_fragments(
+            [(comment_id, version) for comment_id, version, _ in page],
+            render_comments,
+        )
+        return {
+            "data": data,
             "meta": {
                 "total": total,
+                "total_mode": total_mode,
                 "per_page": per_page,
                 "current_page": current_page,
                 "last_page": last_page,
             },
-        }
+        }, thread_roots(path for _, _, path in page)
+
+    def get_cursor_page(self, request, per_page, query):
+        """Keyset-paginated list; the exact total is only counted on request"""
+        cursor = request.query_params.get("cursor") or None
+        with_total = request.query_params.get("with_total") in ("1", "true")
+
+        try:
+            direction = decode_cursor(cursor, query.fields)[1] if cursor else "next"
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=400)
+
+        cache_key, version = cursor_cache_key(
+            cursor,
+            direction,
+            per_page,
+            with_total,
+            query_suffix=query.cache_suffix(),
+            newest_first=query.newest_first,
+        )
+        return cached_list_response(
+            request,
+            cache_key,
+            version,
+            lambda: self.build_cursor_page(cursor, per_page, with_total, query),
+            ttl=page_cache_ttl(1 if cursor is None else math.inf),
+        )
+
+    def build_cursor_page(self, cursor, per_page, with_total, query):
+        paginator = CommentCursorPaginator(per_page, query.fields, query.descending)
+        queryset = query.filter(
+            Comment.objects.only("id", "version", "path", *query.fields)
+        )
+        rows, next_cursor, prev_cursor = paginator.paginate(queryset, cursor)
+
+        total = total_mode = last_page = None
+        if with_total:
+            total, total_mode = count_comments(query, query.count_mode)
+            last_page = math.ceil(total / per_page)
+
+        return {
+            "data": get_fragments(
+                [(row.id, row.version) for row in rows], render_comments
+            ),
+            "meta": {
+                "total": total,
+                "total_mode": total_mode,
+                "per_page": per_page,
+                "current_page": None,
+                "last_page": last_page,
+                "next": next_cursor,
+                "prev": prev_cursor,
+            },
+        }, thread_roots(row.path for row in rows)
+
+
+class CommentThreadAPIView(APIView):
+    authentication_classes = [JWTAuthentication]
+
+    def get(self, request, pk):
+        """Return the comment ``pk`` with its replies nested below it"""
+        depth = request.query_params.get("depth")
+        if depth is not None and not depth.isdigit():
+            return Response(
+                {"error": "depth must be a non-negative integer"}, status=400
+            )
+
+        node = Comment.objects.filter(pk=pk).only("id", "path", "depth").first()
+        # A comment without a path is not committed yet (or was written
+        # around Comment.save); path__startswith="" would match every row.
+        if node is None or not node.path:
+            return Response({"error": "Comment not found."}, status=404)
+
+        queryset = (
+            Comment.objects.for_list()
+            .filter(path__startswith=node.path)
+            .order_by("path")
+        )
+        if depth is not None:
+            queryset = queryset.filter(depth__lte=node.depth + int(depth))
+
+        comments = list(queryset)
+        with timed_serialization():
+            data = CommentSerializer(comments, many=True).data
+        return Response({"data": nest_comments(data, node.id)})
+
+
+class CommentSearchAPIView(APIView):
+    authentication_classes = [JWTAuthentication]
+    max_per_page = 100
+
+    def get(self, request):
+        """Comments matching every word of ``?q=``, most relevant first"""
+        query = request.query_params.get("q", "")
+        terms = search_terms(query)
+        if not terms:
+            return Response({"error": "q must contain at least one word"}, status=400)
+
+        page_num = request.query_params.get("page", "1")
+        per_page = request.query_params.get("per_page", "25")
+        if not page_num.isdigit() or not per_page.isdigit() or int(page_num) < 1:
+            return Response(
+                {"error": "page and per_page must be positive integers"}, status=400
+            )
+        page_num = int(page_num)
+        per_page = min(max(int(per_page), 1), self.max_per_page)
 
-        cache.set(cache_key, response_data, timeout=300)
+        ids, total = get_search_backend().search(
+            terms, (page_num - 1) * per_page, per_page
+        )
+        rows = Comment.objects.for_list().in_bulk(ids)
+        serializer = CommentSerializer(
+            [rows[comment_id] for comment_id in ids if comment_id in rows], many=True
+        )
+        with timed_serialization():
+            data = serializer.data
+        for item in data:
+            item["highlight"] = highlight(item["text"], terms)
 
-        return Response(response_data)
+        return Response(
+            {
+                "data": data,
+                "meta": {
+                    "query": query,
+                    "total": total,
+                    "per_page": per_page,
+                    "current_page": page_num,
+                    "last_page": math.ceil(total / per_page),
+                },
+            }
+        )
@@ -1,12 +1,19 @@
 import api from '@/axios'
 
+// The e-mail column is labelled "sender" in the table
+const ORDERING_FIELDS = { username: 'username', sender: 'email', created_at: 'created_at' }
+
+function toOrdering(sort) {
+    const field = ORDERING_FIELDS[sort.field] || 'created_at'
+    return sort.direction === 'desc' ? `-${field}` : field
+}
+
 export async function fetchComments({ page, perPage, sort }) {
     const response = await api.get('/api/comments/', {
         params: {
             page,
             per_page: perPage,
-            sort_by: sort.field,
-            sort_dir: sort.direction,
+            ordering: toOrdering(sort),
         },
     })
     return response.data